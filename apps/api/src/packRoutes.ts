@@ -2,7 +2,12 @@ import type { FastifyInstance } from 'fastify';
 import { promises as fs } from 'fs';
 import path from 'path';
 
-import { loadLocalPackItems, loadLocalPacks, resolveKinPortraitAsset } from '@dbu/adapters';
+import {
+  loadLocalPackItems,
+  loadLocalPacks,
+  loadPackPortraitIndex,
+  resolveKinPortraitAsset,
+} from '@dbu/adapters';
 import type { ContentRef } from '@dbu/types';
 
 import { requireAuth } from './auth.js';
@@ -24,6 +29,12 @@ const contentTypeForPath = (filePath: string) => {
   return 'application/octet-stream';
 };
 
+// Portrait URLs carry a content hash (from the pack's index.json) once the
+// generators have published it, so those responses can be cached forever.
+const VERSION_LENGTH = 16;
+const SHORT_CACHE = 'private, max-age=3600';
+const IMMUTABLE_CACHE = 'private, max-age=31536000, immutable';
+
 export const registerPackRoutes = (server: FastifyInstance) => {
   server.get('/packs', { preHandler: requireAuth }, async (_request, reply) => {
     const rootDir =
@@ -77,12 +88,14 @@ export const registerPackRoutes = (server: FastifyInstance) => {
       }
 
       const assetPath = resolved.assetPath.replace(/\\/g, '/');
+      const version = resolved.file?.sha256.slice(0, VERSION_LENGTH);
       reply.send({
         url: `/packs/assets?pack_id=${encodeURIComponent(resolved.pack.metadata.id)}&path=${encodeURIComponent(
           assetPath,
-        )}`,
+        )}${version ? `&v=${version}` : ''}`,
         pack_id: resolved.pack.metadata.id,
         path: assetPath,
+        sha256: resolved.file?.sha256 ?? null,
       });
     },
   );
@@ -118,7 +131,7 @@ export const registerPackRoutes = (server: FastifyInstance) => {
       const data = await fs.readFile(filePath);
       reply
         .header('Content-Type', contentTypeForPath(filePath))
-        .header('Cache-Control', 'private, max-age=3600')
+        .header('Cache-Control', SHORT_CACHE)
         .send(data);
     } catch (error) {
       if (
@@ -134,9 +147,10 @@ export const registerPackRoutes = (server: FastifyInstance) => {
   });
 
   server.get('/packs/assets', { preHandler: requireAuth }, async (request, reply) => {
-    const query = request.query as { pack_id?: string; path?: string };
+    const query = request.query as { pack_id?: string; path?: string; v?: string };
     const packId = query.pack_id?.trim();
     const assetPath = query.path?.trim();
+    const version = query.v?.trim();
 
     if (!packId || !assetPath) {
       reply.code(400).send({ error: 'missing_pack_or_path' });
@@ -160,12 +174,20 @@ export const registerPackRoutes = (server: FastifyInstance) => {
       return;
     }
 
+    let cacheControl = SHORT_CACHE;
+    if (version && version.length >= VERSION_LENGTH) {
+      // Only trust the version if it still matches the indexed content.
+      const index = await loadPackPortraitIndex(pack);
+      const file = index.files[assetPath.replace(/\\/g, '/')];
+      if (file?.sha256.startsWith(version)) cacheControl = IMMUTABLE_CACHE;
+    }
+
     const filePath = path.join(pack.directory, assetPath);
     try {
       const data = await fs.readFile(filePath);
       reply
         .header('Content-Type', contentTypeForPath(filePath))
-        .header('Cache-Control', 'private, max-age=3600')
+        .header('Cache-Control', cacheControl)
         .send(data);
     } catch (error) {
       if (
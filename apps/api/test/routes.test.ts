@@ -1,6 +1,7 @@
 import Fastify from 'fastify';
 import { describe, expect, it, vi } from 'vitest';
 
+import { createHash } from 'crypto';
 import { promises as fs } from 'fs';
 import os from 'os';
 import path from 'path';
@@ -216,6 +217,36 @@ describe('api routes', () => {
     expect(res.body.length).toBeGreaterThan(0);
   });
 
+  it('GET /packs/assets serves hashed portraits as immutable', async () => {
+    const packsDir = await makeTempPacksDir();
+    process.env.PACKS_DIR = packsDir;
+    const sha256 = createHash('sha256').update('not-a-real-png-but-ok').digest('hex');
+    await writeJson(path.join(packsDir, 'core', 'assets', 'portraits', 'index.json'), {
+      kins: { 'core:human': 'assets/portraits/kins/human.png' },
+      files: { 'assets/portraits/kins/human.png': { sha256, bytes: 21 } },
+    });
+
+    const app = Fastify();
+    registerPackRoutes(app);
+
+    const resolved = await app.inject({
+      method: 'GET',
+      url: '/packs/portraits/kins/resolve?ref=core:human',
+    });
+    expect(resolved.json().sha256).toBe(sha256);
+    expect(resolved.json().url).toContain(`&v=${sha256.slice(0, 16)}`);
+
+    const res = await app.inject({ method: 'GET', url: resolved.json().url });
+    expect(res.statusCode).toBe(200);
+    expect(res.headers['cache-control']).toContain('immutable');
+
+    const stale = await app.inject({
+      method: 'GET',
+      url: '/packs/assets?pack_id=core&path=assets/portraits/kins/human.png&v=0000000000000000',
+    });
+    expect(stale.headers['cache-control']).toBe('private, max-age=3600');
+  });
+
   it('GET /packs/assets rejects path traversal', async () => {
     const packsDir = await makeTempPacksDir();
     process.env.PACKS_DIR = packsDir;
@@ -8,6 +8,14 @@ import { loadLocalPacks } from './packLoader.js';
 export const PACK_PORTRAIT_INDEX_FILE = path.join('assets', 'portraits', 'index.json');
 export const PACK_KIN_PORTRAIT_DIR = path.join('assets', 'portraits', 'kins');
 
+// Written by scripts/imagegen (publish): content hash and size per asset path.
+export type PortraitFileInfo = {
+  sha256: string;
+  bytes: number;
+  width?: number;
+  height?: number;
+};
+
 const isObject = (value: unknown): value is Record<string, unknown> =>
   Boolean(value) && typeof value === 'object' && !Array.isArray(value);
 
@@ -19,6 +27,42 @@ const isSafeRelativePath = (value: string) => {
   return true;
 };
 
+const isSha256 = (value: unknown): value is string =>
+  typeof value === 'string' && /^[0-9a-f]{64}$/.test(value);
+
+const parseFiles = (
+  rawFiles: unknown,
+  indexPath: string,
+  packId: string,
+  errors: PackValidationError[],
+): Record<string, PortraitFileInfo> => {
+  const files: Record<string, PortraitFileInfo> = {};
+  if (rawFiles === undefined) return files;
+  if (!isObject(rawFiles)) {
+    errors.push({
+      message: `Invalid portrait index files map (${packId})`,
+      path: `${indexPath}#/files`,
+    });
+    return files;
+  }
+  Object.entries(rawFiles).forEach(([assetPath, value]) => {
+    if (!isObject(value) || !isSha256(value.sha256) || typeof value.bytes !== 'number') {
+      errors.push({
+        message: `Invalid portrait file entry for ${assetPath} (${packId})`,
+        path: `${indexPath}#/files/${assetPath}`,
+      });
+      return;
+    }
+    files[assetPath] = {
+      sha256: value.sha256,
+      bytes: value.bytes,
+      ...(typeof value.width === 'number' ? { width: value.width } : {}),
+      ...(typeof value.height === 'number' ? { height: value.height } : {}),
+    };
+  });
+  return files;
+};
+
 const parseContentRef = (value: string): { packId: string; localId: string } | null => {
   const idx = value.indexOf(':');
   if (idx <= 0) return null;
@@ -32,6 +76,7 @@ export const loadPackPortraitIndex = async (
   pack: LocalPack,
 ): Promise<{
   kins: Record<string, string>;
+  files: Record<string, PortraitFileInfo>;
   errors: PackValidationError[];
 }> => {
   const errors: PackValidationError[] = [];
@@ -42,20 +87,24 @@ export const loadPackPortraitIndex = async (
     if (!isObject(json)) {
       return {
         kins: {},
+        files: {},
         errors: [
           { message: `Invalid portrait index format (${pack.metadata.id})`, path: indexPath },
         ],
       };
     }
 
+    const files = parseFiles((json as any).files, indexPath, pack.metadata.id, errors);
     const rawKins = (json as any).kins;
     if (rawKins === undefined) {
-      return { kins: {}, errors: [] };
+      return { kins: {}, files, errors };
     }
     if (!isObject(rawKins)) {
       return {
         kins: {},
+        files,
         errors: [
+          ...errors,
           {
             message: `Invalid portrait index kins map (${pack.metadata.id})`,
             path: `${indexPath}#/kins`,
@@ -97,18 +146,19 @@ export const loadPackPortraitIndex = async (
       kins[key] = value;
     });
 
-    return { kins, errors };
+    return { kins, files, errors };
   } catch (error) {
     if (
       error instanceof Error &&
       'code' in error &&
       (error as NodeJS.ErrnoException).code === 'ENOENT'
     ) {
-      return { kins: {}, errors: [] };
+      return { kins: {}, files: {}, errors: [] };
     }
 
     return {
       kins: {},
+      files: {},
       errors: [
         {
           message: `Failed to load portrait index (${pack.metadata.id}): ${error instanceof Error ? error.message : 'unknown error'}`,
@@ -123,14 +173,20 @@ export const resolveKinPortraitAsset = async (
   rootDir: string,
   kinRef: ContentRef,
 ): Promise<
-  | { pack: LocalPack; assetPath: string; errors: PackValidationError[] }
-  | { pack: null; assetPath: null; errors: PackValidationError[] }
+  | {
+      pack: LocalPack;
+      assetPath: string;
+      file: PortraitFileInfo | null;
+      errors: PackValidationError[];
+    }
+  | { pack: null; assetPath: null; file: null; errors: PackValidationError[] }
 > => {
   const parsed = parseContentRef(kinRef);
   if (!parsed) {
     return {
       pack: null,
       assetPath: null,
+      file: null,
       errors: [{ message: `Invalid kin reference: ${kinRef}`, path: 'kin_ref' }],
     };
   }
@@ -141,6 +197,7 @@ export const resolveKinPortraitAsset = async (
     return {
       pack: null,
       assetPath: null,
+      file: null,
       errors: [...errors, { message: `Pack not found: ${parsed.packId}`, path: 'pack_id' }],
     };
   }
@@ -150,9 +207,19 @@ export const resolveKinPortraitAsset = async (
 
   const mapped = index.kins[kinRef];
   if (mapped) {
-    return { pack, assetPath: mapped, errors: [...errors, ...indexErrors] };
+    return {
+      pack,
+      assetPath: mapped,
+      file: index.files[mapped] ?? null,
+      errors: [...errors, ...indexErrors],
+    };
   }
 
   const fallback = path.join(PACK_KIN_PORTRAIT_DIR, `${parsed.localId}.png`);
-  return { pack, assetPath: fallback, errors: [...errors, ...indexErrors] };
+  return {
+    pack,
+    assetPath: fallback,
+    file: index.files[fallback.replace(/\\/g, '/')] ?? null,
+    errors: [...errors, ...indexErrors],
+  };
 };
@@ -9,26 +9,46 @@ import os
 import shutil
 import subprocess
 import sys
-import urllib.parse
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Tuple
 
 from comfyui_lib import (
+    DEFAULT_NEGATIVE,
+    DEFAULT_WORK_QUEUE,
+    GENERATE_DEFAULTS,
     ROOT_DIR,
-    choose_seed,
-    comfy_txt2img_workflow,
-    extract_first_image_from_history,
-    http_get_bytes,
-    http_json,
+    BatchJob,
+    ComfyUIBackend,
+    FailedItem,
+    checkpoint_loads,
+    close_watch,
+    comfyui_backend_from_cfg,
+    comfyui_server_url,
+    comfyui_timing_key,
+    connect_comfyui_server,
+    default_checkpoints_dir,
+    embed_output_metadata,
+    job_items_from_cfg,
     load_data_file,
     list_checkpoint_files,
+    open_progress,
+    open_timings,
+    open_work_queue,
+    order_batch,
     poll_server_ready,
-    read_kin_prompts_md,
+    print_job_plan,
+    print_server_split,
+    resolve_job_checkpoint,
+    optimize_job_outputs,
+    publish_job_outputs,
     resolve_checkpoint_name,
-    slugify,
+    retry_policy_from_cfg,
+    run_job,
+    session,
+    span,
     start_comfyui_server,
     validate_job_config,
-    wait_for_history,
+    workflow_template_from_cfg,
 )
 
 
@@ -40,10 +60,6 @@ def _default_extra_model_paths() -> Path:
     return ROOT_DIR / "scripts/comfyui/extra_model_paths.yaml"
 
 
-def _default_checkpoints_dir(comfy_dir: Path) -> Path:
-    return comfy_dir / "models/checkpoints"
-
-
 def _which_or_exit(bin_name: str, *, hint: str) -> str:
     p = shutil.which(bin_name)
     if p:
@@ -69,24 +85,27 @@ def cmd_setup(args: argparse.Namespace) -> int:
 
     if not comfy_dir.exists():
         print(f"Cloning ComfyUI into {comfy_dir} ...")
-        subprocess.check_call(
-            [
-                git,
-                "clone",
-                "https://github.com/comfyanonymous/ComfyUI.git",
-                str(comfy_dir),
-            ]
-        )
+        with span("setup.git_clone"):
+            subprocess.check_call(
+                [
+                    git,
+                    "clone",
+                    "https://github.com/comfyanonymous/ComfyUI.git",
+                    str(comfy_dir),
+                ]
+            )
     else:
         print(f"Found existing: {comfy_dir}")
         if args.update:
             print("Updating ComfyUI (git pull --ff-only) ...")
-            subprocess.check_call([git, "-C", str(comfy_dir), "pull", "--ff-only"])
+            with span("setup.git_pull"):
+                subprocess.check_call([git, "-C", str(comfy_dir), "pull", "--ff-only"])
 
     venv_dir = comfy_dir / ".venv"
     if not venv_dir.exists():
         print("Creating venv ...")
-        subprocess.check_call([py_bin, "-m", "venv", str(venv_dir)])
+        with span("setup.venv"):
+            subprocess.check_call([py_bin, "-m", "venv", str(venv_dir)])
 
     pip = venv_dir / "bin/pip"
     if not pip.exists():
@@ -115,10 +134,11 @@ def cmd_setup(args: argparse.Namespace) -> int:
 
     if needs_install:
         print("Installing Python dependencies (this can take a while) ...")
-        subprocess.check_call([str(pip), "install", "-U", "pip"])
-        if req_path.exists():
-            subprocess.check_call([str(pip), "install", "-r", str(req_path)])
-        subprocess.check_call([str(pip), "install", *runner_deps])
+        with span("setup.pip_install"):
+            subprocess.check_call([str(pip), "install", "-U", "pip"])
+            if req_path.exists():
+                subprocess.check_call([str(pip), "install", "-r", str(req_path)])
+            subprocess.check_call([str(pip), "install", *runner_deps])
         marker.write_text(
             json.dumps(
                 {"requirements_sha256": req_hash, "runner_deps": runner_deps},
@@ -155,6 +175,7 @@ def cmd_run_server(args: argparse.Namespace) -> int:
         host=args.host,
         port=args.port,
         extra_model_paths_yaml=extra,
+        preview_method=args.preview_method,
     )
     return proc.wait()
 
@@ -164,7 +185,7 @@ def cmd_doctor(args: argparse.Namespace) -> int:
     venv_py = comfy_dir / ".venv/bin/python"
     if not venv_py.exists():
         venv_py = comfy_dir / ".venv/Scripts/python.exe"
-    checkpoints_dir = _default_checkpoints_dir(comfy_dir)
+    checkpoints_dir = default_checkpoints_dir(comfy_dir)
     server = args.server.rstrip("/")
 
     problems: List[str] = []
@@ -187,7 +208,8 @@ def cmd_doctor(args: argparse.Namespace) -> int:
             print(f"- {p}")
         return 2
 
-    ckpts = list_checkpoint_files(checkpoints_dir)
+    with span("checkpoint.list"):
+        ckpts = list_checkpoint_files(checkpoints_dir)
     if not ckpts:
         print(
             "No checkpoints found. Put a model in tools/ComfyUI/models/checkpoints and rerun."
@@ -210,32 +232,53 @@ def cmd_doctor(args: argparse.Namespace) -> int:
     return 0
 
 
-def _job_items_from_cfg(cfg: dict) -> List[tuple[str, str]]:
-    items = cfg.get("items")
-    if isinstance(items, list):
-        out: List[tuple[str, str]] = []
-        for it in items:
-            if not isinstance(it, dict):
-                raise SystemExit("items must contain objects")
-            name = str(it.get("name") or "").strip()
-            prompt = str(it.get("prompt") or "").strip()
-            if not name or not prompt:
-                raise SystemExit("each item requires name and prompt")
-            out.append((name, prompt))
-        return out
-
-    source = cfg.get("source")
-    if isinstance(source, dict):
-        stype = str(source.get("type") or "").strip()
-        if stype == "kin_prompts_markdown":
-            md_path = source.get("path") or str(
-                ROOT_DIR / "docs/character_creation/kin-profile-portrait-prompts.md"
-            )
-            prompts = read_kin_prompts_md(Path(md_path))
-            return [(p.name, p.prompt) for p in prompts]
-        raise SystemExit(f"Unknown source.type: {stype}")
+def _generate_defaults(args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        "width": args.width,
+        "height": args.height,
+        "steps": args.steps,
+        "cfg": args.cfg,
+        "sampler": args.sampler,
+        "scheduler": args.scheduler,
+        "negative": args.negative,
+        "timeout_s": args.timeout,
+        "denoise": args.denoise,
+        "previews": args.previews,
+    }
+
+
+def _wants_previews(cfg: Dict[str, Any]) -> bool:
+    gen = cfg.get("generate")
+    return bool(gen.get("previews")) if isinstance(gen, dict) else False
+
 
-    raise SystemExit("Config must include either items[] or source{type=...}")
+def _load_job(path: Path) -> Dict[str, Any]:
+    cfg = load_data_file(path)
+    if not isinstance(cfg, dict):
+        raise SystemExit(f"Job config must be an object at top-level: {path}")
+    validate_job_config(cfg)
+    return cfg
+
+
+def _refreshes(cfg: Dict[str, Any], defaults: Dict[str, Any]) -> bool:
+    gen = cfg.get("generate")
+    gen = gen if isinstance(gen, dict) else {}
+    return float(gen.get("denoise", defaults["denoise"])) < 1.0
+
+
+def _job_output(
+    cfg: Dict[str, Any],
+    *,
+    default_dir: str,
+    defaults: Dict[str, Any] = GENERATE_DEFAULTS,
+) -> Tuple[Path, str, bool]:
+    out_raw = cfg.get("output")
+    out_cfg = out_raw if isinstance(out_raw, dict) else {}
+    out_dir = Path(out_cfg.get("dir") or default_dir).resolve()
+    out_ext = str(out_cfg.get("ext") or "png").lstrip(".")
+    # A refresh re-samples existing outputs, so it can't skip them.
+    overwrite = bool(out_cfg.get("overwrite") or False) or _refreshes(cfg, defaults)
+    return out_dir, out_ext, overwrite
 
 
 def cmd_generate(args: argparse.Namespace) -> int:
@@ -246,188 +289,270 @@ def cmd_generate(args: argparse.Namespace) -> int:
         if args.extra_model_paths
         else _default_extra_model_paths()
     )
+    defaults = _generate_defaults(args)
 
-    cfg: dict | None = None
     if args.job:
-        cfg = load_data_file(Path(args.job))
-        if not isinstance(cfg, dict):
-            raise SystemExit("Job config must be an object at top-level")
-        validate_job_config(cfg)
-
-        server_raw = cfg.get("server")
-        server_cfg = server_raw if isinstance(server_raw, dict) else {}
-        server = str(server_cfg.get("url") or server).rstrip("/")
-
-        comfy_raw = cfg.get("comfyui")
-        comfy_cfg = comfy_raw if isinstance(comfy_raw, dict) else {}
-        comfy_dir = Path(comfy_cfg.get("dir") or str(comfy_dir)).resolve()
-        extra = Path(comfy_cfg.get("extra_model_paths") or str(extra)).resolve()
-
-        if bool(server_cfg.get("start")):
-            host = str(server_cfg.get("host") or "127.0.0.1")
-            port = int(server_cfg.get("port") or 8188)
-            print(f"Starting ComfyUI server on {host}:{port} ...")
-            proc = start_comfyui_server(
-                comfy_dir=comfy_dir,
-                host=host,
-                port=port,
-                extra_model_paths_yaml=extra,
-            )
-            try:
-                poll_server_ready(
-                    server, timeout_s=int(server_cfg.get("ready_timeout_s") or 30)
-                )
-            except Exception:
-                proc.terminate()
-                raise
-        else:
-            poll_server_ready(server, timeout_s=args.ready_timeout_s)
-
-        checkpoint_raw = cfg.get("checkpoint")
-        checkpoint_cfg = checkpoint_raw if isinstance(checkpoint_raw, dict) else {}
-        ckpt_name_cfg = checkpoint_cfg.get("name")
-
-        checkpoint_dirs: List[Path] = [_default_checkpoints_dir(comfy_dir)]
-        extra_dirs = (
-            checkpoint_cfg.get("search_dirs")
-            if isinstance(checkpoint_cfg, dict)
-            else None
+        cfg = _load_job(Path(args.job))
+        out_dir, out_ext, overwrite = _job_output(
+            cfg, default_dir=args.out, defaults=defaults
         )
-        if isinstance(extra_dirs, list):
-            checkpoint_dirs += [Path(str(p)).expanduser() for p in extra_dirs]
-
-        ckpt_name, ckpt_dir = resolve_checkpoint_name(
-            args.ckpt or (str(ckpt_name_cfg) if ckpt_name_cfg else None),
-            checkpoint_dirs,
-        )
-        print(f"Checkpoint: {ckpt_name} (from {ckpt_dir})")
-
-        gen_raw = cfg.get("generate")
-        gen = gen_raw if isinstance(gen_raw, dict) else {}
-        width = int(gen.get("width") or args.width)
-        height = int(gen.get("height") or args.height)
-        steps = int(gen.get("steps") or args.steps)
-        cfg_scale = float(gen.get("cfg") or args.cfg)
-        sampler = str(gen.get("sampler") or args.sampler)
-        scheduler = str(gen.get("scheduler") or args.scheduler)
-        negative = str(gen.get("negative") or args.negative)
-        timeout_s = int(gen.get("timeout_s") or args.timeout)
-
-        seed_raw = gen.get("seed")
-        seed_obj = seed_raw if isinstance(seed_raw, dict) else {}
-        seed_mode = str(seed_obj.get("mode") or "random")
-        base_seed = seed_obj.get("value")
-        if base_seed is not None:
-            base_seed = int(base_seed)
-            if seed_mode == "random":
-                seed_mode = "fixed"
-
-        out_raw = cfg.get("output")
-        out_cfg = out_raw if isinstance(out_raw, dict) else {}
-        out_dir = Path(out_cfg.get("dir") or str(args.out)).resolve()
-        out_ext = str(out_cfg.get("ext") or "png").lstrip(".")
-        overwrite = bool(out_cfg.get("overwrite") or False)
-
-        items = _job_items_from_cfg(cfg)
+        items = job_items_from_cfg(cfg)
     else:
         # CLI ad-hoc mode (single image).
         if not args.prompt:
             raise SystemExit("generate requires either --job <file> or --prompt <text>")
-        poll_server_ready(server, timeout_s=args.ready_timeout_s)
-
-        checkpoints_dir = _default_checkpoints_dir(comfy_dir)
-        ckpt_name, ckpt_dir = resolve_checkpoint_name(args.ckpt, [checkpoints_dir])
-        print(f"Checkpoint: {ckpt_name} (from {ckpt_dir})")
-
-        width = args.width
-        height = args.height
-        steps = args.steps
-        cfg_scale = args.cfg
-        sampler = args.sampler
-        scheduler = args.scheduler
-        negative = args.negative
-        timeout_s = args.timeout
-        overwrite = args.overwrite
+        cfg = {}
+        overwrite = args.overwrite or _refreshes(cfg, defaults)
         out_dir = Path(args.out).resolve()
         out_ext = "png"
-        seed_mode = "random" if args.seed == 0 else "fixed"
-        base_seed = None if args.seed == 0 else int(args.seed)
 
         name = args.name or "image"
         items = [(name, args.prompt)]
 
-    out_dir.mkdir(parents=True, exist_ok=True)
-
-    client_id = f"dragonbane-unbound-{os.getpid()}"
-    job_prefix = "dragonbane_unbound/generated"
+    timings = open_timings(args.timings_db, disabled=args.no_timings)
+    if args.dry_run:
+        key = comfyui_timing_key(cfg, ckpt=args.ckpt, defaults=defaults)
+        print(f"Checkpoint: {key['model'] or '(auto)'}")
+        template = workflow_template_from_cfg(cfg)
+        if template is not None:
+            print(f"Workflow: {template.name} (output node {template.output_node})")
+        gen_raw = cfg.get("generate")
+        slots = gen_raw.get("concurrency") if isinstance(gen_raw, dict) else None
+        print_job_plan(
+            items,
+            [(key, int(slots or 1))],
+            out_dir=out_dir,
+            out_ext=out_ext,
+            overwrite=overwrite,
+            timings=timings,
+        )
+        return 0
 
-    for idx, (name, prompt) in enumerate(items, start=1):
-        slug = slugify(name)
-        out_path = out_dir / f"{slug}.{out_ext}"
-        if out_path.exists() and not overwrite:
-            print(f"[{idx}/{len(items)}] skip (exists): {name} -> {out_path}")
-            continue
+    if args.job:
+        backend = comfyui_backend_from_cfg(
+            cfg,
+            server=server,
+            comfy_dir=comfy_dir,
+            extra_model_paths=extra,
+            ckpt=args.ckpt,
+            ready_timeout_s=args.ready_timeout_s,
+            defaults=defaults,
+        )
+    else:
+        poll_server_ready(server, timeout_s=args.ready_timeout_s)
 
-        seed = choose_seed(mode=seed_mode, base_seed=base_seed, idx=idx - 1)
-        prefix = f"{job_prefix}/{slug}"
+        checkpoints_dir = default_checkpoints_dir(comfy_dir)
+        with span("checkpoint.resolve"):
+            ckpt_name, ckpt_dir = resolve_checkpoint_name(args.ckpt, [checkpoints_dir])
+        print(f"Checkpoint: {ckpt_name} (from {ckpt_dir})")
 
-        workflow = comfy_txt2img_workflow(
+        backend = ComfyUIBackend(
+            server=server,
             ckpt_name=ckpt_name,
-            positive=prompt,
-            negative=negative,
-            seed=seed,
-            steps=steps,
-            cfg=cfg_scale,
-            sampler_name=sampler,
-            scheduler=scheduler,
-            width=width,
-            height=height,
-            filename_prefix=prefix,
+            width=args.width,
+            height=args.height,
+            steps=args.steps,
+            cfg=args.cfg,
+            sampler=args.sampler,
+            scheduler=args.scheduler,
+            negative=args.negative,
+            timeout_s=args.timeout,
+            seed_mode="random" if args.seed == 0 else "fixed",
+            base_seed=None if args.seed == 0 else int(args.seed),
+            denoise=args.denoise,
+            previews=args.previews,
         )
 
-        print(f"[{idx}/{len(items)}] queue: {name} -> {out_path.name} (seed={seed})")
-        try:
-            resp = http_json(
-                f"{server}/prompt",
-                payload={"prompt": workflow, "client_id": client_id},
-                timeout_s=60,
-            )
-        except Exception as e:
-            raise SystemExit(f"Failed queue stage for '{name}': {e}")
+    failures: List[FailedItem] = []
+    progress = open_progress(Path(args.job).name if args.job else "ad-hoc")
+    claims = open_work_queue(
+        args.work_queue,
+        out_dir=out_dir,
+        lease_s=args.lease_s,
+        reset=args.work_queue_reset,
+    )
+    try:
+        outcomes = run_job(
+            items,
+            [backend],
+            out_dir=out_dir,
+            out_ext=out_ext,
+            overwrite=overwrite,
+            timings=timings,
+            retry=retry_policy_from_cfg(cfg, attempts=args.attempts),
+            keep_going=args.keep_going,
+            on_failure=failures.append,
+            metadata=embed_output_metadata(cfg),
+            progress=progress,
+            claims=claims,
+        )
+    finally:
+        backend.close()
+        progress.close()
+        if claims is not None:
+            queued = claims.counts()
+            claims.close()
+        if timings is not None:
+            timings.close()
+
+    if claims is not None:
+        print(
+            "Work queue: "
+            + ", ".join(f"{n} {state}" for state, n in sorted(queued.items()))
+        )
+    print_server_split(outcomes)
+    optimize_job_outputs(cfg, out_dir=out_dir)
+    publish_job_outputs(cfg, out_dir=out_dir, out_ext=out_ext)
+    print(f"Done. Wrote outputs to: {out_dir}")
+    return 1 if failures else 0
 
-        prompt_id = resp.get("prompt_id")
-        if not prompt_id:
-            raise SystemExit(
-                f"ComfyUI /prompt response missing prompt_id for '{name}': {resp}"
-            )
 
+def cmd_run_batch(args: argparse.Namespace) -> int:
+    comfy_dir = Path(args.comfy_dir).resolve()
+    extra = (
+        Path(args.extra_model_paths).resolve()
+        if args.extra_model_paths
+        else _default_extra_model_paths()
+    )
+    jobs = []
+    for raw in args.jobs:
+        cfg = _load_job(Path(raw))
+        key = comfyui_timing_key(cfg, defaults=GENERATE_DEFAULTS)
+        # Group by the checkpoint each job will actually load, so jobs that
+        # leave it to the env or the only one on disk group with the rest.
         try:
-            history_item = wait_for_history(server, prompt_id, timeout_s=timeout_s)
-        except Exception as e:
-            raise SystemExit(f"Failed wait stage for '{name}': {e}")
+            key["model"], _ = resolve_job_checkpoint(cfg, comfy_dir=comfy_dir)
+        except SystemExit:
+            pass  # reported when the job runs
+        jobs.append(BatchJob(path=Path(raw), cfg=cfg, key=key))
 
-        try:
-            filename, subfolder, img_type = extract_first_image_from_history(
-                history_item
-            )
-            q = urllib.parse.urlencode(
-                {"filename": filename, "subfolder": subfolder, "type": img_type}
+    servers = {comfyui_server_url(j.cfg, args.server) for j in jobs}
+    if len(servers) > 1:
+        raise SystemExit(
+            "run-batch shares one ComfyUI server, but the jobs name several: "
+            + ", ".join(sorted(servers))
+        )
+
+    # Grouping by checkpoint means each model is loaded once per batch rather
+    # than once per job that switches to it.
+    ordered = order_batch(jobs)
+    print(
+        f"Batch: {len(jobs)} job(s), checkpoint loads: {checkpoint_loads(ordered)} "
+        f"(in the given order: {checkpoint_loads(jobs)})"
+    )
+    for n, job in enumerate(ordered, start=1):
+        key = job.key
+        print(
+            f"  {n}. {job.path.name}: {key['model'] or '(auto)'} "
+            f"{key['width']}x{key['height']}"
+        )
+
+    timings = open_timings(args.timings_db, disabled=args.no_timings)
+    if args.dry_run:
+        for job in ordered:
+            out_dir, out_ext, overwrite = _job_output(job.cfg, default_dir=args.out)
+            gen_raw = job.cfg.get("generate")
+            slots = gen_raw.get("concurrency") if isinstance(gen_raw, dict) else None
+            print(f"\n{job.path.name}:")
+            print_job_plan(
+                job_items_from_cfg(job.cfg),
+                [(job.key, int(slots or 1))],
+                out_dir=out_dir,
+                out_ext=out_ext,
+                overwrite=overwrite,
+                timings=timings,
             )
-            img_url = f"{server}/view?{q}"
-            img_bytes = http_get_bytes(img_url, timeout_s=300)
-            out_path.write_bytes(img_bytes)
-        except Exception as e:
-            raise SystemExit(f"Failed download stage for '{name}': {e}")
+        return 0
 
-    print(f"Done. Wrote outputs to: {out_dir}")
-    return 0
+    starter = next((j for j in ordered if _starts_server(j.cfg)), ordered[0])
+    server = connect_comfyui_server(
+        starter.cfg,
+        server=args.server,
+        comfy_dir=comfy_dir,
+        extra_model_paths=extra,
+        ready_timeout_s=args.ready_timeout_s,
+        previews=any(_wants_previews(j.cfg) for j in ordered),
+    )
+
+    results: List[Tuple[str, str]] = []
+    progress = open_progress("")
+    try:
+        for n, job in enumerate(ordered, start=1):
+            print(f"\n== Job {n}/{len(ordered)}: {job.path} ==")
+            progress.job = f"{job.path.name} ({n}/{len(ordered)})"
+            out_dir, out_ext, overwrite = _job_output(job.cfg, default_dir=args.out)
+            failures: List[FailedItem] = []
+            try:
+                with span("batch.job", job=job.path.name):
+                    backend = comfyui_backend_from_cfg(
+                        job.cfg,
+                        server=server,
+                        comfy_dir=comfy_dir,
+                        extra_model_paths=extra,
+                        connect=False,
+                    )
+                    try:
+                        outcomes = run_job(
+                            job_items_from_cfg(job.cfg),
+                            [backend],
+                            out_dir=out_dir,
+                            out_ext=out_ext,
+                            overwrite=overwrite,
+                            timings=timings,
+                            retry=retry_policy_from_cfg(
+                                job.cfg, attempts=args.attempts
+                            ),
+                            keep_going=args.keep_going,
+                            on_failure=failures.append,
+                            metadata=embed_output_metadata(job.cfg),
+                            progress=progress,
+                        )
+                    finally:
+                        backend.close()
+                    print_server_split(outcomes)
+                    optimize_job_outputs(job.cfg, out_dir=out_dir)
+                    publish_job_outputs(job.cfg, out_dir=out_dir, out_ext=out_ext)
+            except SystemExit as e:
+                # A job that stops on a failed item doesn't stop the batch:
+                # the remaining jobs are independent.
+                results.append((job.path.name, f"STOPPED: {e}"))
+                continue
+            status = f"{len(outcomes)} generated"
+            if failures:
+                status += f", {len(failures)} FAILED"
+            results.append((job.path.name, f"{status} -> {out_dir}"))
+    finally:
+        close_watch(server)
+        progress.close()
+        if timings is not None:
+            timings.close()
+
+    print("\nBatch results:")
+    for name, status in results:
+        print(f"  {name}: {status}")
+    failed = [s for _, s in results if "FAILED" in s or s.startswith("STOPPED")]
+    return 1 if failed else 0
+
+
+def _starts_server(cfg: Dict[str, Any]) -> bool:
+    server_raw = cfg.get("server")
+    return isinstance(server_raw, dict) and bool(server_raw.get("start"))
 
 
 def main(argv: List[str]) -> int:
     ap = argparse.ArgumentParser(description="Dragonbane Unbound ComfyUI helper")
     sub = ap.add_subparsers(dest="cmd", required=True)
+    trace = argparse.ArgumentParser(add_help=False)
+    trace.add_argument(
+        "--trace",
+        default=None,
+        metavar="FILE",
+        help="Write timing spans as Chrome trace JSON (open in ui.perfetto.dev)",
+    )
 
-    p_setup = sub.add_parser("setup", help="Clone ComfyUI and install deps")
+    p_setup = sub.add_parser(
+        "setup", parents=[trace], help="Clone ComfyUI and install deps"
+    )
     p_setup.add_argument(
         "--python",
         default=os.environ.get("PYTHON_BIN") or "python3.11",
@@ -459,9 +584,17 @@ def main(argv: List[str]) -> int:
         default=None,
         help="Path to extra model paths yaml (default: scripts/comfyui/extra_model_paths.yaml if present)",
     )
+    p_run.add_argument(
+        "--preview-method",
+        choices=["auto", "latent2rgb", "taesd"],
+        default=None,
+        help="Render sampler previews (needed for generate --previews)",
+    )
     p_run.set_defaults(func=cmd_run_server)
 
-    p_doc = sub.add_parser("doctor", help="Verify local setup and server")
+    p_doc = sub.add_parser(
+        "doctor", parents=[trace], help="Verify local setup and server"
+    )
     p_doc.add_argument("--comfy-dir", default=str(_default_comfy_dir()))
     p_doc.add_argument("--server", default="http://127.0.0.1:8188")
     p_doc.add_argument(
@@ -472,7 +605,9 @@ def main(argv: List[str]) -> int:
     p_doc.add_argument("--ready-timeout-s", type=int, default=3)
     p_doc.set_defaults(func=cmd_doctor)
 
-    p_gen = sub.add_parser("generate", help="Generate images via ComfyUI API")
+    p_gen = sub.add_parser(
+        "generate", parents=[trace], help="Generate images via ComfyUI API"
+    )
     p_gen.add_argument("--comfy-dir", default=str(_default_comfy_dir()))
     p_gen.add_argument("--server", default="http://127.0.0.1:8188")
     p_gen.add_argument("--ready-timeout-s", type=int, default=30)
@@ -489,30 +624,121 @@ def main(argv: List[str]) -> int:
     )
     p_gen.add_argument("--out", default=str(ROOT_DIR / "assets/portraits/kins"))
     p_gen.add_argument("--overwrite", action="store_true")
-    p_gen.add_argument("--width", type=int, default=1024)
-    p_gen.add_argument("--height", type=int, default=1024)
-    p_gen.add_argument("--steps", type=int, default=28)
-    p_gen.add_argument("--cfg", type=float, default=6.0)
-    p_gen.add_argument("--sampler", default="dpmpp_2m")
-    p_gen.add_argument("--scheduler", default="karras")
-    p_gen.add_argument(
-        "--negative",
-        default=(
-            "low quality, worst quality, blurry, noisy, jpeg artifacts, oversaturated, "
-            "text, watermark, logo, signature, frame, border, extra limbs, deformed"
-        ),
-    )
+    p_gen.add_argument("--width", type=int, default=GENERATE_DEFAULTS["width"])
+    p_gen.add_argument("--height", type=int, default=GENERATE_DEFAULTS["height"])
+    p_gen.add_argument("--steps", type=int, default=GENERATE_DEFAULTS["steps"])
+    p_gen.add_argument("--cfg", type=float, default=GENERATE_DEFAULTS["cfg"])
+    p_gen.add_argument("--sampler", default=GENERATE_DEFAULTS["sampler"])
+    p_gen.add_argument("--scheduler", default=GENERATE_DEFAULTS["scheduler"])
+    p_gen.add_argument("--negative", default=DEFAULT_NEGATIVE)
     p_gen.add_argument(
         "--seed",
         type=int,
         default=0,
         help="0 = random per image; otherwise fixed base seed",
     )
-    p_gen.add_argument("--timeout", type=int, default=1800)
+    p_gen.add_argument("--timeout", type=int, default=GENERATE_DEFAULTS["timeout_s"])
+    p_gen.add_argument(
+        "--denoise",
+        type=float,
+        default=GENERATE_DEFAULTS["denoise"],
+        help="Below 1: re-sample existing outputs at this strength (img2img) "
+        "instead of rendering from noise (implies --overwrite)",
+    )
+    p_gen.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the plan and a time estimate from past runs; generate nothing",
+    )
+    p_gen.add_argument(
+        "--timings-db",
+        default=None,
+        help="SQLite file with generation timings (default: tools/imagegen/timings.sqlite)",
+    )
+    p_gen.add_argument(
+        "--no-timings", action="store_true", help="Do not read or record timings"
+    )
+    p_gen.add_argument(
+        "--attempts",
+        type=int,
+        default=None,
+        help="Tries per item before it counts as failed (default: retry.attempts or 3)",
+    )
+    p_gen.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="Don't stop at a failed item; report failures and exit 1 at the end",
+    )
+    p_gen.add_argument(
+        "--previews",
+        action="store_true",
+        help="Write sampler previews of in-flight items as <name>.preview.jpg",
+    )
+    p_gen.add_argument(
+        "--work-queue",
+        nargs="?",
+        const=str(DEFAULT_WORK_QUEUE),
+        default=None,
+        metavar="FILE",
+        help="Share the job with other runners through this SQLite file "
+        "(default: tools/imagegen/work_queue.sqlite)",
+    )
+    p_gen.add_argument(
+        "--lease-s",
+        type=float,
+        default=120.0,
+        help="With --work-queue: how long an item stays leased to a runner "
+        "that stops renewing it",
+    )
+    p_gen.add_argument(
+        "--work-queue-reset",
+        action="store_true",
+        help="With --work-queue: forget which items earlier runs finished",
+    )
     p_gen.set_defaults(func=cmd_generate)
 
+    p_batch = sub.add_parser(
+        "run-batch",
+        parents=[trace],
+        help="Run several job configs on one server, grouped by checkpoint",
+    )
+    p_batch.add_argument("jobs", nargs="+", help="Job configs (.json/.yaml)")
+    p_batch.add_argument("--comfy-dir", default=str(_default_comfy_dir()))
+    p_batch.add_argument("--server", default="http://127.0.0.1:8188")
+    p_batch.add_argument("--ready-timeout-s", type=int, default=30)
+    p_batch.add_argument(
+        "--extra-model-paths",
+        default=None,
+        help="Path to extra model paths yaml (default: scripts/comfyui/extra_model_paths.yaml if present)",
+    )
+    p_batch.add_argument(
+        "--out",
+        default=str(ROOT_DIR / "assets/portraits/kins"),
+        help="Output dir for jobs without output.dir",
+    )
+    p_batch.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the merged plan and time estimates; generate nothing",
+    )
+    p_batch.add_argument("--timings-db", default=None)
+    p_batch.add_argument("--no-timings", action="store_true")
+    p_batch.add_argument(
+        "--attempts",
+        type=int,
+        default=None,
+        help="Tries per item before it counts as failed (default: retry.attempts or 3)",
+    )
+    p_batch.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="Don't stop a job at a failed item; report failures at the end",
+    )
+    p_batch.set_defaults(func=cmd_run_batch)
+
     args = ap.parse_args(argv)
-    return int(args.func(args))
+    with session(getattr(args, "trace", None), f"comfyui {args.cmd}"):
+        return int(args.func(args))
 
 
 if __name__ == "__main__":
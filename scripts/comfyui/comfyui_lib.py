@@ -2,71 +2,90 @@
 
 from __future__ import annotations
 
+import functools
 import json
+import math
 import os
 import random
-import re
 import subprocess
+import sys
 import time
+import urllib.error
 import urllib.parse
 import urllib.request
+import uuid
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Sequence, Tuple
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "imagegen"))
 
-ROOT_DIR = Path(__file__).resolve().parents[2]
+# Shared job engine; names are re-exported for comfyui.py and the tests.
+from imagegen_lib import (  # noqa: E402, F401
+    DEFAULT_WORK_QUEUE,
+    OUTPUT_KEYS,
+    PUBLISH_KEYS,
+    RETRY_KEYS,
+    ROOT_DIR,
+    FailedItem,
+    GenerationBackend,
+    GenerationResult,
+    JobItem,
+    JobOutcome,
+    PromptItem,
+    StageError,
+    concurrency_limits,
+    embed_output_metadata,
+    job_items_from_cfg,
+    load_data_file,
+    open_progress,
+    open_timings,
+    open_work_queue,
+    print_job_plan,
+    optimize_job_outputs,
+    publish_job_outputs,
+    read_kin_prompts_md,
+    retry_policy_from_cfg,
+    run_job,
+    slugify,
+)
+from imagegen_lib import validate_job_config as _validate_job_config  # noqa: E402
+from tracing import session, span  # noqa: E402, F401
+from preview_stream import PreviewStream  # noqa: E402
+from server_log import ServerLog, log_for, register_log  # noqa: E402
+from server_watch import (  # noqa: E402
+    ServerDown,
+    ServerWatch,
+    close_watch,
+    register_watch,
+    watch_for,
+)
+from workflow_template import (  # noqa: E402, F401
+    WorkflowTemplate,
+    workflow_template_from_cfg,
+)
 
+DEFAULT_NEGATIVE = (
+    "low quality, worst quality, blurry, noisy, jpeg artifacts, oversaturated, "
+    "text, watermark, logo, signature, frame, border, extra limbs, deformed"
+)
 
-def slugify(name: str) -> str:
-    s = name.strip().lower()
-    s = re.sub(r"\s+", "_", s)
-    s = re.sub(r"[^a-z0-9_]+", "", s)
-    s = re.sub(r"_+", "_", s).strip("_")
-    return s or "image"
+# Fallbacks for generate.* when neither the job config nor the CLI sets them.
+GENERATE_DEFAULTS: Dict[str, Any] = {
+    "width": 1024,
+    "height": 1024,
+    "steps": 28,
+    "cfg": 6.0,
+    "sampler": "dpmpp_2m",
+    "scheduler": "karras",
+    "negative": DEFAULT_NEGATIVE,
+    "timeout_s": 1800,
+    "denoise": 1.0,
+    "previews": False,
+}
 
 
-@dataclass(frozen=True)
-class PromptItem:
-    name: str
-    prompt: str
-
-
-def read_kin_prompts_md(md_path: Path) -> List[PromptItem]:
-    text = md_path.read_text(encoding="utf-8")
-    lines = text.splitlines()
-
-    prompts: List[PromptItem] = []
-    current_name: str | None = None
-    in_code = False
-    buf: List[str] = []
-
-    def flush() -> None:
-        nonlocal current_name, buf
-        if current_name and buf:
-            prompt_text = "\n".join(buf).strip()
-            if prompt_text:
-                prompts.append(PromptItem(name=current_name, prompt=prompt_text))
-        buf = []
-
-    for line in lines:
-        m = re.match(r"^##\s+(.+?)\s*$", line)
-        if m and not in_code:
-            flush()
-            current_name = m.group(1).strip()
-            continue
-
-        if line.strip().startswith("```"):
-            in_code = not in_code
-            if in_code:
-                buf = []
-            continue
-
-        if in_code:
-            buf.append(line)
-
-    flush()
-    return prompts
+SERVER_LOG_DIR = ROOT_DIR / "tools/imagegen/logs"
 
 
 def http_json(url: str, payload: dict | None = None, timeout_s: int = 60) -> dict:
@@ -83,12 +102,54 @@ def http_json(url: str, payload: dict | None = None, timeout_s: int = 60) -> dic
         return json.loads(body)
 
 
+def http_post(url: str, payload: dict, timeout_s: int = 30) -> None:
+    # For endpoints that answer with an empty body (/interrupt, /queue).
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=timeout_s) as resp:
+        resp.read()
+
+
 def http_get_bytes(url: str, timeout_s: int = 120) -> bytes:
     req = urllib.request.Request(url, method="GET")
     with urllib.request.urlopen(req, timeout=timeout_s) as resp:
         return resp.read()
 
 
+def upload_image(
+    server: str, data: bytes, *, name: str, subfolder: str, timeout_s: int = 120
+) -> str:
+    """Upload ``data`` to ComfyUI's input dir; returns the LoadImage name."""
+    boundary = f"----dbu{uuid.uuid4().hex}"
+    fields = [
+        ("overwrite", None, b"true"),
+        ("type", None, b"input"),
+        ("subfolder", None, subfolder.encode("utf-8")),
+        ("image", name, data),
+    ]
+    body = b""
+    for field, filename, value in fields:
+        head = f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"'
+        if filename is not None:
+            head += f'; filename="{filename}"\r\nContent-Type: application/octet-stream'
+        body += f"{head}\r\n\r\n".encode("utf-8") + value + b"\r\n"
+    body += f"--{boundary}--\r\n".encode("utf-8")
+    req = urllib.request.Request(
+        f"{server}/upload/image",
+        data=body,
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=timeout_s) as resp:
+        info = json.loads(resp.read().decode("utf-8"))
+    sub = info.get("subfolder") or ""
+    return f"{sub}/{info['name']}" if sub else str(info["name"])
+
+
 def comfy_txt2img_workflow(
     *,
     ckpt_name: str,
@@ -148,9 +209,142 @@ def comfy_txt2img_workflow(
     }
 
 
-def wait_for_history(server: str, prompt_id: str, timeout_s: int = 1800) -> dict:
+def refresh_steps(steps: int, denoise: float) -> int:
+    """Steps an img2img refresh actually samples out of ``steps``.
+
+    Only the last ``denoise`` of the schedule is sampled, so GPU time shrinks
+    with it.
+    """
+    return max(1, math.ceil(steps * denoise))
+
+
+def comfy_img2img_workflow(
+    *,
+    ckpt_name: str,
+    init_image: str,
+    denoise: float,
+    positive: str,
+    negative: str,
+    seed: int,
+    steps: int,
+    cfg: float,
+    sampler_name: str,
+    scheduler: str,
+    width: int,
+    height: int,
+    filename_prefix: str,
+) -> dict:
+    # The txt2img graph with the empty latent swapped for an uploaded image
+    # (scaled to the configured size, then VAE-encoded). KSampler skips the
+    # first (1 - denoise) of the noise schedule, so ``steps`` here are the
+    # steps actually run.
+    workflow = comfy_txt2img_workflow(
+        ckpt_name=ckpt_name,
+        positive=positive,
+        negative=negative,
+        seed=seed,
+        steps=steps,
+        cfg=cfg,
+        sampler_name=sampler_name,
+        scheduler=scheduler,
+        width=width,
+        height=height,
+        filename_prefix=filename_prefix,
+    )
+    workflow["4"] = {
+        "class_type": "LoadImage",
+        "inputs": {"image": init_image},
+    }
+    workflow["8"] = {
+        "class_type": "ImageScale",
+        "inputs": {
+            "image": ["4", 0],
+            "upscale_method": "lanczos",
+            "width": width,
+            "height": height,
+            "crop": "disabled",
+        },
+    }
+    workflow["9"] = {
+        "class_type": "VAEEncode",
+        "inputs": {"pixels": ["8", 0], "vae": ["1", 2]},
+    }
+    sampler = workflow["5"]["inputs"]
+    sampler["latent_image"] = ["9", 0]
+    sampler["denoise"] = denoise
+    return workflow
+
+
+# Where the built-in graphs take each parameter.
+TXT2IMG_BINDINGS = {
+    "checkpoint": "1.ckpt_name",
+    "prompt": "2.text",
+    "negative": "3.text",
+    "width": "4.width",
+    "height": "4.height",
+    "seed": "5.seed",
+    "steps": "5.steps",
+    "cfg": "5.cfg",
+    "sampler": "5.sampler_name",
+    "scheduler": "5.scheduler",
+    "filename_prefix": "7.filename_prefix",
+}
+IMG2IMG_BINDINGS = {
+    **TXT2IMG_BINDINGS,
+    "width": "8.width",
+    "height": "8.height",
+    "init_image": "4.image",
+    "denoise": "5.denoise",
+}
+
+
+def builtin_templates() -> Tuple[WorkflowTemplate, WorkflowTemplate]:
+    """The built-in txt2img and img2img graphs, compiled like a job's own."""
+    blank: Dict[str, Any] = dict(
+        ckpt_name="",
+        positive="",
+        negative="",
+        seed=0,
+        steps=1,
+        cfg=1.0,
+        sampler_name="euler",
+        scheduler="normal",
+        width=64,
+        height=64,
+        filename_prefix="",
+    )
+    return (
+        WorkflowTemplate(comfy_txt2img_workflow(**blank), TXT2IMG_BINDINGS),
+        WorkflowTemplate(
+            comfy_img2img_workflow(init_image="", denoise=1.0, **blank),
+            IMG2IMG_BINDINGS,
+        ),
+    )
+
+
+class ItemRejected(RuntimeError):
+    """A reviewer rejected the item while it was rendering."""
+
+
+def reject_marker(out_path: Path) -> Path:
+    """File a reviewer creates next to an output to cancel it mid-render."""
+    return out_path.with_suffix(".reject")
+
+
+def wait_for_history(
+    server: str,
+    prompt_id: str,
+    timeout_s: int = 1800,
+    *,
+    abort: Callable[[], bool] | None = None,
+    rejected: Callable[[], bool] | None = None,
+) -> dict:
     deadline = time.time() + timeout_s
     while time.time() < deadline:
+        if abort is not None and abort():
+            raise ServerDown(f"Server went down while running prompt_id={prompt_id}")
+        if rejected is not None and rejected():
+            raise ItemRejected(f"Rejected while running prompt_id={prompt_id}")
         hist = http_json(f"{server}/history/{prompt_id}")
         if prompt_id in hist:
             return hist[prompt_id]
@@ -158,16 +352,40 @@ def wait_for_history(server: str, prompt_id: str, timeout_s: int = 1800) -> dict
     raise TimeoutError(f"Timed out waiting for prompt_id={prompt_id}")
 
 
+def cancel_prompt(server: str, prompt_id: str) -> bool:
+    """Drop ``prompt_id`` from the queue, or interrupt it if it's running.
+
+    Returns whether it was running (an interrupted prompt still counts as
+    executed in the server's log; a dropped one never runs).
+    """
+    queue = http_json(f"{server}/queue", timeout_s=10)
+    running = {str(entry[1]) for entry in queue.get("queue_running") or []}
+    if prompt_id in running:
+        # Servers that don't know the prompt_id field interrupt whatever runs,
+        # which is this prompt as of the check above.
+        http_post(f"{server}/interrupt", {"prompt_id": prompt_id})
+        return True
+    http_post(f"{server}/queue", {"delete": [prompt_id]})
+    return False
+
+
 def extract_first_image_from_history(
-    history_item: dict, save_node_id: str = "7"
+    history_item: dict, save_node_id: str | None = None
 ) -> Tuple[str, str, str]:
+    """First image of node ``save_node_id``, or of any node that saved one."""
     outputs = history_item.get("outputs", {})
-    node_out = outputs.get(save_node_id, {})
-    images = node_out.get("images", [])
+    if save_node_id is None:
+        saved = [
+            out.get("images") or [] for out in outputs.values() if isinstance(out, dict)
+        ]
+        # Previews are "temp" images; prefer what a save node wrote.
+        images = [img for imgs in saved for img in imgs if img.get("type") != "temp"]
+        images = images or [img for imgs in saved for img in imgs]
+    else:
+        images = outputs.get(save_node_id, {}).get("images", [])
     if not images:
-        raise RuntimeError(
-            f"No images found in history outputs for node {save_node_id}"
-        )
+        where = f"node {save_node_id}" if save_node_id is not None else "any node"
+        raise RuntimeError(f"No images found in history outputs for {where}")
     img0 = images[0]
     filename = img0.get("filename")
     subfolder = img0.get("subfolder", "")
@@ -244,23 +462,48 @@ def resolve_checkpoint_name(
 def poll_server_ready(server: str, *, timeout_s: int = 30) -> None:
     deadline = time.time() + timeout_s
     last_err: Exception | None = None
-    while time.time() < deadline:
-        try:
-            http_json(f"{server.rstrip('/')}/system_stats", timeout_s=5)
-            return
-        except Exception as e:
-            last_err = e
-            time.sleep(0.5)
+    with span("server.ready", server=server) as sp:
+        attempts = 0
+        while time.time() < deadline:
+            attempts += 1
+            try:
+                http_json(f"{server.rstrip('/')}/system_stats", timeout_s=5)
+                sp.set(attempts=attempts)
+                return
+            except Exception as e:
+                last_err = e
+                time.sleep(0.5)
+        sp.set(attempts=attempts)
     raise SystemExit(f"ComfyUI not reachable at {server}: {last_err}")
 
 
+def vram_pressure(stats: Mapping[str, Any]) -> float | None:
+    """Fraction of VRAM in use on the fullest device in a /system_stats reply."""
+    devices = stats.get("devices")
+    worst: float | None = None
+    for dev in devices if isinstance(devices, list) else []:
+        if not isinstance(dev, dict):
+            continue
+        total = dev.get("vram_total")
+        free = dev.get("vram_free")
+        if not isinstance(total, (int, float)) or not isinstance(free, (int, float)):
+            continue
+        if total > 0:
+            used = 1.0 - free / total
+            worst = used if worst is None else max(worst, used)
+    return worst
+
+
 def start_comfyui_server(
     *,
     comfy_dir: Path,
     host: str,
     port: int,
     extra_model_paths_yaml: Path | None,
+    log: ServerLog | None = None,
+    preview_method: str | None = None,
 ) -> subprocess.Popen[bytes]:
+    """Spawn ComfyUI; its output goes to the terminal, or to ``log``."""
     venv_dir = comfy_dir / ".venv"
     py = venv_dir / "bin/python"
     if not py.exists():
@@ -281,146 +524,91 @@ def start_comfyui_server(
     ]
     if extra_model_paths_yaml and extra_model_paths_yaml.exists():
         args += ["--extra-model-paths-config", str(extra_model_paths_yaml)]
+    if preview_method:
+        args += ["--preview-method", preview_method]
 
-    # Inherit stdio so the user can see ComfyUI logs.
-    return subprocess.Popen(args)
-
-
-def load_data_file(path: Path) -> Dict[str, Any]:
-    suffix = path.suffix.lower()
-    if suffix == ".json":
-        return json.loads(path.read_text(encoding="utf-8"))
-    if suffix in {".yaml", ".yml"}:
-        try:
-            import yaml  # type: ignore
-        except Exception as e:
-            # Prefer not to require PyYAML in the system python. If available,
-            # parse using the ComfyUI venv python (setup installs PyYAML there).
-            venv_py = ROOT_DIR / "tools/ComfyUI/.venv/bin/python"
-            if not venv_py.exists():
-                venv_py = ROOT_DIR / "tools/ComfyUI/.venv/Scripts/python.exe"
-            if venv_py.exists():
-                code = (
-                    "import sys, json; from pathlib import Path; "
-                    "import yaml; "
-                    "data=yaml.safe_load(Path(sys.argv[1]).read_text(encoding='utf-8')); "
-                    "print(json.dumps(data or {}))"
-                )
-                try:
-                    out = subprocess.check_output(
-                        [str(venv_py), "-c", code, str(path)], text=True
-                    )
-                    data2 = json.loads(out)
-                    if not isinstance(data2, dict):
-                        raise SystemExit(
-                            f"Config must be an object at top-level: {path}"
-                        )
-                    return data2
-                except Exception as e2:
-                    raise SystemExit(
-                        "Failed to parse YAML via ComfyUI venv. Try rerunning setup:\n"
-                        "  python3 scripts/comfyui/comfyui.py setup\n"
-                        f"Error: {e2}"
-                    )
+    if log is None:
+        # Inherit stdio so the user can see ComfyUI logs.
+        with span("server.start", host=host, port=port):
+            return subprocess.Popen(args)
 
-            raise SystemExit(
-                "YAML config requires PyYAML (either in your python or the ComfyUI venv).\n"
-                "Fix (recommended): python3 scripts/comfyui/comfyui.py setup\n"
-                f"Import error: {e}"
+    # Straight to a file rather than a pipe, so the server keeps running (and
+    # logging) after the runner that started it exits.
+    log.path.parent.mkdir(parents=True, exist_ok=True)
+    with log.path.open("ab") as f:
+        offset = f.tell()
+        started = time.strftime("%Y-%m-%d %H:%M:%S")
+        f.write(f"\n=== {started}: {' '.join(args)}\n".encode("utf-8"))
+        f.flush()
+        with span("server.start", host=host, port=port):
+            proc = subprocess.Popen(
+                args,
+                stdout=f,
+                stderr=subprocess.STDOUT,
+                env={**os.environ, "PYTHONUNBUFFERED": "1"},
             )
-
-        data = yaml.safe_load(path.read_text(encoding="utf-8"))
-        if data is None:
-            return {}
-        if not isinstance(data, dict):
-            raise SystemExit(f"Config must be an object at top-level: {path}")
-        return data
-    raise SystemExit(f"Unsupported config type: {path} (use .json/.yaml)")
+    log.follow(offset)
+    return proc
 
 
-def _fail_unknown_keys(where: str, unknown: List[str]) -> None:
-    unknown_sorted = ", ".join(sorted(unknown))
-    raise SystemExit(f"Unknown/disallowed keys at {where}: {unknown_sorted}")
+GENERATE_KEYS = {
+    "width",
+    "height",
+    "steps",
+    "cfg",
+    "sampler",
+    "scheduler",
+    "negative",
+    "seed",
+    "timeout_s",
+    "concurrency",
+    "max_concurrency",
+    "denoise",
+    "previews",
+}
 
 
 def validate_job_config(cfg: Dict[str, Any]) -> None:
-    allowed_top = {
-        "version",
-        "server",
-        "comfyui",
-        "checkpoint",
-        "generate",
-        "source",
-        "items",
-        "output",
-    }
-    unknown = [k for k in cfg.keys() if k not in allowed_top]
-    if unknown:
-        _fail_unknown_keys("root", unknown)
-
-    def validate_obj(obj: Any, allowed: set[str], where: str) -> None:
-        if obj is None:
-            return
-        if not isinstance(obj, dict):
-            raise SystemExit(f"Expected object at {where}")
-        unknown2 = [k for k in obj.keys() if k not in allowed]
-        if unknown2:
-            _fail_unknown_keys(where, unknown2)
-
-    validate_obj(
-        cfg.get("server"),
-        {"url", "start", "host", "port", "ready_timeout_s"},
-        "server",
-    )
-    validate_obj(
-        cfg.get("comfyui"),
-        {"dir", "python", "extra_model_paths"},
-        "comfyui",
-    )
-    validate_obj(
-        cfg.get("checkpoint"),
-        {"name", "search_dirs"},
-        "checkpoint",
-    )
-    validate_obj(
-        cfg.get("generate"),
-        {
-            "width",
-            "height",
-            "steps",
-            "cfg",
-            "sampler",
-            "scheduler",
-            "negative",
-            "seed",
-            "timeout_s",
+    _validate_job_config(
+        cfg,
+        top_keys={
+            "version",
+            "server",
+            "comfyui",
+            "checkpoint",
+            "generate",
+            "source",
+            "items",
+            "matrix",
+            "output",
+            "publish",
+            "retry",
+            "workflow",
+        },
+        sections={
+            "server": {"url", "start", "host", "port", "ready_timeout_s"},
+            "comfyui": {"dir", "python", "extra_model_paths"},
+            "checkpoint": {"name", "search_dirs"},
+            "generate": GENERATE_KEYS,
+            "generate.seed": {"mode", "value"},
+            "source": {"type", "path"},
+            "output": OUTPUT_KEYS,
+            "publish": PUBLISH_KEYS,
+            "retry": RETRY_KEYS,
+            "workflow": {"path", "bindings", "output_node"},
         },
-        "generate",
     )
     gen = cfg.get("generate")
-    if isinstance(gen, dict):
-        validate_obj(gen.get("seed"), {"mode", "value"}, "generate.seed")
-    validate_obj(
-        cfg.get("source"),
-        {"type", "path"},
-        "source",
-    )
-    validate_obj(
-        cfg.get("output"),
-        {"dir", "overwrite", "ext"},
-        "output",
-    )
-
-    items = cfg.get("items")
-    if items is not None:
-        if not isinstance(items, list):
-            raise SystemExit("items must be an array")
-        for i, it in enumerate(items):
-            if not isinstance(it, dict):
-                raise SystemExit(f"items[{i}] must be an object")
-            unknown3 = [k for k in it.keys() if k not in {"name", "prompt"}]
-            if unknown3:
-                _fail_unknown_keys(f"items[{i}]", unknown3)
+    if isinstance(gen, dict) and "denoise" in gen:
+        denoise = gen["denoise"]
+        if (
+            isinstance(denoise, bool)
+            or not isinstance(denoise, (int, float))
+            or not 0.0 < denoise <= 1.0
+        ):
+            raise SystemExit(
+                f"generate.denoise must be a number in (0, 1], got {denoise!r}"
+            )
 
 
 def choose_seed(*, mode: str, base_seed: int | None, idx: int) -> int:
@@ -430,3 +618,612 @@ def choose_seed(*, mode: str, base_seed: int | None, idx: int) -> int:
     if base_seed is None:
         raise SystemExit("seed.mode=fixed requires seed.value")
     return base_seed + idx
+
+
+def default_checkpoints_dir(comfy_dir: Path) -> Path:
+    return comfy_dir / "models/checkpoints"
+
+
+# Times one item is queued again after the server went down under it.
+MAX_RESUBMITS = 3
+
+
+class ComfyUIBackend(GenerationBackend):
+    name = "comfyui"
+    # Whether ``close`` stops the server's watch; false when it is shared
+    # (a batch watches its server across all of its jobs).
+    owns_watch = False
+
+    def __init__(
+        self,
+        *,
+        server: str,
+        ckpt_name: str,
+        width: int,
+        height: int,
+        steps: int,
+        cfg: float,
+        sampler: str,
+        scheduler: str,
+        negative: str,
+        timeout_s: int,
+        seed_mode: str,
+        base_seed: int | None,
+        slots: int = 1,
+        max_slots: int | None = None,
+        denoise: float = 1.0,
+        template: WorkflowTemplate | None = None,
+        previews: bool = False,
+        rejected: Callable[[JobItem], bool] | None = None,
+    ) -> None:
+        self.server = server
+        self.ckpt_name = ckpt_name
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.cfg = cfg
+        self.sampler = sampler
+        self.scheduler = scheduler
+        self.negative = negative
+        self.timeout_s = timeout_s
+        self.seed_mode = seed_mode
+        self.base_seed = base_seed
+        self.slots = slots
+        self.max_slots = max_slots
+        # Below 1, items whose output already exists are re-sampled from it
+        # (img2img) at this strength instead of rendered from noise.
+        if not 0.0 < denoise <= 1.0:
+            raise SystemExit(f"denoise must be in (0, 1], got {denoise}")
+        self.denoise = denoise
+        txt2img, img2img = builtin_templates()
+        self.workflow_name = template.name if template is not None else None
+        if template is None:
+            self.template, self.refresh_template = txt2img, img2img
+        elif template.binds("init_image"):
+            # An img2img workflow: every item starts from its existing output.
+            if denoise >= 1.0:
+                raise SystemExit(
+                    f"workflow {template.name} binds init_image; "
+                    "set generate.denoise below 1"
+                )
+            self.template = self.refresh_template = template
+        else:
+            if denoise < 1.0:
+                raise SystemExit(
+                    f"denoise below 1 needs a workflow that binds init_image; "
+                    f"{template.name} doesn't"
+                )
+            self.template, self.refresh_template = template, None
+        # Previews go to the websocket of the client that queued the prompt,
+        # so each backend needs an id of its own.
+        self.client_id = f"dragonbane-unbound-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.previews: PreviewStream | None = None
+        if previews:
+            self.previews = PreviewStream(server, self.client_id)
+            self.previews.start()
+        # Early-cancel hook, polled while an item renders; by default a
+        # reviewer rejects an item by creating its reject_marker.
+        self.rejected = rejected or (lambda item: reject_marker(item.out_path).exists())
+        self.job_prefix = "dragonbane_unbound/generated"
+
+    def timing_key(self, *, refresh: bool | None = None) -> Dict[str, Any]:
+        # A job with denoise below 1 is planned as refreshes; items without an
+        # output yet are recorded as full renders (see result_timing_key).
+        if refresh is None:
+            refresh = self.denoise < 1.0
+        key: Dict[str, Any] = {
+            "backend": self.name,
+            "model": self.ckpt_name,
+            "width": self.width,
+            "height": self.height,
+            "steps": self.steps,
+            "sampler": self.sampler,
+        }
+        if refresh:
+            key.update(steps=refresh_steps(self.steps, self.denoise), mode="img2img")
+        return key
+
+    def result_timing_key(self, meta: Mapping[str, Any]) -> Dict[str, Any]:
+        return self.timing_key(refresh=meta.get("denoise") is not None)
+
+    def render_settings(self) -> Dict[str, Any]:
+        return {
+            **self.timing_key(refresh=False),
+            "cfg": self.cfg,
+            "scheduler": self.scheduler,
+            "negative": self.negative,
+            "seed_mode": self.seed_mode,
+            "base_seed": self.base_seed,
+            "denoise": self.denoise,
+            "workflow": self.template.digest,
+        }
+
+    def pressure(self) -> float | None:
+        try:
+            stats = http_json(f"{self.server}/system_stats", timeout_s=5)
+        except Exception:
+            return None
+        return vram_pressure(stats)
+
+    def location(self) -> str:
+        return self.server
+
+    def close(self) -> None:
+        if self.previews is not None:
+            self.previews.close()
+        if self.owns_watch:
+            close_watch(self.server)
+
+    def _back_after_outage(
+        self, watch: ServerWatch | None, epoch: int, item: JobItem, resubmits: int
+    ) -> bool:
+        """After a failed request: True once a server that went down under
+        ``item`` is back, so the item should be queued again.
+
+        Resubmits don't use up the item's retry attempts; a server that
+        stays down fails it for good.
+        """
+        if watch is None or resubmits >= MAX_RESUBMITS or not watch.went_down(epoch):
+            return False
+        if not watch.wait_up(self.timeout_s):
+            raise StageError(
+                "wait",
+                f"ComfyUI at {self.server} is down; gave up on '{item.name}'",
+                retryable=False,
+            )
+        print(f"  resubmit: {item.name} (server was down)")
+        return True
+
+    def _rejection(self, item: JobItem) -> StageError:
+        # The marker has been acted on; a later run of the item starts clean.
+        reject_marker(item.out_path).unlink(missing_ok=True)
+        return StageError(
+            "review", f"Rejected by reviewer: '{item.name}'", retryable=False
+        )
+
+    def generate(self, item: JobItem) -> GenerationResult:
+        if item.seed is not None:
+            seed = item.seed
+        else:
+            seed = choose_seed(
+                mode=self.seed_mode, base_seed=self.base_seed, idx=item.idx - 1
+            )
+        negative = item.negative if item.negative is not None else self.negative
+        slug = item.out_name.rsplit(".", 1)[0]
+        params: Dict[str, Any] = dict(
+            checkpoint=self.ckpt_name,
+            prompt=item.prompt,
+            negative=negative,
+            seed=seed,
+            steps=self.steps,
+            cfg=self.cfg,
+            sampler=self.sampler,
+            scheduler=self.scheduler,
+            width=self.width,
+            height=self.height,
+            filename_prefix=f"{self.job_prefix}/{slug}",
+        )
+
+        stages: Dict[str, float] = {}
+        # Rejected before it was even queued (e.g. while bulk items wait).
+        if self.rejected(item):
+            raise self._rejection(item)
+        refresh = self.denoise < 1.0 and item.out_path.is_file()
+        template = self.refresh_template if refresh else self.template
+        if template is self.refresh_template and not refresh:
+            raise StageError(
+                "queue",
+                f"Workflow {self.workflow_name} needs an existing image for "
+                f"'{item.name}' ({item.out_path} not found)",
+                retryable=False,
+            )
+        if refresh:
+            t_up = time.monotonic()
+            try:
+                with span("comfyui.upload"):
+                    init_image = upload_image(
+                        self.server,
+                        item.out_path.read_bytes(),
+                        name=f"{slug}{item.out_path.suffix}",
+                        subfolder=self.job_prefix.split("/")[0],
+                    )
+            except Exception as e:
+                raise StageError("queue", f"Failed upload for '{item.name}': {e}")
+            stages["upload"] = time.monotonic() - t_up
+            params["steps"] = refresh_steps(self.steps, self.denoise)
+            params.update(init_image=init_image, denoise=self.denoise)
+        workflow = template.render(params)
+
+        watch = watch_for(self.server)
+        resubmits = 0
+        while True:
+            epoch = watch.epoch if watch is not None else 0
+            t0 = time.monotonic()
+            try:
+                with span("comfyui.queue"):
+                    resp = http_json(
+                        f"{self.server}/prompt",
+                        payload={"prompt": workflow, "client_id": self.client_id},
+                        timeout_s=60,
+                    )
+            except urllib.error.HTTPError as e:
+                # 4xx: ComfyUI rejected the workflow (unknown checkpoint, bad
+                # node inputs); resubmitting it won't help.
+                raise StageError(
+                    "queue",
+                    f"Failed queue stage for '{item.name}': {e}",
+                    retryable=e.code >= 500,
+                )
+            except Exception as e:
+                if self._back_after_outage(watch, epoch, item, resubmits):
+                    resubmits += 1
+                    continue
+                raise StageError("queue", f"Failed queue stage for '{item.name}': {e}")
+
+            prompt_id = resp.get("prompt_id")
+            number = resp.get("number")
+            if not prompt_id:
+                raise StageError(
+                    "queue",
+                    f"ComfyUI /prompt response missing prompt_id for "
+                    f"'{item.name}': {resp}",
+                    retryable=False,
+                )
+
+            t1 = time.monotonic()
+            stages["queue"] = t1 - t0
+            if self.previews is not None:
+                self.previews.watch(prompt_id, item.out_path)
+            first_preview: float | None = None
+            try:
+                # Waiting in ComfyUI's queue plus rendering.
+                with span("comfyui.wait", prompt_id=prompt_id):
+                    history_item = wait_for_history(
+                        self.server,
+                        prompt_id,
+                        timeout_s=self.timeout_s,
+                        abort=(
+                            functools.partial(watch.down_since, epoch)
+                            if watch is not None
+                            else None
+                        ),
+                        rejected=functools.partial(self.rejected, item),
+                    )
+            except ItemRejected:
+                try:
+                    ran = cancel_prompt(self.server, prompt_id)
+                    log = log_for(self.server)
+                    if not ran and log is not None and isinstance(number, int):
+                        log.drop(number)
+                except Exception as e:
+                    print(f"  could not cancel {item.name} on the server: {e}")
+                raise self._rejection(item)
+            except Exception as e:
+                if self._back_after_outage(watch, epoch, item, resubmits):
+                    resubmits += 1
+                    continue
+                raise StageError("wait", f"Failed wait stage for '{item.name}': {e}")
+            finally:
+                if self.previews is not None:
+                    first_preview = self.previews.forget(prompt_id)
+            break
+        t2 = time.monotonic()
+        stages["wait"] = t2 - t1
+        if first_preview is not None:
+            # Time to first look, from queueing.
+            stages["first_preview"] = first_preview - t0
+        log = log_for(self.server)
+        execution = (
+            log.execution(number)
+            if log is not None and isinstance(number, int)
+            else None
+        )
+        if execution is not None:
+            # What the GPU actually spent; the rest of "wait" is queueing.
+            stages["server_exec"] = execution.exec_s
+            if execution.load_s:
+                stages["model_load"] = execution.load_s
+
+        try:
+            filename, subfolder, img_type = extract_first_image_from_history(
+                history_item, template.output_node
+            )
+            q = urllib.parse.urlencode(
+                {"filename": filename, "subfolder": subfolder, "type": img_type}
+            )
+            with span("comfyui.download") as sp:
+                image = http_get_bytes(f"{self.server}/view?{q}", timeout_s=300)
+                sp.set(bytes=len(image))
+        except Exception as e:
+            raise StageError(
+                "download", f"Failed download stage for '{item.name}': {e}"
+            )
+        stages["download"] = time.monotonic() - t2
+
+        return GenerationResult(
+            image=image,
+            meta={
+                "backend": self.name,
+                "model": self.ckpt_name,
+                "prompt": item.prompt,
+                "negative": negative,
+                "width": self.width,
+                "height": self.height,
+                "steps": params["steps"],
+                "denoise": self.denoise if refresh else None,
+                "workflow": self.workflow_name,
+                "seed": seed,
+                "sampler": self.sampler,
+                "scheduler": self.scheduler,
+                "cfg": self.cfg,
+                "prompt_id": prompt_id,
+                "stages": stages,
+            },
+        )
+
+
+def comfyui_server_url(cfg: Mapping[str, Any], server: str) -> str:
+    server_raw = cfg.get("server")
+    server_cfg = server_raw if isinstance(server_raw, dict) else {}
+    return str(server_cfg.get("url") or server).rstrip("/")
+
+
+def connect_comfyui_server(
+    cfg: Mapping[str, Any],
+    *,
+    server: str,
+    comfy_dir: Path,
+    extra_model_paths: Path,
+    ready_timeout_s: int = 30,
+    previews: bool = False,
+) -> str:
+    """Start the server when ``server.start`` is set and wait for it to answer.
+
+    Returns the server URL the job talks to.
+    """
+    server_raw = cfg.get("server")
+    server_cfg = server_raw if isinstance(server_raw, dict) else {}
+    server = comfyui_server_url(cfg, server)
+
+    comfy_raw = cfg.get("comfyui")
+    comfy_cfg = comfy_raw if isinstance(comfy_raw, dict) else {}
+    comfy_dir = Path(comfy_cfg.get("dir") or str(comfy_dir)).resolve()
+    extra = Path(comfy_cfg.get("extra_model_paths") or str(extra_model_paths)).resolve()
+
+    # Servers render sampler previews only when asked to at startup.
+    preview_method = "auto" if previews else None
+    if bool(server_cfg.get("start")):
+        host = str(server_cfg.get("host") or "127.0.0.1")
+        port = int(server_cfg.get("port") or 8188)
+        log = ServerLog(SERVER_LOG_DIR / f"comfyui-{port}.log")
+        print(f"Starting ComfyUI server on {host}:{port} (log: {log.path}) ...")
+        proc = start_comfyui_server(
+            comfy_dir=comfy_dir,
+            host=host,
+            port=port,
+            extra_model_paths_yaml=extra,
+            log=log,
+            preview_method=preview_method,
+        )
+        try:
+            poll_server_ready(
+                server, timeout_s=int(server_cfg.get("ready_timeout_s") or 30)
+            )
+        except BaseException:
+            proc.terminate()
+            log.close()
+            print("\n".join(["Last ComfyUI output:", *log.tail()]), file=sys.stderr)
+            raise
+        register_log(server, log)
+
+        def restart() -> subprocess.Popen[bytes]:
+            # The new process numbers prompts from 0 again: start a new log.
+            old = log_for(server)
+            if old is not None:
+                old.close()
+            new_log = ServerLog(log.path)
+            proc = start_comfyui_server(
+                comfy_dir=comfy_dir,
+                host=host,
+                port=port,
+                extra_model_paths_yaml=extra,
+                log=new_log,
+                preview_method=preview_method,
+            )
+            register_log(server, new_log)
+            return proc
+
+        watch = ServerWatch(
+            server,
+            proc=proc,
+            restart=restart,
+            ready_timeout_s=int(server_cfg.get("ready_timeout_s") or 30),
+        )
+    else:
+        poll_server_ready(server, timeout_s=ready_timeout_s)
+        watch = ServerWatch(server)
+    # Trips as soon as the server dies, instead of items timing out one by one.
+    watch.start()
+    register_watch(server, watch)
+    return server
+
+
+def resolve_job_checkpoint(
+    cfg: Mapping[str, Any], *, comfy_dir: Path, ckpt: str | None = None
+) -> Tuple[str, Path]:
+    """The checkpoint a job renders with: ``ckpt``, its config, env or the only one."""
+    comfy_raw = cfg.get("comfyui")
+    comfy_cfg = comfy_raw if isinstance(comfy_raw, dict) else {}
+    comfy_dir = Path(comfy_cfg.get("dir") or str(comfy_dir)).resolve()
+
+    checkpoint_raw = cfg.get("checkpoint")
+    checkpoint_cfg = checkpoint_raw if isinstance(checkpoint_raw, dict) else {}
+    ckpt_name_cfg = checkpoint_cfg.get("name")
+
+    checkpoint_dirs: List[Path] = [default_checkpoints_dir(comfy_dir)]
+    extra_dirs = checkpoint_cfg.get("search_dirs")
+    if isinstance(extra_dirs, list):
+        checkpoint_dirs += [Path(str(p)).expanduser() for p in extra_dirs]
+    return resolve_checkpoint_name(
+        ckpt or (str(ckpt_name_cfg) if ckpt_name_cfg else None), checkpoint_dirs
+    )
+
+
+def comfyui_backend_from_cfg(
+    cfg: Dict[str, Any],
+    *,
+    server: str,
+    comfy_dir: Path,
+    extra_model_paths: Path,
+    ckpt: str | None = None,
+    ready_timeout_s: int = 30,
+    defaults: Dict[str, Any] = GENERATE_DEFAULTS,
+    connect: bool = True,
+) -> ComfyUIBackend:
+    """Build a backend from a (validated) job config.
+
+    Starts the server when ``server.start`` is set, waits for it to answer and
+    resolves the checkpoint before any item is queued. With ``connect=False``
+    the server is assumed to be up already (a batch connects once).
+    """
+    # A bad workflow file should fail before a server is started for it.
+    template = workflow_template_from_cfg(cfg)
+    gen_raw = cfg.get("generate")
+    gen = gen_raw if isinstance(gen_raw, dict) else {}
+    previews = bool(gen.get("previews", defaults["previews"]))
+    if connect:
+        server = connect_comfyui_server(
+            cfg,
+            server=server,
+            comfy_dir=comfy_dir,
+            extra_model_paths=extra_model_paths,
+            ready_timeout_s=ready_timeout_s,
+            previews=previews,
+        )
+    else:
+        server = comfyui_server_url(cfg, server)
+
+    with span("checkpoint.resolve"):
+        ckpt_name, ckpt_dir = resolve_job_checkpoint(
+            cfg, comfy_dir=comfy_dir, ckpt=ckpt
+        )
+    print(f"Checkpoint: {ckpt_name} (from {ckpt_dir})")
+
+    seed_raw = gen.get("seed")
+    seed_obj = seed_raw if isinstance(seed_raw, dict) else {}
+    seed_mode = str(seed_obj.get("mode") or "random")
+    base_seed = seed_obj.get("value")
+    if base_seed is not None:
+        base_seed = int(base_seed)
+        if seed_mode == "random":
+            seed_mode = "fixed"
+    # ComfyUI renders one prompt at a time; a second one in flight still
+    # overlaps queueing and downloads with rendering.
+    slots, max_slots = concurrency_limits(gen, default=1)
+    denoise = float(gen.get("denoise", defaults["denoise"]))
+
+    backend = ComfyUIBackend(
+        server=server,
+        ckpt_name=ckpt_name,
+        width=int(gen.get("width") or defaults["width"]),
+        height=int(gen.get("height") or defaults["height"]),
+        steps=int(gen.get("steps") or defaults["steps"]),
+        cfg=float(gen.get("cfg") or defaults["cfg"]),
+        sampler=str(gen.get("sampler") or defaults["sampler"]),
+        scheduler=str(gen.get("scheduler") or defaults["scheduler"]),
+        negative=str(gen.get("negative") or defaults["negative"]),
+        timeout_s=int(gen.get("timeout_s") or defaults["timeout_s"]),
+        seed_mode=seed_mode,
+        base_seed=base_seed,
+        slots=slots,
+        max_slots=max_slots,
+        denoise=denoise,
+        template=template,
+        previews=previews,
+    )
+    backend.owns_watch = connect
+    return backend
+
+
+def comfyui_timing_key(
+    cfg: Dict[str, Any],
+    *,
+    ckpt: str | None = None,
+    defaults: Dict[str, Any] = GENERATE_DEFAULTS,
+    env_var: str = "COMFYUI_CKPT",
+) -> Dict[str, Any]:
+    """Timing key for a job config without contacting the server.
+
+    Mirrors ``ComfyUIBackend.timing_key``; the checkpoint is taken as written
+    (flag, config, then env) rather than resolved on disk.
+    """
+    gen_raw = cfg.get("generate")
+    gen = gen_raw if isinstance(gen_raw, dict) else {}
+    ckpt_raw = cfg.get("checkpoint")
+    ckpt_cfg = ckpt_raw if isinstance(ckpt_raw, dict) else {}
+    model = ckpt or ckpt_cfg.get("name") or os.environ.get(env_var) or ""
+    steps = int(gen.get("steps") or defaults["steps"])
+    denoise = float(gen.get("denoise", defaults["denoise"]))
+    key: Dict[str, Any] = {
+        "backend": ComfyUIBackend.name,
+        "model": Path(str(model)).name,
+        "width": int(gen.get("width") or defaults["width"]),
+        "height": int(gen.get("height") or defaults["height"]),
+        "steps": steps,
+        "sampler": str(gen.get("sampler") or defaults["sampler"]),
+    }
+    if denoise < 1.0:
+        key.update(steps=refresh_steps(steps, denoise), mode="img2img")
+    return key
+
+
+@dataclass
+class BatchJob:
+    """One job config of a ``run-batch``, with its timing key for ordering."""
+
+    path: Path
+    cfg: Dict[str, Any]
+    key: Dict[str, Any]
+
+
+def order_batch(jobs: Sequence[BatchJob]) -> List[BatchJob]:
+    """Jobs grouped by checkpoint, then by resolution.
+
+    Checkpoints keep the order they first appear in, so the first job (whose
+    model may already be loaded) still runs first; jobs that tie keep their
+    given order.
+    """
+    first_seen: Dict[str, int] = {}
+    for job in jobs:
+        first_seen.setdefault(job.key["model"], len(first_seen))
+    return sorted(
+        jobs,
+        key=lambda j: (first_seen[j.key["model"]], j.key["width"], j.key["height"]),
+    )
+
+
+def checkpoint_loads(jobs: Sequence[BatchJob]) -> int:
+    """Model loads when ``jobs`` run in this order on one server."""
+    models = [j.key["model"] for j in jobs]
+    return sum(1 for i, m in enumerate(models) if i == 0 or m != models[i - 1])
+
+
+def print_server_split(outcomes: Sequence[JobOutcome]) -> None:
+    """Split the client-side wait into server execution and overhead.
+
+    Only items rendered on a server this process started (and so has the
+    log of) carry server-side timings.
+    """
+    stages = [o.meta.get("stages") or {} for o in outcomes]
+    timed = [st for st in stages if "server_exec" in st]
+    if not timed:
+        return
+    waited = sum(st.get("wait", 0.0) for st in timed)
+    executed = sum(st["server_exec"] for st in timed)
+    loading = sum(st.get("model_load", 0.0) for st in timed)
+    transfer = sum(st.get("queue", 0.0) + st.get("download", 0.0) for st in timed)
+    print(
+        f"Server time ({len(timed)} item(s)): {executed:.1f}s executing "
+        f"({loading:.1f}s loading models), {max(0.0, waited - executed):.1f}s "
+        f"queued, {transfer:.1f}s submitting/downloading"
+    )
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import ssl
+import struct
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+from typing import BinaryIO, Dict, Tuple
+
+# ComfyUI pushes sampler previews over its /ws websocket to the client that
+# queued the prompt, as binary messages: a 4-byte event type (1 = preview
+# image), a 4-byte format (1 = JPEG, 2 = PNG) and the image. Which prompt a
+# preview belongs to comes from the "executing"/"progress" JSON messages
+# before it. The server only renders previews when started with
+# --preview-method (auto, latent2rgb or taesd).
+
+PREVIEW_IMAGE = 1
+PREVIEW_FORMATS = {1: ".jpg", 2: ".png"}
+
+# A preview file is rewritten at most this often per item.
+PREVIEW_EVERY_S = 1.0
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OP_CONT, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0, 1, 2, 8, 9, 10
+
+
+def preview_path(out_path: Path, ext: str = ".jpg") -> Path:
+    """Where the preview of an item writing ``out_path`` goes."""
+    return out_path.with_suffix(f".preview{ext}")
+
+
+def _read_exact(f: BinaryIO, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) < n:
+        raise ConnectionError("websocket closed")
+    return data
+
+
+def read_frame(f: BinaryIO) -> Tuple[bool, int, bytes]:
+    """One websocket frame: (fin, opcode, payload)."""
+    b0, b1 = _read_exact(f, 2)
+    n = b1 & 0x7F
+    if n == 126:
+        (n,) = struct.unpack(">H", _read_exact(f, 2))
+    elif n == 127:
+        (n,) = struct.unpack(">Q", _read_exact(f, 8))
+    mask = _read_exact(f, 4) if b1 & 0x80 else None
+    payload = _read_exact(f, n)
+    if mask is not None:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return bool(b0 & 0x80), b0 & 0x0F, payload
+
+
+def encode_frame(opcode: int, payload: bytes) -> bytes:
+    # Frames from a client must be masked.
+    mask = os.urandom(4)
+    n = len(payload)
+    if n < 126:
+        head = struct.pack(">BB", 0x80 | opcode, 0x80 | n)
+    elif n < 1 << 16:
+        head = struct.pack(">BBH", 0x80 | opcode, 0x80 | 126, n)
+    else:
+        head = struct.pack(">BBQ", 0x80 | opcode, 0x80 | 127, n)
+    return head + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+class PreviewStream:
+    """Writes sampler previews of watched prompts next to their outputs.
+
+    Listens on the server's websocket as ``client_id`` (the id prompts are
+    queued with) in a daemon thread, reconnecting if the server goes away.
+    """
+
+    def __init__(self, server: str, client_id: str) -> None:
+        self.server = server.rstrip("/")
+        self.client_id = client_id
+        self._watched: Dict[str, Path] = {}
+        self._first: Dict[str, float] = {}
+        self._written: Dict[str, float] = {}
+        self._running: str | None = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sock: socket.socket | None = None
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="comfyui-previews", daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def watch(self, prompt_id: str, out_path: Path) -> None:
+        with self._lock:
+            self._watched[prompt_id] = out_path
+
+    def forget(self, prompt_id: str, *, keep: bool = False) -> float | None:
+        """Stop watching ``prompt_id``; returns when its first preview came.
+
+        The preview file is removed unless ``keep`` is set.
+        """
+        with self._lock:
+            out_path = self._watched.pop(prompt_id, None)
+            self._written.pop(prompt_id, None)
+            first = self._first.pop(prompt_id, None)
+        if out_path is not None and not keep:
+            for ext in PREVIEW_FORMATS.values():
+                preview_path(out_path, ext).unlink(missing_ok=True)
+        return first
+
+    def _connect(self) -> BinaryIO:
+        url = urllib.parse.urlsplit(self.server)
+        secure = url.scheme == "https"
+        host = url.hostname or "127.0.0.1"
+        port = url.port or (443 if secure else 80)
+        sock = socket.create_connection((host, port), timeout=10)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        path = (
+            f"{url.path.rstrip('/')}/ws?clientId={urllib.parse.quote(self.client_id)}"
+        )
+        sock.sendall(
+            (
+                f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+                "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+            ).encode("ascii")
+        )
+        f = sock.makefile("rb")
+        status = f.readline().decode("latin-1")
+        headers: Dict[str, str] = {}
+        while True:
+            line = f.readline().decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(
+            hashlib.sha1((key + WS_GUID).encode("ascii")).digest()
+        ).decode("ascii")
+        if " 101 " not in status or headers.get("sec-websocket-accept") != accept:
+            sock.close()
+            raise ConnectionError(f"websocket upgrade refused: {status.strip()}")
+        sock.settimeout(None)
+        self._sock = sock
+        return f
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                f = self._connect()
+            except OSError:
+                self._stop.wait(2.0)
+                continue
+            try:
+                self._read(f)
+            except (OSError, ValueError):
+                pass
+            finally:
+                if self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+            self._stop.wait(1.0)
+
+    def _read(self, f: BinaryIO) -> None:
+        message = b""
+        opcode = OP_TEXT
+        while not self._stop.is_set():
+            fin, op, payload = read_frame(f)
+            if op == OP_CLOSE:
+                return
+            if op == OP_PING and self._sock is not None:
+                self._sock.sendall(encode_frame(OP_PONG, payload))
+                continue
+            if op in (OP_TEXT, OP_BINARY):
+                opcode, message = op, payload
+            elif op == OP_CONT:
+                message += payload
+            else:
+                continue
+            if not fin:
+                continue
+            self.feed(message.decode("utf-8") if opcode == OP_TEXT else message)
+
+    def feed(self, message: str | bytes) -> None:
+        """Handle one websocket message: a JSON event or a binary preview."""
+        if isinstance(message, bytes):
+            self._on_preview(message)
+        else:
+            self._on_event(json.loads(message))
+
+    def _on_event(self, event: Dict[str, object]) -> None:
+        data = event.get("data")
+        if not isinstance(data, dict):
+            return
+        if event.get("type") in ("executing", "progress") and data.get("prompt_id"):
+            running = data.get("prompt_id")
+            if event.get("type") == "executing" and data.get("node") is None:
+                running = None  # that prompt just finished
+            self._running = str(running) if running else None
+
+    def _on_preview(self, message: bytes) -> None:
+        if len(message) < 8:
+            return
+        event, fmt = struct.unpack(">II", message[:8])
+        ext = PREVIEW_FORMATS.get(fmt)
+        prompt_id = self._running
+        if event != PREVIEW_IMAGE or ext is None or prompt_id is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            out_path = self._watched.get(prompt_id)
+            if out_path is None:
+                return
+            self._first.setdefault(prompt_id, now)
+            last = self._written.get(prompt_id)
+            if last is not None and now - last < PREVIEW_EVERY_S:
+                return
+            self._written[prompt_id] = now
+        path = preview_path(out_path, ext)
+        tmp = path.with_name(f".{path.name}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(message[8:])
+            os.replace(tmp, path)
+        except OSError:
+            pass  # a missed preview isn't worth failing the item over
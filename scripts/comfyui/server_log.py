@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Deque, Dict, List
+
+# Lines of a spawned server's output kept in memory (shown when it fails).
+TAIL_LINES = 500
+
+# ComfyUI log lines, as printed by main.py / server.py / model_management.py.
+GOT_PROMPT = "got prompt"
+INVALID_PROMPT = "invalid prompt"
+EXECUTED_RE = re.compile(r"Prompt executed in ([0-9.]+) seconds")
+LOAD_START_RE = re.compile(r"Requested to load ")
+LOAD_DONE_RE = re.compile(r"loaded (?:completely|partially)")
+
+
+@dataclass(frozen=True)
+class ServerExecution:
+    exec_s: float  # as reported by the server: nodes only, no queueing
+    load_s: float  # model loads seen while it ran (part of exec_s)
+
+
+class ServerLog:
+    """Output of a ComfyUI server this process started.
+
+    The server writes to ``path`` (so it can outlive the runner); a thread
+    follows the file, keeps the last lines in a ring buffer and turns them
+    into per-prompt timings.
+
+    The server logs no prompt ids, so prompts are matched by the queue
+    ``number`` its /prompt reply carries. Numbers count every POST since the
+    server started ("got prompt"), prompts rejected by validation take a
+    number but never run, and the rest run in number order, so the n-th
+    "Prompt executed" line belongs to the n-th valid number. Model load time
+    is the gap between "Requested to load" and "loaded completely/partially"
+    lines, added to the prompt running at the time.
+
+    If the log shows more executions than valid prompts (lines it missed or
+    couldn't parse), that matching can't be trusted any more, and no timings
+    are reported from then on.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        tail: int = TAIL_LINES,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.path = path
+        self.lines: Deque[str] = deque(maxlen=tail)
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._got = 0
+        self._valid: List[int] = []  # numbers of prompts that will run, in order
+        self._executed = 0
+        self._in_sync = True
+        self._load_started: float | None = None
+        self._load_s = 0.0
+        self._executions: Dict[int, ServerExecution] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def follow(self, offset: int) -> None:
+        """Start reading ``path`` from byte ``offset`` in a daemon thread."""
+        self._thread = threading.Thread(
+            target=self._follow, args=(offset,), name="comfyui-log", daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _follow(self, offset: int) -> None:
+        partial = b""
+        with self.path.open("rb") as f:
+            f.seek(offset)
+            while not self._stop.is_set():
+                chunk = f.readline()
+                if not chunk:
+                    self._stop.wait(0.1)
+                    continue
+                partial += chunk
+                if partial.endswith(b"\n"):
+                    self.feed(partial.decode("utf-8", errors="replace").rstrip())
+                    partial = b""
+
+    def feed(self, line: str) -> None:
+        now = self._clock()
+        with self._cond:
+            self.lines.append(line)
+            if line.startswith(GOT_PROMPT):
+                self._valid.append(self._got)
+                self._got += 1
+            elif line.startswith(INVALID_PROMPT) and self._valid:
+                self._valid.pop()
+            elif LOAD_START_RE.search(line):
+                self._load_started = now
+            elif LOAD_DONE_RE.search(line) and self._load_started is not None:
+                self._load_s += now - self._load_started
+                self._load_started = None
+            else:
+                m = EXECUTED_RE.search(line)
+                if m is None:
+                    return
+                if self._executed >= len(self._valid):
+                    self._in_sync = False
+                    self._executions.clear()
+                elif self._in_sync:
+                    number = self._valid[self._executed]
+                    self._executions[number] = ServerExecution(
+                        exec_s=float(m.group(1)), load_s=self._load_s
+                    )
+                self._executed += 1
+                self._load_s = 0.0
+                self._cond.notify_all()
+
+    def drop(self, number: int) -> None:
+        """Prompt ``number`` was deleted from the queue and will never run."""
+        with self._cond:
+            pending = self._valid[self._executed :]
+            if number in pending:
+                self._valid.remove(number)
+
+    def execution(
+        self, number: int, *, timeout_s: float = 0.5
+    ) -> ServerExecution | None:
+        """Server-side timing of prompt ``number``.
+
+        History can show a prompt as done a moment before its log line is
+        read, so this waits up to ``timeout_s`` for it, but only while the
+        prompt is still pending in a log that is in sync.
+        """
+        deadline = time.monotonic() + timeout_s
+        with self._cond:
+            while number not in self._executions:
+                if not self._in_sync or number not in self._valid[self._executed :]:
+                    return None  # already past it, never seen, or can't tell
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                self._cond.wait(left)
+            return self._executions.pop(number)
+
+    def tail(self, n: int = 20) -> List[str]:
+        with self._cond:
+            return list(self.lines)[-n:]
+
+
+# Logs of servers started by this process, by URL; backends talking to one
+# of them add its server-side timings to their stages.
+_logs: Dict[str, ServerLog] = {}
+
+
+def register_log(server: str, log: ServerLog) -> None:
+    _logs[server.rstrip("/")] = log
+
+
+def log_for(server: str) -> ServerLog | None:
+    return _logs.get(server.rstrip("/"))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import subprocess
+import threading
+import time
+import urllib.request
+from typing import Callable, Dict
+
+# Checks of a server that fail in a row before it counts as down. A process
+# this runner started that has exited counts as down at once.
+MAX_MISSES = 3
+
+# Restarts of an owned server in a row before the watch gives up on it.
+MAX_RESTARTS = 3
+
+
+class ServerDown(RuntimeError):
+    """The server went down while a prompt was queued or running on it."""
+
+
+class ServerWatch:
+    """Circuit breaker for one ComfyUI server.
+
+    A thread checks the server every ``interval_s``: the process this runner
+    started (``proc``, if any) must still be running and /system_stats must
+    answer. When either fails the breaker opens: ``up`` turns false and
+    ``epoch`` goes up, so a backend can tell that prompts it queued before
+    are gone and resubmit them once ``wait_up`` returns. A server this runner
+    owns is restarted through ``restart`` (which returns the new process);
+    one it doesn't own is watched until it answers again.
+    """
+
+    def __init__(
+        self,
+        server: str,
+        *,
+        proc: subprocess.Popen[bytes] | None = None,
+        restart: Callable[[], subprocess.Popen[bytes]] | None = None,
+        interval_s: float = 1.0,
+        ready_timeout_s: float = 120.0,
+    ) -> None:
+        self.server = server.rstrip("/")
+        self.proc = proc
+        self._restart = restart
+        self.interval_s = interval_s
+        self.ready_timeout_s = ready_timeout_s
+        self.up = True
+        self.gave_up = False
+        self.epoch = 0
+        self.restarts = 0
+        # When /system_stats last answered, while the server was up.
+        self._last_ok: float | None = None
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="comfyui-watch", daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _answers(self) -> bool:
+        try:
+            with urllib.request.urlopen(f"{self.server}/system_stats", timeout=5):
+                return True
+        except Exception:
+            return False
+
+    def _run(self) -> None:
+        misses = 0
+        while not self._stop.wait(self.interval_s):
+            code = self.proc.poll() if self.proc is not None else None
+            if code is not None:
+                reason = f"process exited with code {code}"
+            elif self._answers():
+                misses = 0
+                self._last_ok = time.monotonic()
+                continue
+            else:
+                self._last_ok = None
+                misses += 1
+                if misses < MAX_MISSES:
+                    continue
+                reason = f"no answer from /system_stats ({misses} checks)"
+            misses = 0
+            self._last_ok = None
+            self._trip(reason)
+            self._recover()
+
+    def _trip(self, reason: str) -> None:
+        print(f"ComfyUI at {self.server} is down: {reason}")
+        with self._cond:
+            self.up = False
+            self.epoch += 1
+            self._cond.notify_all()
+
+    def _recover(self) -> None:
+        down_at = time.monotonic()
+        if self._restart is None:
+            while not self._stop.wait(self.interval_s):
+                if self._answers():
+                    break
+            else:
+                return
+        else:
+            for n in range(1, MAX_RESTARTS + 1):
+                if self._stop.is_set():
+                    return
+                self._stop_process()
+                print(f"Restarting ComfyUI ({n}/{MAX_RESTARTS}) ...")
+                self.proc = self._restart()
+                self.restarts += 1
+                if self._wait_ready():
+                    break
+            else:
+                print(f"ComfyUI at {self.server} didn't come back; giving up")
+                with self._cond:
+                    self.gave_up = True
+                    self._cond.notify_all()
+                self._stop.set()
+                return
+        print(
+            f"ComfyUI at {self.server} is back after {time.monotonic() - down_at:.1f}s"
+        )
+        with self._cond:
+            self.up = True
+            self._cond.notify_all()
+
+    def _stop_process(self) -> None:
+        # A hung server still holds the port (and VRAM); make way for the new one.
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def _wait_ready(self) -> bool:
+        deadline = time.monotonic() + self.ready_timeout_s
+        while time.monotonic() < deadline and not self._stop.is_set():
+            if self.proc is not None and self.proc.poll() is not None:
+                return False
+            if self._answers():
+                return True
+            self._stop.wait(0.5)
+        return False
+
+    def down_since(self, epoch: int) -> bool:
+        return self.epoch != epoch
+
+    def went_down(self, epoch: int) -> bool:
+        """Whether the breaker opened since ``epoch``.
+
+        Called after a request to the server failed, so it gives the watch
+        time to confirm (or not) before answering, unless the server answered
+        its last check and the next one isn't overdue: then the request
+        failed for some other reason (a rejected prompt, a missing node).
+        """
+        last_ok = self._last_ok
+        if (
+            self.epoch == epoch
+            and last_ok is not None
+            and time.monotonic() - last_ok < 2 * self.interval_s
+            and (self.proc is None or self.proc.poll() is None)
+        ):
+            return False
+        grace = self.interval_s * (MAX_MISSES + 1) + 5.0
+        with self._cond:
+            return self._cond.wait_for(lambda: self.epoch != epoch, timeout=grace)
+
+    def wait_up(self, timeout_s: float) -> bool:
+        """Block until the server is back; False if it won't be."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.up or self.gave_up, timeout=timeout_s)
+            return self.up
+
+
+# Watches of the servers this process talks to, by URL.
+_watches: Dict[str, ServerWatch] = {}
+
+
+def register_watch(server: str, watch: ServerWatch) -> None:
+    _watches[server.rstrip("/")] = watch
+
+
+def watch_for(server: str) -> ServerWatch | None:
+    return _watches.get(server.rstrip("/"))
+
+
+def close_watch(server: str) -> None:
+    """Stop watching ``server`` (when this process is done with it)."""
+    watch = _watches.pop(server.rstrip("/"), None)
+    if watch is not None:
+        watch.close()
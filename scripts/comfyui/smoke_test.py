@@ -2,12 +2,37 @@
 
 from __future__ import annotations
 
+import contextlib
+import io
+import itertools
+import json
 import os
+import struct
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
-from comfyui_lib import resolve_checkpoint_name, slugify, validate_job_config
+from comfyui_lib import (
+    BatchJob,
+    WorkflowTemplate,
+    builtin_templates,
+    checkpoint_loads,
+    comfy_img2img_workflow,
+    comfyui_timing_key,
+    extract_first_image_from_history,
+    order_batch,
+    resolve_checkpoint_name,
+    slugify,
+    validate_job_config,
+)
+from preview_stream import PreviewStream, encode_frame, read_frame
+from server_log import ServerExecution, ServerLog
+from server_watch import ServerWatch
 
 
 class ComfyUISmokeTests(unittest.TestCase):
@@ -25,6 +50,15 @@ class ComfyUISmokeTests(unittest.TestCase):
         with self.assertRaises(SystemExit):
             validate_job_config(cfg)
 
+    def test_validate_job_config_denoise_range(self) -> None:
+        for bad in (0, -0.5, 1.5, "0.4", None):
+            cfg = {"version": 1, "generate": {"denoise": bad}}
+            with self.assertRaises(SystemExit) as ctx:
+                validate_job_config(cfg)
+            self.assertIn("generate.denoise", str(ctx.exception))
+        validate_job_config({"version": 1, "generate": {"denoise": 0.4}})
+        validate_job_config({"version": 1, "generate": {"denoise": 1}})
+
     def test_checkpoint_resolution_priority(self) -> None:
         with tempfile.TemporaryDirectory() as td:
             d = Path(td)
@@ -53,6 +87,223 @@ class ComfyUISmokeTests(unittest.TestCase):
             self.assertEqual(name, "only.safetensors")
             self.assertEqual(used_dir, d)
 
+    def test_order_batch_groups_checkpoints(self) -> None:
+        def job(name: str, model: str, size: int) -> BatchJob:
+            key = {"model": model, "width": size, "height": size}
+            return BatchJob(path=Path(name), cfg={}, key=key)
+
+        jobs = [
+            job("kins", "a", 1024),
+            job("monsters", "b", 1024),
+            job("professions", "a", 768),
+            job("items", "b", 512),
+            job("npcs", "a", 1024),
+        ]
+        ordered = order_batch(jobs)
+        self.assertEqual(
+            [j.path.name for j in ordered],
+            ["professions", "kins", "npcs", "items", "monsters"],
+        )
+        self.assertEqual(checkpoint_loads(jobs), 5)
+        self.assertEqual(checkpoint_loads(ordered), 2)
+
+    def test_server_log_matches_executions_to_prompt_numbers(self) -> None:
+        clock = itertools.chain(
+            [0.0, 0.0, 0.0, 0.0, 1.0, 4.0, 5.0, 6.0, 7.0, 8.0], itertools.repeat(9.0)
+        )
+        log = ServerLog(Path("unused.log"), tail=3, clock=lambda: next(clock))
+        for line in [
+            "got prompt",  # 0
+            "got prompt",  # 1: rejected
+            "invalid prompt: {'type': 'prompt_outputs_failed_validation'}",
+            "got prompt",  # 2
+            "Requested to load SDXL",
+            "loaded completely 0.0 4897.0 True",
+            "Prompt executed in 12.50 seconds",
+            "got prompt",  # 3
+            "Prompt executed in 8.25 seconds",
+            "Prompt executed in 8.00 seconds",
+        ]:
+            log.feed(line)
+        self.assertEqual(log.execution(0, timeout_s=0), ServerExecution(12.5, 3.0))
+        self.assertIsNone(log.execution(1, timeout_s=0))
+        self.assertEqual(log.execution(2, timeout_s=0), ServerExecution(8.25, 0.0))
+        self.assertEqual(log.execution(3, timeout_s=0), ServerExecution(8.0, 0.0))
+        self.assertEqual(len(log.tail()), 3)
+
+        # Once the log shows a run it can't place, it stops guessing (and
+        # doesn't wait for lines that won't come).
+        log.feed("got prompt")  # 4
+        log.feed("Prompt executed in 1.00 seconds")
+        log.feed("Prompt executed in 2.00 seconds")
+        log.feed("got prompt")  # 5
+        self.assertIsNone(log.execution(4, timeout_s=60))
+        self.assertIsNone(log.execution(5, timeout_s=60))
+
+    def test_img2img_workflow_samples_from_uploaded_image(self) -> None:
+        wf = comfy_img2img_workflow(
+            ckpt_name="m.safetensors",
+            init_image="dragonbane_unbound/elf.png",
+            denoise=0.4,
+            positive="elf",
+            negative="",
+            seed=1,
+            steps=12,
+            cfg=6.0,
+            sampler_name="euler",
+            scheduler="karras",
+            width=512,
+            height=768,
+            filename_prefix="x/elf",
+        )
+        self.assertEqual(wf["4"]["inputs"]["image"], "dragonbane_unbound/elf.png")
+        self.assertEqual(wf["8"]["inputs"]["image"], ["4", 0])
+        self.assertEqual(
+            (wf["8"]["inputs"]["width"], wf["8"]["inputs"]["height"]), (512, 768)
+        )
+        self.assertEqual(wf["9"]["inputs"]["pixels"], ["8", 0])
+        sampler = wf["5"]["inputs"]
+        self.assertEqual((sampler["latent_image"], sampler["denoise"]), (["9", 0], 0.4))
+        # Every node input link points at a node that exists.
+        for node in wf.values():
+            for value in node["inputs"].values():
+                if isinstance(value, list):
+                    self.assertIn(value[0], wf)
+
+    def test_refresh_timing_key_counts_sampled_steps(self) -> None:
+        full = comfyui_timing_key({"generate": {"steps": 30}})
+        refresh = comfyui_timing_key({"generate": {"steps": 30, "denoise": 0.4}})
+        self.assertNotIn("mode", full)
+        self.assertEqual((refresh["steps"], refresh["mode"]), (12, "img2img"))
+
+    def test_workflow_template_patches_bound_inputs(self) -> None:
+        path = Path(__file__).resolve().parent / "workflows/sdxl_lora.api.json"
+        bindings = {"prompt": "6.text", "seed": ["3.seed"], "width": "5.width"}
+        tpl = WorkflowTemplate.load(path, bindings)
+        self.assertEqual(tpl.output_node, "9")
+        wf = tpl.render({"prompt": "elf", "seed": 7, "negative": "unbound"})
+        self.assertEqual(wf["6"]["inputs"]["text"], "elf")
+        self.assertEqual(wf["3"]["inputs"]["seed"], 7)
+        self.assertEqual(wf["5"]["inputs"]["width"], 1024)  # not given: exported
+        self.assertEqual(wf["7"]["inputs"]["text"], "")
+        self.assertIs(wf["10"], tpl.graph["10"])  # unpatched nodes are shared
+        self.assertEqual(tpl.graph["6"]["inputs"]["text"], "")
+        for bad in ({"prompt": "6.txt"}, {"prompt": "6.clip"}, {"seed": "3.seed"}):
+            with self.assertRaises(SystemExit):
+                WorkflowTemplate.load(path, bad)
+
+        txt2img, img2img = builtin_templates()
+        self.assertEqual((txt2img.output_node, img2img.output_node), ("7", "7"))
+        self.assertEqual(
+            img2img.render({"init_image": "a.png"})["4"]["inputs"]["image"], "a.png"
+        )
+
+    def test_output_image_found_without_node_id(self) -> None:
+        history = {
+            "outputs": {
+                "12": {"images": [{"filename": "p.png", "type": "temp"}]},
+                "9": {"images": [{"filename": "x.png", "subfolder": "s"}]},
+            }
+        }
+        self.assertEqual(
+            extract_first_image_from_history(history), ("x.png", "s", "output")
+        )
+        self.assertEqual(extract_first_image_from_history(history, "12")[0], "p.png")
+        with self.assertRaises(RuntimeError):
+            extract_first_image_from_history({"outputs": {}})
+
+    def test_server_watch_restarts_a_dead_server(self) -> None:
+        class Stats(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args: object) -> None:
+                pass
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Stats)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        sleeper = [sys.executable, "-c", "import time; time.sleep(30)"]
+        procs = [subprocess.Popen(sleeper)]
+
+        def restart() -> subprocess.Popen[bytes]:
+            procs.append(subprocess.Popen(sleeper))
+            return procs[-1]
+
+        watch = ServerWatch(
+            f"http://127.0.0.1:{httpd.server_port}",
+            proc=procs[0],
+            restart=restart,
+            interval_s=0.05,
+        )
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                watch.start()
+                self.assertFalse(watch.down_since(0))
+                procs[0].kill()  # "crashes" mid-batch
+                self.assertTrue(watch.went_down(0))
+                self.assertTrue(watch.wait_up(10))
+            self.assertEqual((watch.epoch, watch.restarts, len(procs)), (1, 1, 2))
+            self.assertIn("process exited", out.getvalue())
+        finally:
+            watch.close()
+            httpd.shutdown()
+            httpd.server_close()
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+
+    def test_server_watch_answers_at_once_while_the_server_is_up(self) -> None:
+        class Stats(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args: object) -> None:
+                pass
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), Stats)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        watch = ServerWatch(f"http://127.0.0.1:{httpd.server_port}", interval_s=0.05)
+        try:
+            watch.start()
+            time.sleep(0.2)  # a few checks in
+            # A request that failed for its own reasons (e.g. a rejected
+            # prompt) doesn't wait out the outage grace period.
+            started = time.monotonic()
+            self.assertFalse(watch.went_down(0))
+            self.assertLess(time.monotonic() - started, 0.1)
+        finally:
+            watch.close()
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_preview_stream_writes_previews_of_watched_prompts(self) -> None:
+        fin, op, payload = read_frame(io.BytesIO(encode_frame(2, b"x" * 300)))
+        self.assertEqual((fin, op, payload), (True, 2, b"x" * 300))
+
+        def preview(data: bytes) -> bytes:
+            return struct.pack(">II", 1, 1) + data
+
+        def progress(prompt_id: str) -> str:
+            return json.dumps({"type": "progress", "data": {"prompt_id": prompt_id}})
+
+        with tempfile.TemporaryDirectory() as td:
+            out_path = Path(td) / "elf.png"
+            stream = PreviewStream("http://127.0.0.1:1", "client")
+            stream.watch("p1", out_path)
+            stream.feed(progress("p0"))  # another client's prompt
+            stream.feed(preview(b"other"))
+            self.assertFalse((Path(td) / "elf.preview.jpg").exists())
+            stream.feed(progress("p1"))
+            stream.feed(preview(b"step 1"))
+            stream.feed(preview(b"step 2"))  # within PREVIEW_EVERY_S: skipped
+            self.assertEqual((Path(td) / "elf.preview.jpg").read_bytes(), b"step 1")
+            self.assertIsNotNone(stream.forget("p1"))
+            self.assertEqual(list(Path(td).iterdir()), [])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
+
+# Values the backend fills in per item, by the name bindings use.
+PARAMS = (
+    "checkpoint",
+    "prompt",
+    "negative",
+    "seed",
+    "steps",
+    "cfg",
+    "sampler",
+    "scheduler",
+    "width",
+    "height",
+    "filename_prefix",
+    "denoise",
+    "init_image",
+)
+
+# Node classes taken as the image to download when the job doesn't name one.
+OUTPUT_CLASSES = ("SaveImage",)
+
+
+def _is_link(value: Any) -> bool:
+    # API format wires an input to another node's output as [node_id, index].
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[0], str)
+        and isinstance(value[1], int)
+    )
+
+
+class WorkflowTemplate:
+    """A ComfyUI API-format workflow with named parameter bindings.
+
+    ``bindings`` maps a parameter (see ``PARAMS``) to one ``"<node>.<input>"``
+    target or a list of them (e.g. the seed of two samplers). Everything is
+    checked once here; ``render`` then copies only the nodes it patches and
+    shares the rest with the template, so per-item cost doesn't grow with the
+    size of the graph. Inputs without a binding, or whose parameter isn't
+    given, keep the value they were exported with.
+    """
+
+    def __init__(
+        self,
+        graph: Mapping[str, Any],
+        bindings: Mapping[str, Any],
+        *,
+        name: str = "",
+        output_node: str | None = None,
+    ) -> None:
+        self.name = name
+        where = f"workflow {name}" if name else "workflow"
+        if isinstance(graph.get("nodes"), list) and "links" in graph:
+            raise SystemExit(
+                f"{where} is in the editor's UI format; export it with "
+                "'Save (API Format)' instead"
+            )
+        for node_id, node in graph.items():
+            if not (
+                isinstance(node, dict)
+                and isinstance(node.get("class_type"), str)
+                and isinstance(node.get("inputs"), dict)
+            ):
+                raise SystemExit(
+                    f"{where}: node {node_id!r} needs class_type and inputs"
+                )
+        self.graph: Dict[str, Dict[str, Any]] = dict(graph)
+
+        unknown = sorted(set(bindings) - set(PARAMS))
+        if unknown:
+            raise SystemExit(
+                f"{where}: unknown binding(s) {', '.join(unknown)} "
+                f"(expected: {', '.join(PARAMS)})"
+            )
+        if "prompt" not in bindings:
+            raise SystemExit(f"{where}: bindings must include prompt")
+
+        patches: Dict[str, List[Tuple[str, str]]] = {}
+        for param, raw in bindings.items():
+            targets = [raw] if isinstance(raw, str) else raw
+            if not isinstance(targets, list) or not targets:
+                raise SystemExit(
+                    f"{where}: binding {param} must be '<node>.<input>' "
+                    "or a list of them"
+                )
+            for target in targets:
+                node_id, _, input_name = str(target).partition(".")
+                node = self.graph.get(node_id)
+                if node is None:
+                    raise SystemExit(f"{where}: {param} -> {target}: no node {node_id}")
+                if input_name not in node["inputs"]:
+                    raise SystemExit(
+                        f"{where}: {param} -> {target}: {node['class_type']} node "
+                        f"{node_id} has no input {input_name!r}"
+                    )
+                if _is_link(node["inputs"][input_name]):
+                    raise SystemExit(
+                        f"{where}: {param} -> {target}: input is wired to "
+                        "another node"
+                    )
+                patches.setdefault(node_id, []).append((input_name, param))
+        self.params = frozenset(bindings)
+        self._patches: Sequence[Tuple[str, Sequence[Tuple[str, str]]]] = [
+            (node_id, tuple(inputs)) for node_id, inputs in patches.items()
+        ]
+        self.output_node = self._find_output_node(output_node, where)
+        # Identity of what ``render`` produces for given values.
+        self.digest = hashlib.sha256(
+            json.dumps(
+                [self.graph, sorted(bindings.items()), self.output_node],
+                sort_keys=True,
+                separators=(",", ":"),
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def _find_output_node(self, output_node: str | None, where: str) -> str:
+        if output_node is not None:
+            if str(output_node) not in self.graph:
+                raise SystemExit(f"{where}: output_node {output_node} not found")
+            return str(output_node)
+        found = [
+            node_id
+            for node_id, node in self.graph.items()
+            if node["class_type"] in OUTPUT_CLASSES
+        ]
+        if len(found) != 1:
+            what = "no" if not found else f"{len(found)}"
+            raise SystemExit(
+                f"{where} has {what} {'/'.join(OUTPUT_CLASSES)} node(s)"
+                + (f" ({', '.join(found)})" if found else "")
+                + "; set workflow.output_node"
+            )
+        return found[0]
+
+    @classmethod
+    def load(
+        cls,
+        path: Path,
+        bindings: Mapping[str, Any],
+        *,
+        output_node: str | None = None,
+    ) -> WorkflowTemplate:
+        try:
+            graph = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"Can't read workflow {path}: {e}")
+        if not isinstance(graph, dict):
+            raise SystemExit(f"workflow {path.name} must be a JSON object")
+        return cls(graph, bindings, name=path.name, output_node=output_node)
+
+    def binds(self, param: str) -> bool:
+        return param in self.params
+
+    def render(self, values: Mapping[str, Any]) -> Dict[str, Any]:
+        """The workflow to POST, with bound inputs set from ``values``."""
+        workflow = dict(self.graph)
+        for node_id, inputs in self._patches:
+            node = self.graph[node_id]
+            patched = dict(node["inputs"])
+            for input_name, param in inputs:
+                if param in values:
+                    patched[input_name] = values[param]
+            workflow[node_id] = {**node, "inputs": patched}
+        return workflow
+
+
+def workflow_template_from_cfg(cfg: Mapping[str, Any]) -> WorkflowTemplate | None:
+    """The job's ``workflow`` section compiled, or None to use the built-in."""
+    wf_raw = cfg.get("workflow")
+    if wf_raw is None:
+        return None
+    if not isinstance(wf_raw, dict) or not wf_raw.get("path"):
+        raise SystemExit("workflow must be an object with a path")
+    bindings = wf_raw.get("bindings")
+    if not isinstance(bindings, dict):
+        raise SystemExit("workflow.bindings must be an object")
+    output_node = wf_raw.get("output_node")
+    return WorkflowTemplate.load(
+        Path(str(wf_raw["path"])).expanduser(),
+        bindings,
+        output_node=str(output_node) if output_node is not None else None,
+    )
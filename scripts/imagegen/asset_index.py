@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+from png_tools import PngError, decode_scanlines, gray_at, palette, read_header
+from portrait_index import image_dimensions, write_json_atomic
+
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".webp"}
+
+# dHash bit distance at or below which two images count as near-duplicates.
+DEFAULT_MAX_DISTANCE = 6
+
+# Samples averaged per dHash cell by the stdlib fallback (SAMPLES x SAMPLES).
+SAMPLES = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    dhash TEXT,
+    width INTEGER,
+    height INTEGER
+);
+CREATE INDEX IF NOT EXISTS assets_sha256 ON assets (sha256);
+"""
+
+
+def _gray_grid_pillow(data: bytes) -> List[List[int]] | None:
+    try:
+        from PIL import Image  # type: ignore
+    except ImportError:
+        return None
+    try:
+        im = Image.open(io.BytesIO(data)).convert("L").resize((9, 8), Image.BOX)
+    except Exception:
+        return None
+    px = list(im.getdata())
+    return [px[y * 9 : y * 9 + 9] for y in range(8)]
+
+
+def _gray_grid_png(data: bytes) -> List[List[int]] | None:
+    # Stdlib fallback: decode the PNG and average a few samples per cell.
+    try:
+        header, rows = decode_scanlines(data)
+    except PngError:
+        return None
+    plte = palette(data) if header.color_type == 3 else []
+    grid: List[List[int]] = []
+    for cy in range(8):
+        line: List[int] = []
+        for cx in range(9):
+            total = 0
+            for sy in range(SAMPLES):
+                y = min(header.height - 1, (cy * SAMPLES + sy) * header.height // 32)
+                for sx in range(SAMPLES):
+                    x = min(header.width - 1, (cx * SAMPLES + sx) * header.width // 36)
+                    total += gray_at(header, rows, x, y, plte)
+            line.append(total // (SAMPLES * SAMPLES))
+        grid.append(line)
+    return grid
+
+
+def dhash(data: bytes) -> int | None:
+    """64-bit difference hash, or None if the image can't be decoded.
+
+    Uses Pillow when installed; otherwise PNGs are decoded with the stdlib
+    (other formats then get no perceptual hash, only sha256).
+    """
+    grid = _gray_grid_pillow(data) or _gray_grid_png(data)
+    if grid is None:
+        return None
+    value = 0
+    for row in grid:
+        for x in range(8):
+            value = (value << 1) | (1 if row[x] > row[x + 1] else 0)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def hash_image_file(path: str) -> Tuple[str, int | None, int | None, int | None]:
+    """(sha256, dhash, width, height) for one file; runs in worker processes."""
+    data = Path(path).read_bytes()
+    dims = image_dimensions(data)
+    if dims is None:
+        try:
+            h = read_header(data)
+            dims = (h.width, h.height)
+        except PngError:
+            dims = None
+    return (
+        hashlib.sha256(data).hexdigest(),
+        dhash(data),
+        dims[0] if dims else None,
+        dims[1] if dims else None,
+    )
+
+
+def iter_image_files(roots: Sequence[Path]) -> List[Path]:
+    out: List[Path] = []
+    for root in roots:
+        if root.is_file():
+            out.append(root.resolve())
+            continue
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                p = Path(dirpath) / name
+                if p.suffix.lower() in IMAGE_EXTS and not name.startswith("."):
+                    out.append(p.resolve())
+    return sorted(set(out))
+
+
+class AssetIndex:
+    """sha256 + perceptual hash per image file, cached in SQLite.
+
+    Files are only rehashed when their size or mtime changes.
+    """
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(str(path))
+        self._conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def refresh(self, roots: Sequence[Path], *, workers: int | None = None) -> int:
+        """Index every image under ``roots``; return how many were (re)hashed."""
+        files = iter_image_files(roots)
+        known = {
+            r[0]: (r[1], r[2])
+            for r in self._conn.execute("SELECT path, size, mtime_ns FROM assets")
+        }
+        stale: List[Tuple[Path, os.stat_result]] = []
+        for p in files:
+            st = p.stat()
+            if known.get(str(p)) != (st.st_size, st.st_mtime_ns):
+                stale.append((p, st))
+
+        paths = [str(p) for p, _ in stale]
+        if len(paths) > 1 and (workers or os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(hash_image_file, paths, chunksize=4))
+        else:
+            results = [hash_image_file(p) for p in paths]
+
+        for (p, st), (sha, dh, w, h) in zip(stale, results):
+            self._conn.execute(
+                "INSERT OR REPLACE INTO assets"
+                " (path, size, mtime_ns, sha256, dhash, width, height)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(p),
+                    st.st_size,
+                    st.st_mtime_ns,
+                    sha,
+                    f"{dh:016x}" if dh is not None else None,
+                    w,
+                    h,
+                ),
+            )
+
+        # Forget files that disappeared from the scanned roots.
+        present = {str(p) for p in files}
+        prefixes = [str(r.resolve()) for r in roots]
+        for path in known:
+            if path not in present and any(
+                path == pre or path.startswith(pre + os.sep) for pre in prefixes
+            ):
+                self._conn.execute("DELETE FROM assets WHERE path=?", (path,))
+        self._conn.commit()
+        return len(stale)
+
+    def _rows(self, roots: Sequence[Path]) -> List[Tuple[str, str, int | None]]:
+        prefixes = [str(r.resolve()) for r in roots]
+        out: List[Tuple[str, str, int | None]] = []
+        for path, sha, dh in self._conn.execute(
+            "SELECT path, sha256, dhash FROM assets ORDER BY path"
+        ):
+            if any(path == pre or path.startswith(pre + os.sep) for pre in prefixes):
+                out.append((path, sha, int(dh, 16) if dh else None))
+        return out
+
+    def exact_clusters(self, roots: Sequence[Path]) -> List[List[str]]:
+        """Groups of byte-identical files, canonical copy first."""
+        by_sha: Dict[str, List[str]] = {}
+        for path, sha, _ in self._rows(roots):
+            by_sha.setdefault(sha, []).append(path)
+        return sorted(
+            (_by_priority(paths, roots) for paths in by_sha.values() if len(paths) > 1),
+            key=lambda c: c[0],
+        )
+
+    def similar_clusters(
+        self, roots: Sequence[Path], *, max_distance: int = DEFAULT_MAX_DISTANCE
+    ) -> List[List[str]]:
+        """Groups of visually near-identical files that are not byte-identical."""
+        first: Dict[str, Tuple[str, int]] = {}
+        members: Dict[str, List[str]] = {}
+        for path, sha, dh in self._rows(roots):
+            if dh is None:
+                continue
+            first.setdefault(sha, (path, dh))
+            members.setdefault(sha, []).append(path)
+        shas = sorted(first)
+        parent = {s: s for s in shas}
+
+        def find(s: str) -> str:
+            while parent[s] != s:
+                parent[s] = parent[parent[s]]
+                s = parent[s]
+            return s
+
+        for i, a in enumerate(shas):
+            for b in shas[i + 1 :]:
+                if hamming(first[a][1], first[b][1]) <= max_distance:
+                    parent[find(a)] = find(b)
+
+        groups: Dict[str, List[str]] = {}
+        for s in shas:
+            groups.setdefault(find(s), []).append(s)
+        return sorted(
+            (
+                _by_priority([p for s in g for p in members[s]], roots)
+                for g in groups.values()
+                if len(g) > 1
+            ),
+            key=lambda c: c[0],
+        )
+
+    def similar(
+        self, data: bytes, *, max_distance: int = DEFAULT_MAX_DISTANCE
+    ) -> List[Tuple[int, str]]:
+        """Indexed files that look like ``data``: (distance, path), closest first."""
+        target = dhash(data)
+        if target is None:
+            return []
+        out: List[Tuple[int, str]] = []
+        for path, dh in self._conn.execute(
+            "SELECT path, dhash FROM assets WHERE dhash IS NOT NULL"
+        ):
+            d = hamming(target, int(dh, 16))
+            if d <= max_distance:
+                out.append((d, path))
+        return sorted(out)
+
+
+def _by_priority(paths: Sequence[str], roots: Sequence[Path]) -> List[str]:
+    # The copy under the earliest-listed root is canonical; ties go by path.
+    prefixes = [str(r.resolve()) for r in roots]
+
+    def rank(path: str) -> Tuple[int, str]:
+        for i, pre in enumerate(prefixes):
+            if path == pre or path.startswith(pre + os.sep):
+                return i, path
+        return len(prefixes), path
+
+    return sorted(paths, key=rank)
+
+
+def link_duplicates(clusters: Sequence[Sequence[str]]) -> List[Tuple[str, str]]:
+    """Replace every copy with a hardlink to the cluster's first file."""
+    linked: List[Tuple[str, str]] = []
+    for cluster in clusters:
+        canonical = cluster[0]
+        for dup in cluster[1:]:
+            if os.path.samefile(canonical, dup):
+                continue
+            tmp = f"{dup}.dedup-tmp"
+            try:
+                os.link(canonical, tmp)
+                os.replace(tmp, dup)
+            except OSError as e:
+                Path(tmp).unlink(missing_ok=True)
+                print(f"WARNING: could not hardlink {dup}: {e}")
+                continue
+            linked.append((dup, canonical))
+    return linked
+
+
+def reference_duplicates(
+    clusters: Sequence[Sequence[str]], refs_file: Path
+) -> List[Tuple[str, str]]:
+    """Delete every copy and record ``copy -> canonical`` in ``refs_file``.
+
+    Paths in the file are relative to its directory; existing entries are kept.
+    """
+    base = refs_file.resolve().parent
+    try:
+        refs = json.loads(refs_file.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        refs = {}
+    if not isinstance(refs, dict):
+        raise SystemExit(f"Invalid references file (expected an object): {refs_file}")
+
+    removed: List[Tuple[str, str]] = []
+    for cluster in clusters:
+        canonical = cluster[0]
+        for dup in cluster[1:]:
+            refs[os.path.relpath(dup, base)] = os.path.relpath(canonical, base)
+            removed.append((dup, canonical))
+    # Record first, then delete, so an interruption never loses a file's
+    # whereabouts.
+    write_json_atomic(refs_file, dict(sorted(refs.items())))
+    for dup, _ in removed:
+        Path(dup).unlink(missing_ok=True)
+    return removed
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Tuple
+
+# A window increase has to buy at least this much throughput to be kept.
+GAIN = 1.10
+
+# Back off when an epoch's mean latency exceeds this multiple of the latency
+# measured at the best throughput so far (and throughput did not improve).
+LATENCY_FACTOR = 2.0
+
+# VRAM use (0..1) at which the window stops growing / is halved.
+PRESSURE_GROW = 0.80
+PRESSURE_HIGH = 0.92
+
+# Epochs to hold a window that stopped paying off before probing above it.
+PROBE_EPOCHS = 5
+
+
+class AimdController:
+    """Adaptive in-flight limit for one backend lane (AIMD).
+
+    Workers call ``acquire`` before taking an item and ``release`` with its
+    latency and success afterwards. Once ``limit`` items have completed
+    since the last decision (an epoch), throughput and mean latency are
+    compared with the best epoch so far:
+
+    - throughput improved: grow the window by one (up to ``ceiling``),
+    - the last increase bought nothing: step back and hold for a while,
+    - failures, latency rising well past the best epoch's, or ``pressure``
+      (e.g. VRAM use reported by the server) too high: halve the window.
+
+    Every change is logged with its reason.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        initial: int,
+        ceiling: int,
+        pressure: Callable[[], float | None] | None = None,
+        log: Callable[[str], None] = print,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.ceiling = max(1, ceiling)
+        self.limit = max(1, min(initial, self.ceiling))
+        self.changes = 0
+        self._pressure = pressure
+        self._log = log
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._best: Tuple[float, float, int] | None = None  # throughput, latency, limit
+        self._last_grow = False
+        self._hold = 0
+        self._reset_epoch()
+
+    def _reset_epoch(self) -> None:
+        self._epoch_start = self._clock()
+        self._done = 0
+        self._failed = 0
+        self._latency_sum = 0.0
+
+    def acquire(self, stop: threading.Event) -> bool:
+        """Wait for a free slot in the window; False once ``stop`` is set."""
+        with self._cond:
+            while self._in_flight >= self.limit:
+                if stop.is_set():
+                    return False
+                self._cond.wait(0.1)
+            self._in_flight += 1
+            return True
+
+    def cancel(self) -> None:
+        """Give back a slot that was acquired but not used."""
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def release(self, latency_s: float, *, ok: bool) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._done += 1
+            self._failed += 0 if ok else 1
+            self._latency_sum += latency_s
+            epoch = None
+            if self._done >= self.limit:
+                epoch = self._end_epoch()
+            self._cond.notify_all()
+        if epoch is None:
+            return
+        # The pressure probe may be a slow HTTP call; other workers keep
+        # acquiring and releasing meanwhile.
+        pressure = self._pressure() if self._pressure is not None else None
+        with self._cond:
+            self._decide(*epoch, pressure)
+            self._cond.notify_all()
+
+    def _end_epoch(self) -> Tuple[float, float, int]:
+        """Throughput, mean latency and failures of the epoch just ended."""
+        elapsed = max(self._clock() - self._epoch_start, 1e-6)
+        epoch = (self._done / elapsed, self._latency_sum / self._done, self._failed)
+        self._reset_epoch()
+        return epoch
+
+    def _set(self, limit: int, reason: str) -> None:
+        limit = max(1, min(limit, self.ceiling))
+        if limit != self.limit:
+            self._log(f"Concurrency {self.name}: {self.limit} -> {limit} ({reason})")
+            self.limit = limit
+            self.changes += 1
+
+    def _decide(
+        self, throughput: float, latency: float, failed: int, pressure: float | None
+    ) -> None:
+        best = self._best
+        grew, self._last_grow = self._last_grow, False
+
+        def rate(x: float) -> str:
+            return f"{x * 60:.1f}/min"
+
+        if failed:
+            self._best = None
+            self._set(self.limit // 2, f"{failed} failure(s)")
+        elif pressure is not None and pressure >= PRESSURE_HIGH:
+            self._best = None
+            self._set(self.limit // 2, f"VRAM {pressure:.0%} in use")
+        elif (
+            best is not None
+            and latency > LATENCY_FACTOR * best[1]
+            and throughput < best[0]
+        ):
+            self._best = None
+            self._set(
+                self.limit // 2,
+                f"latency {latency:.1f}s vs {best[1]:.1f}s at {best[2]}",
+            )
+        elif best is None or throughput >= best[0] * GAIN or self.limit == best[2]:
+            # New best, or a fresh reading for the current best window (so the
+            # baseline follows slow drift, e.g. a heavier checkpoint).
+            self._best = (throughput, latency, self.limit)
+            improved = best is not None and best[2] != self.limit
+            if self.limit < self.ceiling and (
+                best is None or improved or self._hold <= 0
+            ):
+                if pressure is not None and pressure >= PRESSURE_GROW:
+                    return
+                note = f"throughput {rate(throughput)}"
+                if improved:
+                    note += f", was {rate(best[0])}"
+                self._last_grow = True
+                self._set(self.limit + 1, note)
+            else:
+                self._hold -= 1
+        elif grew:
+            self._hold = PROBE_EPOCHS
+            self._set(
+                best[2],
+                f"no gain: {rate(throughput)} vs {rate(best[0])} at {best[2]}",
+            )
+        else:
+            self._hold -= 1
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import hashlib
+import heapq
+import itertools
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
+
+from imagegen_lib import GenerationBackend, GenerationResult, JobItem, output_metadata
+from png_tools import PNG_SIGNATURE, PngHeader, embed_metadata, encode_png
+from verify import check_image
+
+# Lower runs first. Interactive requests (someone is waiting in the web app)
+# always jump ahead of bulk batches.
+PRIORITIES = {"interactive": 0, "bulk": 1}
+
+REQUEST_KEYS = {"name", "prompt", "negative", "seed", "priority"}
+
+TERMINAL = {"done", "failed"}
+
+# Finished requests are forgotten this long after they finish, so a daemon
+# that runs for weeks doesn't keep every request it ever saw. A done image
+# stays on disk and is picked up again if the request comes back.
+DEFAULT_KEEP_S = 3600.0
+
+
+class StandInBackend(GenerationBackend):
+    """Renders a flat-colored PNG after ``delay_s``; for tests and demos."""
+
+    name = "stand-in"
+
+    def __init__(self, *, slots: int = 1, delay_s: float = 0.2, size: int = 64):
+        self.slots = slots
+        self.delay_s = delay_s
+        self.size = size
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def timing_key(self) -> Dict[str, Any]:
+        return {"backend": self.name, "width": self.size, "height": self.size}
+
+    def generate(self, item: JobItem) -> GenerationResult:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay_s)
+        digest = hashlib.sha256(item.prompt.encode("utf-8")).digest()
+        row = digest[:3] * self.size
+        image = encode_png(PngHeader(self.size, self.size, 8, 2, 0), [row] * self.size)
+        return GenerationResult(
+            image=image,
+            meta={"backend": self.name, "prompt": item.prompt, "seed": item.seed},
+        )
+
+
+@dataclass
+class GenRequest:
+    id: str  # the workflow hash; identical requests share it
+    name: str
+    prompt: str
+    negative: str | None
+    seed: int | None
+    priority: int
+    out_path: Path
+    created: float = field(default_factory=time.time)
+    status: str = "queued"  # queued | running | done | failed
+    started: float | None = None
+    finished: float | None = None
+    backend: str = ""
+    error: str = ""
+    meta: Dict[str, Any] = field(default_factory=dict)
+    submissions: int = 1
+    version: int = 0  # bumped on every change, for streaming clients
+
+    def to_json(self) -> Dict[str, Any]:
+        prio = next(k for k, v in PRIORITIES.items() if v == self.priority)
+        out: Dict[str, Any] = {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "priority": prio,
+            "submissions": self.submissions,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if self.backend:
+            out["backend"] = self.backend
+        if self.status == "done":
+            out["image_url"] = f"/requests/{self.id}/image"
+            out["seed"] = self.meta.get("seed")
+        if self.error:
+            out["error"] = self.error
+        return out
+
+
+def workflow_hash(
+    fingerprint: str, prompt: str, negative: str | None, seed: int | None
+) -> str:
+    """Identity of a render: same backends + same inputs = same image."""
+    blob = json.dumps([fingerprint, prompt, negative, seed], separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:32]
+
+
+def _intact(path: Path) -> bool:
+    """Whether ``path`` holds a complete image (not missing or truncated)."""
+    try:
+        check_image(path.read_bytes())
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def parse_request(payload: Any) -> Tuple[str, str, str | None, int | None, int]:
+    if not isinstance(payload, dict):
+        raise ValueError("request body must be a JSON object")
+    unknown = sorted(k for k in payload if k not in REQUEST_KEYS)
+    if unknown:
+        raise ValueError(f"unknown keys: {', '.join(unknown)}")
+    prompt = str(payload.get("prompt") or "").strip()
+    if not prompt:
+        raise ValueError("prompt is required")
+    name = str(payload.get("name") or "").strip() or prompt[:40]
+    negative = payload.get("negative")
+    if negative is not None and not isinstance(negative, str):
+        raise ValueError("negative must be a string")
+    seed = payload.get("seed")
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int)):
+        raise ValueError("seed must be an integer")
+    prio_name = str(payload.get("priority") or "interactive")
+    if prio_name not in PRIORITIES:
+        raise ValueError(f"priority must be one of: {', '.join(PRIORITIES)}")
+    return name, prompt, negative, seed, PRIORITIES[prio_name]
+
+
+class GenerationDaemon:
+    """Priority queue of generation requests feeding long-lived backends.
+
+    Requests with the same workflow hash are coalesced: while one is queued,
+    running or done, resubmitting it returns the same entry. A bulk request
+    that gets resubmitted as interactive is promoted. Finished entries are
+    dropped ``keep_s`` after they finish.
+    """
+
+    def __init__(
+        self,
+        backends: Sequence[GenerationBackend],
+        *,
+        out_dir: Path,
+        keep_s: float = DEFAULT_KEEP_S,
+    ) -> None:
+        if not backends:
+            raise SystemExit("No generation backend configured")
+        self.backends = list(backends)
+        self.out_dir = out_dir
+        self.keep_s = keep_s
+        self.fingerprint = json.dumps(
+            sorted(json.dumps(b.render_settings(), sort_keys=True) for b in backends)
+        )
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[int, int, str]] = []
+        self._seq = itertools.count()
+        self._requests: Dict[str, GenRequest] = {}
+        self._stop = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        for lane, backend in enumerate(self.backends):
+            for _ in range(max(1, backend.slots)):
+                t = threading.Thread(
+                    target=self._worker, args=(lane, backend), daemon=True
+                )
+                t.start()
+                self._threads.append(t)
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        for b in self.backends:
+            b.close()
+
+    def _touch(self, req: GenRequest) -> None:
+        req.version += 1
+        self._cond.notify_all()
+
+    def _evict(self) -> None:
+        cutoff = time.time() - self.keep_s
+        old = [
+            rid
+            for rid, req in self._requests.items()
+            if req.status in TERMINAL and (req.finished or 0.0) < cutoff
+        ]
+        for rid in old:
+            del self._requests[rid]
+
+    def submit(self, payload: Any) -> Tuple[GenRequest, bool]:
+        """Queue a request; returns (entry, coalesced)."""
+        name, prompt, negative, seed, priority = parse_request(payload)
+        rid = workflow_hash(self.fingerprint, prompt, negative, seed)
+        out_path = self.out_dir / f"{rid}.png"
+        # Read before taking the lock; done images are written atomically.
+        on_disk = _intact(out_path)
+        with self._cond:
+            self._evict()
+            req = self._requests.get(rid)
+            if req is not None and req.status == "done" and not on_disk:
+                self._lost(req)
+            if req is not None and req.status != "failed":
+                req.submissions += 1
+                if req.status == "queued" and priority < req.priority:
+                    req.priority = priority
+                    heapq.heappush(self._heap, (priority, next(self._seq), rid))
+                self._touch(req)
+                return req, True
+
+            req = GenRequest(
+                id=rid,
+                name=name,
+                prompt=prompt,
+                negative=negative,
+                seed=seed,
+                priority=priority,
+                out_path=out_path,
+            )
+            self._requests[rid] = req
+            if on_disk:
+                # Rendered by an earlier daemon run with the same backends.
+                req.status = "done"
+                req.finished = time.time()
+            else:
+                heapq.heappush(self._heap, (priority, next(self._seq), rid))
+            self._touch(req)
+            return req, False
+
+    def get(self, rid: str) -> GenRequest | None:
+        with self._cond:
+            return self._requests.get(rid)
+
+    def image(self, req: GenRequest) -> bytes | None:
+        """A done request's image; None if the file has gone since, which
+        fails the request so that submitting it again renders it again."""
+        try:
+            return req.out_path.read_bytes()
+        except OSError:
+            with self._cond:
+                if req.status == "done":
+                    self._lost(req)
+            return None
+
+    def _lost(self, req: GenRequest) -> None:
+        req.status = "failed"
+        req.error = f"image {req.out_path.name} is gone"
+        req.finished = time.time()
+        self._touch(req)
+
+    def wait_for_change(
+        self, rid: str, version: int, timeout_s: float
+    ) -> Dict[str, Any] | None:
+        """Block until request ``rid`` moves past ``version``; return its state."""
+        deadline = time.monotonic() + timeout_s
+        with self._cond:
+            while True:
+                req = self._requests.get(rid)
+                if req is None:
+                    return None
+                if req.version != version:
+                    return {**req.to_json(), "version": req.version}
+                left = deadline - time.monotonic()
+                if left <= 0 or self._stop:
+                    return {**req.to_json(), "version": req.version}
+                self._cond.wait(left)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            counts: Dict[str, int] = {}
+            for req in self._requests.values():
+                counts[req.status] = counts.get(req.status, 0) + 1
+            return {
+                "requests": counts,
+                "backends": [
+                    {"name": b.name, "slots": max(1, b.slots)} for b in self.backends
+                ],
+            }
+
+    def _next(self) -> GenRequest | None:
+        with self._cond:
+            while not self._stop:
+                while self._heap:
+                    priority, _, rid = heapq.heappop(self._heap)
+                    req = self._requests.get(rid)
+                    # Promotions leave a stale heap entry behind (whose request
+                    # may since have finished and been dropped); skip it.
+                    if (
+                        req is not None
+                        and req.status == "queued"
+                        and req.priority == priority
+                    ):
+                        req.status = "running"
+                        req.started = time.time()
+                        self._touch(req)
+                        return req
+                self._cond.wait()
+            return None
+
+    def _worker(self, lane: int, backend: GenerationBackend) -> None:
+        while True:
+            req = self._next()
+            if req is None:
+                return
+            item = JobItem(
+                idx=1,
+                name=req.name,
+                prompt=req.prompt,
+                out_path=req.out_path,
+                negative=req.negative,
+                seed=req.seed,
+            )
+            try:
+                result = backend.generate(item)
+                image = result.image
+                if image[:8] == PNG_SIGNATURE:
+                    meta = {"backend": backend.name, **result.meta}
+                    image = embed_metadata(image, output_metadata(item, meta))
+                tmp = req.out_path.with_suffix(".tmp")
+                tmp.write_bytes(image)
+                tmp.replace(req.out_path)
+            except (Exception, SystemExit) as e:
+                with self._cond:
+                    req.status = "failed"
+                    req.error = str(e)
+                    req.backend = backend.name
+                    req.finished = time.time()
+                    self._touch(req)
+                continue
+            with self._cond:
+                req.status = "done"
+                req.backend = backend.name
+                req.meta = dict(result.meta)
+                req.finished = time.time()
+                self._touch(req)
+
+
+def _make_handler(daemon: GenerationDaemon) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        server_version = "dbu-imagegen"
+
+        def log_message(self, fmt: str, *args: Any) -> None:
+            pass
+
+        def _json(self, code: int, body: Mapping[str, Any]) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self) -> None:
+            if self.path != "/requests":
+                self._json(404, {"error": "not_found"})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b"null")
+                req, coalesced = daemon.submit(payload)
+            except ValueError as e:
+                self._json(400, {"error": str(e)})
+                return
+            self._json(
+                200 if coalesced else 201, {**req.to_json(), "coalesced": coalesced}
+            )
+
+        def do_GET(self) -> None:
+            parts = [p for p in self.path.split("?", 1)[0].split("/") if p]
+            if parts == ["status"]:
+                self._json(200, daemon.stats())
+                return
+            if len(parts) < 2 or parts[0] != "requests":
+                self._json(404, {"error": "not_found"})
+                return
+            req = daemon.get(parts[1])
+            if req is None:
+                self._json(404, {"error": "not_found"})
+                return
+            if len(parts) == 2:
+                self._json(200, req.to_json())
+            elif parts[2:] == ["image"] and req.status == "done":
+                data = daemon.image(req)
+                if data is None:
+                    self._json(410, {"error": "gone", **req.to_json()})
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(data)))
+                # The id is a content hash of the inputs: safe to cache forever.
+                self.send_header("Cache-Control", "max-age=31536000, immutable")
+                self.end_headers()
+                self.wfile.write(data)
+            elif parts[2:] == ["events"]:
+                self._stream(req.id)
+            else:
+                self._json(404, {"error": "not_found"})
+
+        def _stream(self, rid: str) -> None:
+            # Server-sent events: one "data:" line per status change, closed
+            # once the request is done or failed.
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            version = -1
+            while True:
+                state = daemon.wait_for_change(rid, version, timeout_s=15.0)
+                if state is None:
+                    return
+                try:
+                    if state["version"] == version:
+                        self.wfile.write(b": keep-alive\n\n")
+                    else:
+                        version = state["version"]
+                        line = json.dumps(state)
+                        self.wfile.write(f"data: {line}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                if state["status"] in TERMINAL:
+                    return
+
+    return Handler
+
+
+def make_server(daemon: GenerationDaemon, host: str, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _make_handler(daemon))
+    server.daemon_threads = True
+    return server
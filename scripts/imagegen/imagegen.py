@@ -0,0 +1,645 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+SCRIPTS_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(SCRIPTS_DIR / "comfyui"))
+sys.path.insert(0, str(SCRIPTS_DIR / "ollama"))
+
+import asset_index  # noqa: E402
+import comfyui_lib  # noqa: E402
+import daemon  # noqa: E402
+import png_optimize  # noqa: E402
+import png_tools  # noqa: E402
+import ollama_lib  # noqa: E402
+import status  # noqa: E402
+import verify  # noqa: E402
+from progress import read_progress  # noqa: E402
+from portrait_index import print_publish_report, publish_portraits  # noqa: E402
+from tracing import session  # noqa: E402
+from imagegen_lib import (  # noqa: E402
+    DEFAULT_ASSET_DB,
+    DEFAULT_OPTIMIZE_LEDGER,
+    DEFAULT_PROGRESS_DIR,
+    DEFAULT_VERIFY_CACHE,
+    OUTPUT_KEYS,
+    PUBLISH_KEYS,
+    RETRY_KEYS,
+    ROOT_DIR,
+    FailedItem,
+    GenerationBackend,
+    JobOutcome,
+    embed_output_metadata,
+    fail_unknown_keys,
+    job_items_from_cfg,
+    load_data_file,
+    open_progress,
+    open_timings,
+    print_job_plan,
+    optimize_job_outputs,
+    publish_job_outputs,
+    retry_policy_from_cfg,
+    run_job,
+    validate_job_config,
+)
+
+BACKEND_TYPES = ("comfyui", "ollama")
+
+BACKEND_GENERATE_KEYS = {
+    "comfyui": comfyui_lib.GENERATE_KEYS,
+    "ollama": ollama_lib.GENERATE_KEYS,
+}
+
+# Shared generate.* keys are copied into every backend. `seed` is excluded
+# because the two backends use different seed shapes.
+SHARED_GENERATE_KEYS = (comfyui_lib.GENERATE_KEYS | ollama_lib.GENERATE_KEYS) - {"seed"}
+
+
+def _merged_backend_cfg(
+    entry: Dict[str, Any], shared_gen: Dict[str, Any]
+) -> Dict[str, Any]:
+    gen_raw = entry.get("generate")
+    gen = dict(shared_gen)
+    gen.update(gen_raw if isinstance(gen_raw, dict) else {})
+    out = {k: v for k, v in entry.items() if k != "type"}
+    out["generate"] = gen
+    return out
+
+
+def validate_mixed_job_config(cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Validate a multi-backend job; return one merged config per backend."""
+    validate_job_config(
+        cfg,
+        top_keys={
+            "version",
+            "generate",
+            "backends",
+            "source",
+            "items",
+            "matrix",
+            "output",
+            "publish",
+            "retry",
+        },
+        sections={
+            "generate": set(SHARED_GENERATE_KEYS),
+            "source": {"type", "path"},
+            "output": OUTPUT_KEYS,
+            "publish": PUBLISH_KEYS,
+            "retry": RETRY_KEYS,
+        },
+    )
+    backends = cfg.get("backends")
+    if not isinstance(backends, list) or not backends:
+        raise SystemExit("backends must be a non-empty array")
+
+    for i, entry in enumerate(backends):
+        where = f"backends[{i}]"
+        if not isinstance(entry, dict):
+            raise SystemExit(f"{where} must be an object")
+        if entry.get("type") not in BACKEND_TYPES:
+            raise SystemExit(f"{where}.type must be one of: {', '.join(BACKEND_TYPES)}")
+
+    # A shared key has to mean the same on every backend of the job, or items
+    # would render differently depending on where they land.
+    gen_raw = cfg.get("generate")
+    shared_gen = gen_raw if isinstance(gen_raw, dict) else {}
+    types = sorted({entry["type"] for entry in backends})
+    for key in sorted(shared_gen):
+        missing = [t for t in types if key not in BACKEND_GENERATE_KEYS[t]]
+        if missing:
+            raise SystemExit(
+                f"generate.{key} isn't supported by {', '.join(missing)}; "
+                "set it in the generate section of the backends that use it"
+            )
+
+    merged: List[Dict[str, Any]] = []
+    for i, entry in enumerate(backends):
+        where = f"backends[{i}]"
+        btype = entry["type"]
+        job_level = [
+            k
+            for k in ("source", "items", "matrix", "output", "publish", "retry")
+            if k in entry
+        ]
+        if job_level:
+            fail_unknown_keys(where, job_level)
+        merged_cfg = _merged_backend_cfg(entry, shared_gen)
+        if btype == "comfyui":
+            comfyui_lib.validate_job_config(merged_cfg)
+        else:
+            ollama_lib.validate_job_config(merged_cfg)
+        merged_cfg["type"] = btype
+        merged.append(merged_cfg)
+    return merged
+
+
+def build_backend(cfg: Dict[str, Any]) -> GenerationBackend:
+    if cfg["type"] == "comfyui":
+        return comfyui_lib.comfyui_backend_from_cfg(
+            cfg,
+            server="http://127.0.0.1:8188",
+            comfy_dir=ROOT_DIR / "tools/ComfyUI",
+            extra_model_paths=SCRIPTS_DIR / "comfyui/extra_model_paths.yaml",
+        )
+    ollama_lib.ensure_ollama_present(auto_install=False)
+    return ollama_lib.ollama_backend_from_cfg(cfg)
+
+
+def timing_lane(cfg: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+    # Same keys/slots the built backend would report, without contacting it.
+    gen = cfg.get("generate") or {}
+    if cfg["type"] == "comfyui":
+        return comfyui_lib.comfyui_timing_key(cfg), int(gen.get("concurrency") or 1)
+    slots = gen.get("concurrency") or len(cfg.get("hosts") or []) or 1
+    return ollama_lib.ollama_timing_key(cfg), int(slots)
+
+
+def cmd_generate(args: argparse.Namespace) -> int:
+    cfg = load_data_file(Path(args.job))
+    if not isinstance(cfg, dict):
+        raise SystemExit("Job config must be an object at top-level")
+    backend_cfgs = validate_mixed_job_config(cfg)
+
+    out_raw = cfg.get("output")
+    out_cfg = out_raw if isinstance(out_raw, dict) else {}
+    out_dir = Path(out_cfg.get("dir") or str(args.out)).resolve()
+    out_ext = str(out_cfg.get("ext") or "png").lstrip(".")
+    overwrite = bool(out_cfg.get("overwrite") or False)
+
+    items = job_items_from_cfg(cfg)
+    timings = open_timings(args.timings_db, disabled=args.no_timings)
+    if args.dry_run:
+        print_job_plan(
+            items,
+            [timing_lane(c) for c in backend_cfgs],
+            out_dir=out_dir,
+            out_ext=out_ext,
+            overwrite=overwrite,
+            timings=timings,
+        )
+        return 0
+
+    backends = [build_backend(c) for c in backend_cfgs]
+    per_backend: Dict[str, int] = {}
+    failures: List[FailedItem] = []
+
+    def count_outcome(o: JobOutcome) -> None:
+        per_backend[o.backend] = per_backend.get(o.backend, 0) + 1
+
+    progress = open_progress(Path(args.job).name)
+    try:
+        run_job(
+            items,
+            backends,
+            out_dir=out_dir,
+            out_ext=out_ext,
+            overwrite=overwrite,
+            timings=timings,
+            on_outcome=count_outcome,
+            retry=retry_policy_from_cfg(cfg, attempts=args.attempts),
+            keep_going=args.keep_going,
+            on_failure=failures.append,
+            metadata=embed_output_metadata(cfg),
+            progress=progress,
+        )
+    finally:
+        progress.close()
+        for b in backends:
+            b.close()
+        if timings is not None:
+            timings.close()
+
+    for name, count in sorted(per_backend.items()):
+        print(f"- {name}: {count} image(s)")
+    optimize_job_outputs(cfg, out_dir=out_dir)
+    publish_job_outputs(cfg, out_dir=out_dir, out_ext=out_ext)
+    print(f"Done. Wrote outputs to: {out_dir}")
+    return 1 if failures else 0
+
+
+def cmd_publish(args: argparse.Namespace) -> int:
+    src_dir = Path(args.src).resolve()
+    if not src_dir.is_dir():
+        raise SystemExit(f"Not a directory: {src_dir}")
+    pack_dir = Path(args.pack).resolve()
+    report = publish_portraits(
+        src_dir,
+        pack_dir,
+        section=args.section,
+        ext=args.ext.lstrip("."),
+        prune=not args.no_prune,
+    )
+    print_publish_report(report, pack_dir)
+    return 0
+
+
+def _rel(path: str) -> str:
+    try:
+        return str(Path(path).relative_to(ROOT_DIR))
+    except ValueError:
+        return path
+
+
+def cmd_dedup(args: argparse.Namespace) -> int:
+    roots = [Path(r) for r in args.roots] or [
+        ROOT_DIR / "assets",
+        ROOT_DIR / "content-packs",
+    ]
+    index = asset_index.AssetIndex(Path(args.db))
+    try:
+        hashed = index.refresh(roots, workers=args.workers)
+        print(
+            f"Indexed {len(asset_index.iter_image_files(roots))} image(s), {hashed} (re)hashed"
+        )
+
+        if args.check:
+            data = Path(args.check).read_bytes()
+            matches = index.similar(data, max_distance=args.max_distance)
+            for dist, path in matches:
+                print(f"similar (distance {dist}): {_rel(path)}")
+            if not matches:
+                print("No similar image indexed")
+            return 0
+
+        exact = index.exact_clusters(roots)
+        similar = index.similar_clusters(roots, max_distance=args.max_distance)
+        wasted = 0
+        for cluster in exact:
+            size = Path(cluster[0]).stat().st_size
+            wasted += size * (len(cluster) - 1)
+            print(f"identical ({len(cluster)} copies, {size} bytes each):")
+            for path in cluster:
+                print(f"  {_rel(path)}")
+        for cluster in similar:
+            print(f"near-identical ({len(cluster)} files):")
+            for path in cluster:
+                print(f"  {_rel(path)}")
+        print(
+            f"{len(exact)} identical cluster(s) ({wasted} duplicate bytes), "
+            f"{len(similar)} near-identical cluster(s)"
+        )
+
+        if args.link:
+            done = asset_index.link_duplicates(exact)
+            print(f"Hardlinked {len(done)} duplicate(s)")
+        elif args.refs:
+            done = asset_index.reference_duplicates(exact, Path(args.refs))
+            print(f"Removed {len(done)} duplicate(s); references in {args.refs}")
+    finally:
+        index.close()
+    return 0
+
+
+def cmd_optimize(args: argparse.Namespace) -> int:
+    paths = [Path(p) for p in args.paths] or [ROOT_DIR / "assets/portraits"]
+    ledger = None if args.no_ledger else png_optimize.OptimizeLedger(Path(args.ledger))
+    try:
+        results = png_optimize.optimize_pngs(paths, ledger=ledger, workers=args.workers)
+    finally:
+        if ledger is not None:
+            ledger.close()
+    png_optimize.print_optimize_report(results)
+    return 1 if any(r.status == "error" for r in results) else 0
+
+
+def cmd_inspect(args: argparse.Namespace) -> int:
+    paths = [Path(p) for p in args.paths] or [ROOT_DIR / "assets/portraits"]
+    started = time.perf_counter()
+    files = png_optimize.iter_pngs(paths)
+    missing = 0
+    for path in files:
+        try:
+            meta = png_tools.read_metadata(path)
+        except (png_tools.PngError, ValueError) as e:
+            print(f"ERROR: {path}: {e}", file=sys.stderr)
+            missing += 1
+            continue
+        if meta is None:
+            missing += 1
+            if not args.jsonl:
+                print(f"{path}: (no generation metadata)")
+            continue
+        if args.jsonl:
+            print(json.dumps({"path": str(path), **meta}, ensure_ascii=False))
+        else:
+            print(f"{path}: {json.dumps(meta, ensure_ascii=False)}")
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(
+        f"Scanned {len(files)} PNG(s) in {elapsed_ms:.0f} ms; "
+        f"{len(files) - missing} with metadata",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def cmd_verify(args: argparse.Namespace) -> int:
+    packs = sorted(p for p in (ROOT_DIR / "content-packs").iterdir() if p.is_dir())
+    roots = [Path(r) for r in args.roots] or [ROOT_DIR / "assets/portraits"] + [
+        p / "assets" for p in packs
+    ]
+    cache = None if args.no_cache else verify.VerifyCache(Path(args.cache))
+    started = time.perf_counter()
+    try:
+        results = verify.verify_tree(
+            roots, packs=packs, cache=cache, deep=args.deep, workers=args.workers
+        )
+    finally:
+        if cache is not None:
+            cache.close()
+    verify.print_verify_report(results)
+    print(
+        f"Verified in {time.perf_counter() - started:.2f}s",
+        file=sys.stderr,
+    )
+
+    corrupt = [r for r in results if r.status == "corrupt"]
+    if args.requeue and corrupt:
+        # Only files that made it into the requeue file are deleted; the rest
+        # (no embedded metadata, not a PNG) would be lost for good.
+        requeued = []
+        with Path(args.requeue).open("a", encoding="utf-8") as f:
+            for r in corrupt:
+                entry = verify.requeue_entry(r)
+                if entry is not None:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    requeued.append(r)
+        print(
+            f"Requeued {len(requeued)} of {len(corrupt)} corrupt file(s) "
+            f"to {args.requeue}"
+        )
+        for r in corrupt:
+            if r not in requeued:
+                print(f"NOT REQUEUED (kept): {r.path}")
+        corrupt = requeued
+    if (args.delete or args.requeue) and corrupt:
+        for r in corrupt:
+            Path(r.path).unlink(missing_ok=True)
+        print(f"Deleted {len(corrupt)} corrupt file(s)")
+    return 1 if any(r.status not in ("ok", "cached") for r in results) else 0
+
+
+def cmd_status(args: argparse.Namespace) -> int:
+    # Redraw in place on a terminal; print plain snapshots when piped.
+    clear = "\x1b[H\x1b[2J" if sys.stdout.isatty() and not args.once else ""
+    try:
+        while True:
+            runners = read_progress(DEFAULT_PROGRESS_DIR)
+            servers = status.servers_in_use(runners, args.server)
+            if not servers and not runners:
+                servers = ["http://127.0.0.1:8188"]
+            view = status.render_status(
+                runners, [status.poll_server(s) for s in servers], now=time.time()
+            )
+            print(clear + view, flush=True)
+            if args.once:
+                return 0
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+def cmd_serve(args: argparse.Namespace) -> int:
+    if args.stand_in:
+        backends: List[GenerationBackend] = [
+            daemon.StandInBackend(
+                slots=args.stand_in_slots, delay_s=args.stand_in_delay_s
+            )
+        ]
+    elif args.config:
+        cfg = load_data_file(Path(args.config))
+        if not isinstance(cfg, dict):
+            raise SystemExit("Config must be an object at top-level")
+        backends = [build_backend(c) for c in validate_mixed_job_config(cfg)]
+    else:
+        raise SystemExit("serve requires --config <file> or --stand-in")
+
+    service = daemon.GenerationDaemon(
+        backends, out_dir=Path(args.out).resolve(), keep_s=args.keep_s
+    )
+    service.start()
+    server = daemon.make_server(service, args.host, args.port)
+    names = ", ".join(f"{b.name} x{max(1, b.slots)}" for b in backends)
+    print(f"Serving on http://{args.host}:{server.server_address[1]} ({names})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+    return 0
+
+
+def main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(
+        description="Dragonbane Unbound multi-backend image job runner"
+    )
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    trace = argparse.ArgumentParser(add_help=False)
+    trace.add_argument(
+        "--trace",
+        default=None,
+        metavar="FILE",
+        help="Write timing spans as Chrome trace JSON (open in ui.perfetto.dev)",
+    )
+
+    p_gen = sub.add_parser(
+        "generate",
+        parents=[trace],
+        help="Run one job across several ComfyUI/Ollama backends",
+    )
+    p_gen.add_argument("--job", required=True, help="Job config (.json/.yaml)")
+    p_gen.add_argument("--out", default=str(ROOT_DIR / "assets/portraits/kins"))
+    p_gen.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the plan and a time estimate from past runs; generate nothing",
+    )
+    p_gen.add_argument(
+        "--timings-db",
+        default=None,
+        help="SQLite file with generation timings (default: tools/imagegen/timings.sqlite)",
+    )
+    p_gen.add_argument(
+        "--no-timings", action="store_true", help="Do not read or record timings"
+    )
+    p_gen.add_argument(
+        "--attempts",
+        type=int,
+        default=None,
+        help="Tries per item before it counts as failed (default: retry.attempts or 3)",
+    )
+    p_gen.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="Don't stop at a failed item; report failures and exit 1 at the end",
+    )
+    p_gen.set_defaults(func=cmd_generate)
+
+    p_pub = sub.add_parser(
+        "publish", help="Copy generated portraits into a content pack and reindex it"
+    )
+    p_pub.add_argument(
+        "--from",
+        dest="src",
+        default=str(ROOT_DIR / "assets/portraits/kins"),
+        help="Directory with generated images",
+    )
+    p_pub.add_argument("--pack", default=str(ROOT_DIR / "content-packs/core"))
+    p_pub.add_argument(
+        "--section", default="kins", help="Index map to update (default: kins)"
+    )
+    p_pub.add_argument("--ext", default="png")
+    p_pub.add_argument(
+        "--no-prune",
+        action="store_true",
+        help="Keep index entries whose file is missing",
+    )
+    p_pub.set_defaults(func=cmd_publish)
+
+    p_dedup = sub.add_parser(
+        "dedup",
+        help="Index asset images by sha256 + perceptual hash; report duplicates",
+    )
+    p_dedup.add_argument(
+        "roots",
+        nargs="*",
+        help="Files/directories to index, canonical copies first (default: assets content-packs)",
+    )
+    p_dedup.add_argument("--db", default=str(DEFAULT_ASSET_DB))
+    p_dedup.add_argument(
+        "--max-distance",
+        type=int,
+        default=asset_index.DEFAULT_MAX_DISTANCE,
+        help="Perceptual hash bit distance that still counts as near-identical",
+    )
+    p_dedup.add_argument("--workers", type=int, default=None)
+    p_dedup.add_argument(
+        "--check", default=None, help="Only list indexed images similar to this file"
+    )
+    act = p_dedup.add_mutually_exclusive_group()
+    act.add_argument(
+        "--link",
+        action="store_true",
+        help="Replace byte-identical copies with hardlinks to the canonical file",
+    )
+    act.add_argument(
+        "--refs",
+        default=None,
+        help="Delete byte-identical copies and record them in this JSON file",
+    )
+    p_dedup.set_defaults(func=cmd_dedup)
+
+    p_opt = sub.add_parser(
+        "optimize", help="Losslessly recompress PNGs in parallel and report bytes saved"
+    )
+    p_opt.add_argument(
+        "paths", nargs="*", help="PNG files/directories (default: assets/portraits)"
+    )
+    p_opt.add_argument("--workers", type=int, default=None)
+    p_opt.add_argument(
+        "--ledger",
+        default=str(DEFAULT_OPTIMIZE_LEDGER),
+        help="SQLite ledger of already-optimized file hashes",
+    )
+    p_opt.add_argument("--no-ledger", action="store_true", help="Reprocess every file")
+    p_opt.set_defaults(func=cmd_optimize)
+
+    p_inspect = sub.add_parser(
+        "inspect", help="Print the generation metadata embedded in PNG outputs"
+    )
+    p_inspect.add_argument(
+        "paths", nargs="*", help="PNG files/directories (default: assets/portraits)"
+    )
+    p_inspect.add_argument(
+        "--jsonl", action="store_true", help="One JSON object per line, with path"
+    )
+    p_inspect.set_defaults(func=cmd_inspect)
+
+    p_verify = sub.add_parser(
+        "verify",
+        help="Check image files for corruption and against recorded hashes",
+    )
+    p_verify.add_argument(
+        "roots",
+        nargs="*",
+        help="Files/directories (default: assets/portraits and content-packs/*/assets)",
+    )
+    p_verify.add_argument("--workers", type=int, default=None)
+    p_verify.add_argument(
+        "--deep",
+        action="store_true",
+        help="Also inflate PNG image data (slower; catches corrupt deflate streams)",
+    )
+    p_verify.add_argument(
+        "--cache",
+        default=str(DEFAULT_VERIFY_CACHE),
+        help="SQLite cache of files already found intact (by size + mtime)",
+    )
+    p_verify.add_argument("--no-cache", action="store_true", help="Check every file")
+    fix = p_verify.add_mutually_exclusive_group()
+    fix.add_argument(
+        "--delete",
+        action="store_true",
+        help="Delete corrupt files so the next generate run renders them again",
+    )
+    fix.add_argument(
+        "--requeue",
+        default=None,
+        help="Append corrupt PNGs' name/prompt to this JSONL source and delete "
+        "those; corrupt files that can't be requeued are kept",
+    )
+    p_verify.set_defaults(func=cmd_verify)
+
+    p_status = sub.add_parser(
+        "status", help="Live view of running jobs and ComfyUI server load"
+    )
+    p_status.add_argument(
+        "--server",
+        action="append",
+        default=[],
+        help="ComfyUI server to watch besides the ones running jobs use (repeatable)",
+    )
+    p_status.add_argument("--interval", type=float, default=2.0, help="Seconds")
+    p_status.add_argument("--once", action="store_true", help="Print once and exit")
+    p_status.set_defaults(func=cmd_status)
+
+    p_serve = sub.add_parser(
+        "serve", help="Run a local generation service with an HTTP API"
+    )
+    p_serve.add_argument(
+        "--config", default=None, help="Backends config (same format as mixed jobs)"
+    )
+    p_serve.add_argument(
+        "--stand-in",
+        action="store_true",
+        help="Use a built-in backend that renders flat PNGs (no GPU; for tests)",
+    )
+    p_serve.add_argument("--stand-in-slots", type=int, default=1)
+    p_serve.add_argument("--stand-in-delay-s", type=float, default=0.5)
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=8765)
+    p_serve.add_argument("--out", default=str(ROOT_DIR / "tools/imagegen/daemon"))
+    p_serve.add_argument(
+        "--keep-s",
+        type=float,
+        default=daemon.DEFAULT_KEEP_S,
+        help="Forget finished requests this long after they finish",
+    )
+    p_serve.set_defaults(func=cmd_serve)
+
+    args = ap.parse_args(argv)
+    with session(getattr(args, "trace", None), f"imagegen {args.cmd}"):
+        return int(args.func(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
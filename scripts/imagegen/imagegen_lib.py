@@ -0,0 +1,1325 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import glob
+import hashlib
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import asdict, dataclass, field, replace
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Sequence,
+    Sized,
+    Tuple,
+    Union,
+)
+
+from concurrency import AimdController
+from png_optimize import OptimizeLedger, optimize_pngs, print_optimize_report
+from png_tools import PNG_SIGNATURE, embed_metadata
+from portrait_index import print_publish_report, publish_portraits, write_json_atomic
+from progress import ProgressFile
+from timing_db import TimingDB, estimate_s, format_duration
+from tracing import current_id, span
+from work_queue import DEFAULT_LEASE_S, WorkQueue
+
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+
+DEFAULT_TIMINGS_DB = ROOT_DIR / "tools/imagegen/timings.sqlite"
+
+DEFAULT_ASSET_DB = ROOT_DIR / "tools/imagegen/assets.sqlite"
+
+DEFAULT_OPTIMIZE_LEDGER = ROOT_DIR / "tools/imagegen/optimized.sqlite"
+
+DEFAULT_VERIFY_CACHE = ROOT_DIR / "tools/imagegen/verified.sqlite"
+
+# One progress file per running runner, read by `imagegen.py status`.
+DEFAULT_PROGRESS_DIR = ROOT_DIR / "tools/imagegen/progress"
+
+# Item leases shared by runners working on the same job (--work-queue).
+DEFAULT_WORK_QUEUE = ROOT_DIR / "tools/imagegen/work_queue.sqlite"
+
+# How many of this run's own timings per backend feed the ETA fallback.
+HISTORY_SAMPLES = 50
+
+# After an abort (a failure, Ctrl-C), how long workers still busy with a
+# render get to wind down before the run stops waiting for them.
+ABORT_JOIN_S = 10.0
+
+DEFAULT_KIN_PROMPTS_MD = (
+    ROOT_DIR / "docs/character_creation/kin-profile-portrait-prompts.md"
+)
+
+
+def slugify(name: str) -> str:
+    s = name.strip().lower()
+    s = re.sub(r"\s+", "_", s)
+    s = re.sub(r"[^a-z0-9_]+", "", s)
+    s = re.sub(r"_+", "_", s).strip("_")
+    return s or "image"
+
+
+@dataclass(frozen=True)
+class PromptItem:
+    name: str
+    prompt: str
+    source: str = ""
+    source_idx: int = 0
+    # Set by matrix expansion; None means the backend's own setting applies.
+    negative: str | None = None
+    seed: int | None = None
+    subdir: str = ""
+
+
+def read_kin_prompts_md(md_path: Path) -> List[PromptItem]:
+    text = md_path.read_text(encoding="utf-8")
+    lines = text.splitlines()
+
+    prompts: List[PromptItem] = []
+    current_name: str | None = None
+    in_code = False
+    buf: List[str] = []
+
+    def flush() -> None:
+        nonlocal current_name, buf
+        if current_name and buf:
+            prompt_text = "\n".join(buf).strip()
+            if prompt_text:
+                prompts.append(PromptItem(name=current_name, prompt=prompt_text))
+        buf = []
+
+    for line in lines:
+        m = re.match(r"^##\s+(.+?)\s*$", line)
+        if m and not in_code:
+            flush()
+            current_name = m.group(1).strip()
+            continue
+
+        if line.strip().startswith("```"):
+            in_code = not in_code
+            if in_code:
+                buf = []
+            continue
+
+        if in_code:
+            buf.append(line)
+
+    flush()
+    return prompts
+
+
+def load_data_file(path: Path) -> Dict[str, Any]:
+    with span("config.load", path=str(path)):
+        return _load_data_file(path)
+
+
+def _load_data_file(path: Path) -> Dict[str, Any]:
+    suffix = path.suffix.lower()
+    if suffix == ".json":
+        return json.loads(path.read_text(encoding="utf-8"))
+    if suffix in {".yaml", ".yml"}:
+        try:
+            import yaml  # type: ignore
+        except Exception as e:
+            # Prefer not to require PyYAML in the system python. If available,
+            # parse using the ComfyUI venv python (setup installs PyYAML there).
+            venv_py = ROOT_DIR / "tools/ComfyUI/.venv/bin/python"
+            if not venv_py.exists():
+                venv_py = ROOT_DIR / "tools/ComfyUI/.venv/Scripts/python.exe"
+            if venv_py.exists():
+                code = (
+                    "import sys, json; from pathlib import Path; "
+                    "import yaml; "
+                    "data=yaml.safe_load(Path(sys.argv[1]).read_text(encoding='utf-8')); "
+                    "print(json.dumps(data or {}))"
+                )
+                try:
+                    out = subprocess.check_output(
+                        [str(venv_py), "-c", code, str(path)], text=True
+                    )
+                    data2 = json.loads(out)
+                    if not isinstance(data2, dict):
+                        raise SystemExit(
+                            f"Config must be an object at top-level: {path}"
+                        )
+                    return data2
+                except Exception as e2:
+                    raise SystemExit(
+                        "Failed to parse YAML via ComfyUI venv. Try rerunning setup:\n"
+                        "  python3 scripts/comfyui/comfyui.py setup\n"
+                        f"Error: {e2}"
+                    )
+
+            raise SystemExit(
+                "YAML config requires PyYAML. Use JSON, or install PyYAML in your python\n"
+                "(python3 scripts/comfyui/comfyui.py setup installs it in the ComfyUI venv).\n"
+                f"Import error: {e}"
+            )
+
+        data = yaml.safe_load(path.read_text(encoding="utf-8"))
+        if data is None:
+            return {}
+        if not isinstance(data, dict):
+            raise SystemExit(f"Config must be an object at top-level: {path}")
+        return data
+    raise SystemExit(f"Unsupported config type: {path} (use .json/.yaml)")
+
+
+def fail_unknown_keys(where: str, unknown: Iterable[str]) -> None:
+    unknown_sorted = ", ".join(sorted(unknown))
+    raise SystemExit(f"Unknown/disallowed keys at {where}: {unknown_sorted}")
+
+
+def validate_obj(obj: Any, allowed: set[str], where: str) -> None:
+    if obj is None:
+        return
+    if not isinstance(obj, dict):
+        raise SystemExit(f"Expected object at {where}")
+    unknown = [k for k in obj.keys() if k not in allowed]
+    if unknown:
+        fail_unknown_keys(where, unknown)
+
+
+def validate_job_config(
+    cfg: Mapping[str, Any],
+    *,
+    top_keys: set[str],
+    sections: Mapping[str, set[str]],
+) -> None:
+    """Check a job config against a backend's key schema.
+
+    ``sections`` maps dotted paths (``"generate"``, ``"generate.seed"``) to
+    the keys allowed in the object found there. ``items[]`` is always checked
+    for ``name``/``prompt`` objects.
+    """
+    unknown = [k for k in cfg.keys() if k not in top_keys]
+    if unknown:
+        fail_unknown_keys("root", unknown)
+
+    for where, allowed in sections.items():
+        obj: Any = cfg
+        for part in where.split("."):
+            obj = obj.get(part) if isinstance(obj, dict) else None
+        validate_obj(obj, allowed, where)
+
+    if "matrix" in cfg:
+        validate_matrix(cfg["matrix"])
+
+    items = cfg.get("items")
+    if items is not None:
+        if not isinstance(items, list):
+            raise SystemExit("items must be an array")
+        for i, it in enumerate(items):
+            if not isinstance(it, dict):
+                raise SystemExit(f"items[{i}] must be an object")
+            unknown3 = [k for k in it.keys() if k not in {"name", "prompt"}]
+            if unknown3:
+                fail_unknown_keys(f"items[{i}]", unknown3)
+
+
+def _iter_jsonl_items(path: Path) -> Iterator[PromptItem]:
+    # One {"name": ..., "prompt": ...} object per line; read line by line so a
+    # 100k-item catalog never sits in memory at once.
+    label = path.name
+    n = 0
+    with path.open("r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise SystemExit(f"{path}:{lineno}: invalid JSON: {e}")
+            if not isinstance(obj, dict):
+                raise SystemExit(f"{path}:{lineno}: expected an object")
+            unknown = [k for k in obj.keys() if k not in {"name", "prompt"}]
+            if unknown:
+                fail_unknown_keys(f"{path}:{lineno}", unknown)
+            name = str(obj.get("name") or "").strip()
+            prompt = str(obj.get("prompt") or "").strip()
+            if not name or not prompt:
+                raise SystemExit(f"{path}:{lineno}: each item requires name and prompt")
+            n += 1
+            yield PromptItem(name=name, prompt=prompt, source=label, source_idx=n)
+
+
+def _iter_markdown_glob_items(pattern: str) -> Iterator[PromptItem]:
+    paths = sorted(glob.glob(pattern, recursive=True))
+    if not paths:
+        raise SystemExit(f"source.path matched no files: {pattern}")
+    for p in paths:
+        # Files are parsed one at a time, only when the runner gets to them.
+        for n, it in enumerate(read_kin_prompts_md(Path(p)), start=1):
+            yield PromptItem(
+                name=it.name, prompt=it.prompt, source=Path(p).name, source_idx=n
+            )
+
+
+MATRIX_STYLE_KEYS = {"name", "prompt_prefix", "negative"}
+
+
+def validate_matrix(matrix: Any) -> None:
+    validate_obj(matrix, {"styles", "seeds"}, "matrix")
+    if not isinstance(matrix, dict):
+        return
+    styles = matrix.get("styles")
+    if styles is not None:
+        if not isinstance(styles, list) or not styles:
+            raise SystemExit("matrix.styles must be a non-empty array")
+        subdirs: Dict[str, str] = {}
+        for i, st in enumerate(styles):
+            where = f"matrix.styles[{i}]"
+            validate_obj(st, MATRIX_STYLE_KEYS, where)
+            if not isinstance(st, dict):
+                raise SystemExit(f"{where} must be an object")
+            name = str(st.get("name") or "").strip()
+            if not name:
+                raise SystemExit(f"{where} requires name")
+            sub = slugify(name)
+            if sub in subdirs:
+                raise SystemExit(
+                    f"matrix styles '{subdirs[sub]}' and '{name}' share directory {sub}"
+                )
+            subdirs[sub] = name
+    seeds = matrix.get("seeds")
+    if seeds is not None:
+        if not isinstance(seeds, list) or not seeds:
+            raise SystemExit("matrix.seeds must be a non-empty array")
+        for i, seed in enumerate(seeds):
+            if isinstance(seed, bool) or not isinstance(seed, int):
+                raise SystemExit(f"matrix.seeds[{i}] must be an integer")
+
+
+def expand_matrix(
+    items: Iterable[PromptItem], matrix: Mapping[str, Any]
+) -> Iterator[PromptItem]:
+    """Combine every item with each style preset and seed, lazily.
+
+    Combinations are yielded item by item, so all styles of one prompt are
+    queued next to each other. A combination identical to one already yielded
+    (same prompt text, negative and seed, e.g. two styles with the same
+    prefix) is dropped. Each style writes to its own subdirectory.
+    """
+    styles = matrix.get("styles") or [{"name": ""}]
+    seeds: List[int | None] = list(matrix.get("seeds") or [None])
+    seen: set[bytes] = set()
+    for it in items:
+        for st in styles:
+            prefix = str(st.get("prompt_prefix") or "").strip()
+            prompt = f"{prefix} {it.prompt}".strip() if prefix else it.prompt
+            negative = st.get("negative")
+            style_name = str(st.get("name") or "")
+            for seed in seeds:
+                # Only a digest per combination is kept, not the prompt text.
+                digest = hashlib.sha1(
+                    json.dumps([it.name, prompt, negative, seed]).encode("utf-8")
+                ).digest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                yield PromptItem(
+                    name=it.name,
+                    prompt=prompt,
+                    source=it.source,
+                    source_idx=it.source_idx,
+                    negative=str(negative) if negative is not None else None,
+                    seed=seed,
+                    subdir=slugify(style_name) if style_name else "",
+                )
+
+
+def job_items_from_cfg(cfg: Mapping[str, Any]) -> Iterable[PromptItem]:
+    """Items a job config describes, expanded by its ``matrix`` block if any.
+
+    Inline ``items`` and a single markdown file come back as a list; the
+    streaming sources (``jsonl``, ``prompts_markdown_glob``) and matrix jobs
+    come back as a generator that is evaluated lazily.
+    """
+    items = _source_items(cfg)
+    matrix = cfg.get("matrix")
+    if isinstance(matrix, dict):
+        return expand_matrix(items, matrix)
+    return items
+
+
+def _source_items(cfg: Mapping[str, Any]) -> Iterable[PromptItem]:
+    items = cfg.get("items")
+    if isinstance(items, list):
+        out: List[PromptItem] = []
+        for it in items:
+            if not isinstance(it, dict):
+                raise SystemExit("items must contain objects")
+            name = str(it.get("name") or "").strip()
+            prompt = str(it.get("prompt") or "").strip()
+            if not name or not prompt:
+                raise SystemExit("each item requires name and prompt")
+            out.append(PromptItem(name=name, prompt=prompt))
+        return out
+
+    source = cfg.get("source")
+    if isinstance(source, dict):
+        stype = str(source.get("type") or "").strip()
+        if stype == "kin_prompts_markdown":
+            md_path = source.get("path") or str(DEFAULT_KIN_PROMPTS_MD)
+            return read_kin_prompts_md(Path(md_path))
+        if stype in {"jsonl", "prompts_markdown_glob"}:
+            path = str(source.get("path") or "").strip()
+            if not path:
+                raise SystemExit(f"source.type={stype} requires source.path")
+            if stype == "jsonl":
+                if not Path(path).is_file():
+                    raise SystemExit(f"source.path not found: {path}")
+                return _iter_jsonl_items(Path(path))
+            return _iter_markdown_glob_items(path)
+        raise SystemExit(f"Unknown source.type: {stype}")
+
+    raise SystemExit("Config must include either items[] or source{type=...}")
+
+
+@dataclass(frozen=True)
+class JobItem:
+    idx: int  # 1-based position in the job, also used to derive seeds
+    name: str
+    prompt: str
+    out_path: Path
+    source: str = ""  # file the item came from, for streaming sources
+    source_idx: int = 0  # 1-based position within that file
+    negative: str | None = None  # per-item overrides from a job matrix
+    seed: int | None = None
+    subdir: str = ""
+
+    @property
+    def out_name(self) -> str:
+        # Output path relative to the job's output dir, for progress lines.
+        if self.subdir:
+            return f"{self.subdir}/{self.out_path.name}"
+        return self.out_path.name
+
+
+@dataclass
+class GenerationResult:
+    image: bytes
+    # Normalized keys: backend, model, prompt, negative, width, height, steps,
+    # seed, sampler, scheduler, cfg. Backends leave out what they don't know.
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+
+class GenerationBackend:
+    """One image generation service the job engine can dispatch items to.
+
+    ``slots`` is how many items the engine keeps in flight on this backend at
+    once. When ``max_slots`` is higher, ``slots`` is only the starting point
+    and the engine adapts the window between 1 and ``max_slots`` (see
+    concurrency.AimdController). ``generate`` is called from worker threads
+    and must be thread-safe when either is above 1.
+    """
+
+    name = "backend"
+    slots = 1
+    max_slots: int | None = None
+
+    def generate(self, item: JobItem) -> GenerationResult:
+        raise NotImplementedError
+
+    def timing_key(self) -> Dict[str, Any]:
+        # What makes renders comparable for ETA/regression purposes; see
+        # timing_db.KEY_FIELDS.
+        return {"backend": self.name}
+
+    def render_settings(self) -> Dict[str, Any]:
+        # Everything besides an item's own prompt, negative and seed that
+        # decides what image comes out (checkpoint, sampler, workflow, ...),
+        # for telling renders apart; see daemon.workflow_hash.
+        return self.timing_key()
+
+    def result_timing_key(self, meta: Mapping[str, Any]) -> Dict[str, Any]:
+        # Key for one finished render, given its meta; backends whose items
+        # don't all render the same way (e.g. img2img refreshes) override it.
+        return self.timing_key()
+
+    def pressure(self) -> float | None:
+        # Resource use (0..1, e.g. VRAM) the adaptive window backs off on;
+        # None when the backend can't tell.
+        return None
+
+    def location(self) -> str:
+        # Server URL shown (and polled) by `imagegen.py status`, if any.
+        return ""
+
+    def host_states(self) -> List[Dict[str, Any]]:
+        # Load and health of each host a backend spreads items over, shown
+        # by `imagegen.py status`; empty for single-server backends.
+        return []
+
+    def close(self) -> None:
+        pass
+
+
+def concurrency_limits(
+    gen: Mapping[str, Any],
+    *,
+    default: int,
+    concurrency: int | None = None,
+    max_concurrency: int | None = None,
+) -> Tuple[int, int | None]:
+    """(slots, max_slots) from ``generate.concurrency``/``max_concurrency``.
+
+    Keyword arguments are CLI overrides. A ``max_concurrency`` above the
+    starting concurrency turns on the adaptive window.
+    """
+    slots = concurrency if concurrency is not None else gen.get("concurrency")
+    slots = int(slots) if slots is not None else default
+    ceiling = (
+        max_concurrency if max_concurrency is not None else gen.get("max_concurrency")
+    )
+    ceiling = int(ceiling) if ceiling is not None else None
+    if slots < 1:
+        raise SystemExit("concurrency must be >= 1")
+    if ceiling is not None and ceiling < slots:
+        raise SystemExit(
+            f"max_concurrency ({ceiling}) must be >= concurrency ({slots})"
+        )
+    return slots, ceiling
+
+
+@dataclass(frozen=True)
+class JobOutcome:
+    item: JobItem
+    backend: str
+    elapsed_s: float
+    meta: Dict[str, Any]
+    lane: int = 0  # index of the backend in the list passed to run_job
+
+
+# Stages a backend failure is attributed to; see StageError.
+# "review" is a reviewer rejecting an item mid-render; it is never retried.
+STAGES = ("queue", "wait", "download", "render", "write", "review")
+
+RETRY_KEYS = {"attempts", "backoff_s", "max_backoff_s", "stages"}
+
+# Written to the output dir when items fail; removed by the next clean run.
+FAILURE_REPORT = "failures.json"
+
+
+class StageError(RuntimeError):
+    """A backend failure attributed to one stage of generating an item.
+
+    ``retryable=False`` marks failures that will not go away on their own
+    (e.g. the server rejecting the workflow), so they are not retried.
+    """
+
+    def __init__(self, stage: str, message: str, *, retryable: bool = True):
+        super().__init__(message)
+        self.stage = stage
+        self.retryable = retryable
+
+
+def failure_stage(error: BaseException) -> str:
+    return getattr(error, "stage", "render")
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How often, and after which stages, a failed item is generated again."""
+
+    attempts: int = 3
+    backoff_s: float = 2.0
+    max_backoff_s: float = 60.0
+    stages: Tuple[str, ...] = ("queue", "wait", "download", "render")
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        if attempt >= self.attempts:
+            return False
+        if isinstance(error, StageError) and not error.retryable:
+            return False
+        return failure_stage(error) in self.stages
+
+    def delay_s(self, attempt: int) -> float:
+        # Exponential backoff with jitter (half fixed, half random), so items
+        # that failed together don't all hit the server again at once.
+        cap = min(self.max_backoff_s, self.backoff_s * 2 ** (attempt - 1))
+        return cap / 2 + random.uniform(0, cap / 2)
+
+
+NO_RETRY = RetryPolicy(attempts=1)
+
+
+def retry_policy_from_cfg(
+    cfg: Mapping[str, Any], *, attempts: int | None = None
+) -> RetryPolicy:
+    """RetryPolicy from a job's ``retry`` block; ``attempts`` is a CLI override."""
+    raw = cfg.get("retry")
+    retry = raw if isinstance(raw, dict) else {}
+    stages = retry.get("stages")
+    if stages is not None:
+        if not isinstance(stages, list) or any(st not in STAGES for st in stages):
+            raise SystemExit(f"retry.stages must be a list of: {', '.join(STAGES)}")
+
+    def number(key: str, kind: type, minimum: float) -> Any:
+        # An explicit 0 (e.g. backoff_s: 0) is a setting, not a missing value.
+        value = retry.get(key, getattr(RetryPolicy, key))
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise SystemExit(f"retry.{key} must be a number")
+        if value < minimum or (kind is int and value != int(value)):
+            what = "an integer" if kind is int else "a number"
+            raise SystemExit(f"retry.{key} must be {what} >= {minimum}")
+        return kind(value)
+
+    policy = RetryPolicy(
+        attempts=number("attempts", int, 1),
+        backoff_s=number("backoff_s", float, 0),
+        max_backoff_s=number("max_backoff_s", float, 0),
+        stages=tuple(stages) if stages is not None else RetryPolicy.stages,
+    )
+    if attempts is not None:
+        if attempts < 1:
+            raise SystemExit("--attempts must be >= 1")
+        policy = replace(policy, attempts=attempts)
+    return policy
+
+
+class ItemFailure(RuntimeError):
+    def __init__(
+        self,
+        backend: GenerationBackend,
+        elapsed_s: float,
+        error: BaseException,
+        *,
+        attempts: int = 1,
+    ):
+        super().__init__(f"{backend.name}: {error}")
+        self.backend = backend
+        self.elapsed_s = elapsed_s
+        self.error = error
+        self.stage = failure_stage(error)
+        self.attempts = attempts
+
+
+@dataclass(frozen=True)
+class FailedItem:
+    item: JobItem
+    backend: str
+    stage: str
+    attempts: int
+    error: str
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "name": self.item.name,
+            "source": self.item.source,
+            "source_idx": self.item.source_idx,
+            "out": self.item.out_name,
+            "backend": self.backend,
+            "stage": self.stage,
+            "attempts": self.attempts,
+            "error": self.error,
+        }
+
+
+def write_failure_report(out_dir: Path, failures: Sequence[FailedItem]) -> Path:
+    """Write (or, with no failures, remove) ``out_dir/failures.json``."""
+    path = out_dir / FAILURE_REPORT
+    if failures:
+        write_json_atomic(
+            path,
+            {
+                "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "failed": [f.to_json() for f in failures],
+            },
+        )
+    else:
+        path.unlink(missing_ok=True)
+    return path
+
+
+OUTPUT_KEYS = {"dir", "overwrite", "ext", "optimize", "metadata"}
+
+# Per-run details left out of the metadata embedded in outputs, so the same
+# settings always produce the same chunk.
+VOLATILE_META = {"stages", "prompt_id", "host", "attempts"}
+
+
+def output_metadata(item: JobItem, meta: Mapping[str, Any]) -> Dict[str, Any]:
+    """What gets embedded in an output: the item plus its generation settings."""
+    out: Dict[str, Any] = {"v": 1, "name": item.name}
+    if item.source:
+        out["source"] = item.source
+        out["source_idx"] = item.source_idx
+    out.update(
+        (k, v) for k, v in meta.items() if k not in VOLATILE_META and v is not None
+    )
+    return out
+
+
+def embed_output_metadata(cfg: Mapping[str, Any]) -> bool:
+    out = cfg.get("output")
+    return not isinstance(out, dict) or out.get("metadata", True) is not False
+
+
+PUBLISH_KEYS = {"pack", "section", "prune"}
+
+
+def optimize_job_outputs(cfg: Mapping[str, Any], *, out_dir: Path) -> None:
+    """Losslessly recompress a finished job's PNGs when ``output.optimize`` is set."""
+    out = cfg.get("output")
+    if not isinstance(out, dict) or not out.get("optimize"):
+        return
+    ledger = OptimizeLedger(DEFAULT_OPTIMIZE_LEDGER)
+    try:
+        with span("output.optimize"):
+            results = optimize_pngs([out_dir], ledger=ledger)
+        print_optimize_report(results)
+    finally:
+        ledger.close()
+
+
+def publish_job_outputs(cfg: Mapping[str, Any], *, out_dir: Path, out_ext: str) -> None:
+    """Copy a finished job's outputs into the content pack named by ``publish``."""
+    pub = cfg.get("publish")
+    if not isinstance(pub, dict):
+        return
+    pack = str(pub.get("pack") or "").strip()
+    if not pack:
+        raise SystemExit("publish.pack is required")
+    pack_dir = Path(pack).resolve()
+    with span("output.publish", pack=str(pack_dir)):
+        report = publish_portraits(
+            out_dir,
+            pack_dir,
+            section=str(pub.get("section") or "kins"),
+            ext=out_ext,
+            prune=bool(pub.get("prune", True)),
+        )
+    print_publish_report(report, pack_dir)
+
+
+def open_timings(path: str | None, *, disabled: bool = False) -> TimingDB | None:
+    if disabled:
+        return None
+    with span("timings.open"):
+        return TimingDB(Path(path) if path else DEFAULT_TIMINGS_DB)
+
+
+def open_progress(job: str) -> ProgressFile:
+    return ProgressFile(DEFAULT_PROGRESS_DIR / f"{os.getpid()}.json", job=job)
+
+
+def open_work_queue(
+    path: str | None,
+    *,
+    out_dir: Path,
+    lease_s: float = DEFAULT_LEASE_S,
+    reset: bool = False,
+) -> WorkQueue | None:
+    """Join the shared queue for the job writing to ``out_dir`` (None: off)."""
+    if path is None:
+        return None
+    claims = WorkQueue(Path(path), job=out_dir.resolve().as_posix(), lease_s=lease_s)
+    if reset:
+        print(f"Work queue: forgot {claims.reset()} finished item(s)")
+    claims.start()
+    print(f"Work queue: {path} (as {claims.owner})")
+    return claims
+
+
+def print_job_estimate(
+    count: int,
+    lanes: Sequence[Tuple[Mapping[str, Any], int]],
+    timings: TimingDB | None,
+) -> None:
+    """Print the expected wall time for ``count`` items from timing history.
+
+    ``lanes`` pairs each backend's timing key with its slot count.
+    """
+    if not count or timings is None:
+        return
+    medians = [(timings.median_s(key), slots) for key, slots in lanes]
+    est = estimate_s(count, medians)
+    if est is None:
+        print(f"Estimate: {count} item(s); no timing history for this setup yet")
+        return
+    per_item = ", ".join(
+        f"{key.get('backend')} ~{m:.1f}s/item"
+        for (key, _), (m, _) in zip(lanes, medians)
+        if m
+    )
+    print(f"Estimate: {count} item(s) in ~{format_duration(est)} ({per_item})")
+
+
+ItemLike = Union[PromptItem, Tuple[str, str]]
+
+
+def iter_job_items(
+    items: Iterable[ItemLike],
+    *,
+    out_dir: Path,
+    out_ext: str,
+    overwrite: bool,
+) -> Iterator[Tuple[JobItem, bool]]:
+    """Resolve output paths as items arrive, yielding ``(item, skip)`` pairs.
+
+    ``skip`` is true when the output already exists and ``overwrite`` is off.
+    Only output names are remembered (to warn about collisions), never
+    prompts. Colliding items are all rendered; the last one written wins.
+    """
+    seen: Dict[str, str] = {}
+    for idx, raw in enumerate(items, start=1):
+        it = raw if isinstance(raw, PromptItem) else PromptItem(*raw)
+        stem = slugify(it.name)
+        if it.seed is not None:
+            stem += f"_seed{it.seed}"
+        rel = f"{it.subdir}/{stem}.{out_ext}" if it.subdir else f"{stem}.{out_ext}"
+        if rel in seen:
+            print(f"WARNING: items '{seen[rel]}' and '{it.name}' both write to {rel}")
+        seen[rel] = it.name
+        out_path = out_dir / rel
+        item = JobItem(
+            idx=idx,
+            name=it.name,
+            prompt=it.prompt,
+            out_path=out_path,
+            source=it.source,
+            source_idx=it.source_idx,
+            negative=it.negative,
+            seed=it.seed,
+            subdir=it.subdir,
+        )
+        yield item, out_path.exists() and not overwrite
+
+
+def progress_label(item: JobItem, total: int | None) -> str:
+    # Streaming sources have no total; they report their position per file.
+    pos = f"{item.idx}/{total}" if total is not None else str(item.idx)
+    if item.source:
+        pos += f" {item.source}#{item.source_idx}"
+    return f"[{pos}]"
+
+
+def print_job_plan(
+    items: Iterable[ItemLike],
+    lanes: Sequence[Tuple[Mapping[str, Any], int]],
+    *,
+    out_dir: Path,
+    out_ext: str,
+    overwrite: bool,
+    timings: TimingDB | None,
+) -> None:
+    """Dry run: show what a job would generate and how long it should take."""
+    total = len(items) if isinstance(items, Sized) else None
+    count = skipped = 0
+    for item, skip in iter_job_items(
+        items, out_dir=out_dir, out_ext=out_ext, overwrite=overwrite
+    ):
+        count += 1
+        if skip:
+            skipped += 1
+            print(
+                f"{progress_label(item, total)} skip (exists): "
+                f"{item.name} -> {item.out_path}"
+            )
+    print(
+        f"Plan: {count} item(s), {skipped} already exist, "
+        f"{count - skipped} to generate -> {out_dir}"
+    )
+    if timings is None:
+        return
+    print_job_estimate(count - skipped, lanes, timings)
+
+
+def _put(q: queue.Queue[Any], value: Any, stop: threading.Event) -> bool:
+    # Bounded put that gives up once the job is being torn down.
+    while not stop.is_set():
+        try:
+            q.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_job(
+    items: Iterable[ItemLike],
+    backends: Sequence[GenerationBackend],
+    *,
+    out_dir: Path,
+    out_ext: str,
+    overwrite: bool,
+    timings: TimingDB | None = None,
+    on_outcome: Callable[[JobOutcome], None] | None = None,
+    retry: RetryPolicy = NO_RETRY,
+    keep_going: bool = False,
+    on_failure: Callable[[FailedItem], None] | None = None,
+    metadata: bool = True,
+    progress: ProgressFile | None = None,
+    claims: WorkQueue | None = None,
+) -> List[JobOutcome]:
+    """Generate every item not yet on disk using the given backends.
+
+    All backends pull from one shared queue, so whichever backend has a free
+    slot takes the next item. ``items`` may be a generator: it is consumed as
+    slots free up, through bounded queues, so generation starts immediately
+    and memory stays flat however long the source is. Progress is reported
+    in item order, with an ETA based on ``timings`` history (or this run's own
+    pace) when the item count is known up front.
+
+    Outcomes are returned as a list, or handed to ``on_outcome`` one by one
+    (and not kept) when it is given.
+
+    A failed item is retried on the same backend according to ``retry``.
+    Once out of attempts it stops the job (SystemExit), or, with
+    ``keep_going``, is handed to ``on_failure`` while the rest carries on.
+    Failures are written to ``out_dir/failures.json`` either way.
+
+    PNG outputs get the generation settings embedded as a JSON iTXt chunk
+    (see png_tools.embed_metadata) unless ``metadata`` is off.
+
+    With ``progress``, counts, throughput, ETA and per-backend load are
+    written there on every change, for `imagegen.py status`.
+
+    With ``claims``, only items this runner leases from the shared queue are
+    generated, so several runners can work through one job together. Once
+    its items run out, a runner takes over the expired leases of runners
+    that died, and waits for the live ones, so nothing is left behind.
+    """
+    with span("run_job", backends=[b.name for b in backends]):
+        return _run_job(
+            items,
+            backends,
+            out_dir=out_dir,
+            out_ext=out_ext,
+            overwrite=overwrite,
+            timings=timings,
+            on_outcome=on_outcome,
+            retry=retry,
+            keep_going=keep_going,
+            on_failure=on_failure,
+            metadata=metadata,
+            progress=progress,
+            claims=claims,
+        )
+
+
+def _run_job(
+    items: Iterable[ItemLike],
+    backends: Sequence[GenerationBackend],
+    *,
+    out_dir: Path,
+    out_ext: str,
+    overwrite: bool,
+    timings: TimingDB | None,
+    on_outcome: Callable[[JobOutcome], None] | None,
+    retry: RetryPolicy,
+    keep_going: bool,
+    on_failure: Callable[[FailedItem], None] | None,
+    metadata: bool,
+    progress: ProgressFile | None,
+    claims: WorkQueue | None,
+) -> List[JobOutcome]:
+    if not backends:
+        raise SystemExit("No generation backend configured")
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    planned: Iterable[Tuple[JobItem, bool]] = iter_job_items(
+        items, out_dir=out_dir, out_ext=out_ext, overwrite=overwrite
+    )
+    total = len(items) if isinstance(items, Sized) else None
+    pending_count: int | None = None
+    if total is not None:
+        # In-memory item lists are cheap to resolve up front, which gives the
+        # estimate and ETA an exact count of what actually needs generating.
+        planned = list(planned)
+        pending_count = sum(1 for _, skip in planned if not skip)
+        if not pending_count:
+            for item, _ in planned:
+                print(
+                    f"{progress_label(item, total)} skip (exists): "
+                    f"{item.name} -> {item.out_path}"
+                )
+            write_failure_report(out_dir, [])
+            return []
+        if claims is not None:
+            # Other runners take a share we can't know in advance.
+            pending_count = None
+
+    # Lanes with ``max_slots`` above ``slots`` get an adaptive window and
+    # enough worker threads to fill its ceiling.
+    controllers = [
+        (
+            AimdController(
+                b.name, initial=b.slots, ceiling=b.max_slots, pressure=b.pressure
+            )
+            if b.max_slots is not None and b.max_slots > max(1, b.slots)
+            else None
+        )
+        for b in backends
+    ]
+    threads_per_lane = [
+        c.ceiling if c is not None else max(1, b.slots)
+        for b, c in zip(backends, controllers)
+    ]
+    total_slots = sum(threads_per_lane)
+    lanes = [(b.timing_key(), max(1, b.slots)) for b in backends]
+    if pending_count is not None:
+        print_job_estimate(pending_count, lanes, timings)
+    if total_slots > 1:
+        names = ", ".join(
+            f"{b.name} x{max(1, b.slots)}"
+            + (f" (adaptive, max {c.ceiling})" if c is not None else "")
+            for b, c in zip(backends, controllers)
+        )
+        print(f"Workers: {names}")
+
+    # Workers take from ``work``; the main thread reports from ``order``, which
+    # also carries skipped items so every line comes out in item order. Both
+    # are bounded, so the feeder only reads ahead a few items.
+    work: queue.Queue[Tuple[JobItem, Future[JobOutcome]] | None] = queue.Queue(
+        maxsize=total_slots
+    )
+    started_at = time.time()
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+    lane_busy = [0] * len(backends)
+    lane_done = [0] * len(backends)
+    last_eta: List[float | None] = [None]
+    progress_lock = threading.Lock()
+
+    def report_progress() -> None:
+        if progress is None:
+            return
+        with progress_lock:
+            elapsed = time.time() - started_at
+            state = {
+                "out_dir": str(out_dir),
+                "started": started_at,
+                "total": pending_count,
+                **counts,
+                "in_flight": sum(lane_busy),
+                "per_min": 60.0 * counts["done"] / elapsed if counts["done"] else None,
+                "eta_s": last_eta[0],
+                "lanes": [
+                    {
+                        "backend": b.name,
+                        "server": b.location(),
+                        "in_flight": lane_busy[i],
+                        "done": lane_done[i],
+                        "limit": (
+                            controllers[i].limit
+                            if controllers[i] is not None
+                            else max(1, b.slots)
+                        ),
+                        "hosts": b.host_states(),
+                    }
+                    for i, b in enumerate(backends)
+                ],
+            }
+            progress.write(state)
+
+    def busy(lane: int, delta: int) -> None:
+        with progress_lock:
+            lane_busy[lane] += delta
+        report_progress()
+
+    order: queue.Queue[Any] = queue.Queue(maxsize=4 * total_slots + 16)
+    stop = threading.Event()
+    job_span = current_id()  # worker threads hang their item spans off it
+
+    def taken_over() -> Iterator[Tuple[JobItem, bool]]:
+        # Leases of runners that died expire; pick those items up while any
+        # other runner is still working, since its items might be next.
+        assert claims is not None
+        waiting = False
+        while not stop.is_set():
+            found = claims.expired()
+            for key, payload in found:
+                yield JobItem(out_path=out_dir / key, **payload), False
+            if found:
+                continue
+            others = claims.leased_elsewhere()
+            if not others:
+                return
+            if not waiting:
+                print(f"Waiting on {others} item(s) leased by other runners")
+                waiting = True
+            stop.wait(min(5.0, claims.lease_s / 3))
+
+    def feeder() -> None:
+        try:
+            claimed: Iterable[Tuple[JobItem, bool]] = []
+            if claims is not None:
+                claimed = taken_over()
+            for item, skip in itertools.chain(planned, claimed):
+                note = "exists" if skip else None
+                if note is None and claims is not None:
+                    payload = {k: v for k, v in asdict(item).items() if k != "out_path"}
+                    note = claims.claim(
+                        item.out_name,
+                        payload,
+                        redo=overwrite or not item.out_path.exists(),
+                    )
+                fut: Future[JobOutcome] | None = None if note else Future()
+                if not _put(order, (item, fut, note), stop):
+                    return
+                if fut is not None and not _put(work, (item, fut), stop):
+                    return
+            _put(order, None, stop)
+        except BaseException as e:
+            _put(order, e, stop)
+        finally:
+            for _ in workers:
+                _put(work, None, stop)
+
+    def generate_once(
+        backend: GenerationBackend, item: JobItem, attempt: int
+    ) -> GenerationResult:
+        with span(
+            "item",
+            parent=job_span,
+            item=item.name,
+            backend=backend.name,
+            attempt=attempt,
+        ):
+            result = backend.generate(item)
+            image = result.image
+            if metadata and image[:8] == PNG_SIGNATURE:
+                meta = {"backend": backend.name, **result.meta}
+                image = embed_metadata(image, output_metadata(item, meta))
+            with span("write", bytes=len(image)):
+                try:
+                    if item.subdir:
+                        item.out_path.parent.mkdir(parents=True, exist_ok=True)
+                    item.out_path.write_bytes(image)
+                except OSError as e:
+                    raise StageError("write", str(e), retryable=False)
+        return result
+
+    def worker(lane: int, backend: GenerationBackend) -> None:
+        gate = controllers[lane]
+        while not stop.is_set():
+            if gate is not None and not gate.acquire(stop):
+                return
+            try:
+                entry = work.get(timeout=0.1)
+            except queue.Empty:
+                if gate is not None:
+                    gate.cancel()
+                continue
+            if entry is None:
+                if gate is not None:
+                    gate.cancel()
+                return
+            item, fut = entry
+            if total_slots == 1:
+                print(
+                    f"{progress_label(item, total)} generate: "
+                    f"{item.name} -> {item.out_name}"
+                )
+            busy(lane, +1)
+            try:
+                run_item(lane, backend, gate, item, fut)
+            finally:
+                busy(lane, -1)
+
+    def run_item(
+        lane: int,
+        backend: GenerationBackend,
+        gate: AimdController | None,
+        item: JobItem,
+        fut: Future[JobOutcome],
+    ) -> None:
+        attempt = 1
+        while True:
+            started = time.monotonic()
+            try:
+                result = generate_once(backend, item, attempt)
+            except (Exception, SystemExit) as e:
+                elapsed = time.monotonic() - started
+                if gate is not None:
+                    gate.release(elapsed, ok=False)
+                if stop.is_set() or not retry.should_retry(e, attempt):
+                    if claims is not None and not stop.is_set():
+                        claims.fail(item.out_name, str(e))
+                    fut.set_exception(
+                        ItemFailure(backend, elapsed, e, attempts=attempt)
+                    )
+                    return
+                delay = retry.delay_s(attempt)
+                print(
+                    f"  retry {attempt + 1}/{retry.attempts} in {delay:.1f}s: "
+                    f"{item.name} ({failure_stage(e)}: {e})"
+                )
+                # Adaptive lanes give the slot back while waiting.
+                if stop.wait(delay) or (gate is not None and not gate.acquire(stop)):
+                    fut.set_exception(
+                        ItemFailure(backend, elapsed, e, attempts=attempt)
+                    )
+                    return
+                attempt += 1
+                continue
+            elapsed = time.monotonic() - started
+            if gate is not None:
+                gate.release(elapsed, ok=True)
+            meta = dict(result.meta)
+            meta.setdefault("backend", backend.name)
+            if attempt > 1:
+                meta["attempts"] = attempt
+            if claims is not None:
+                claims.complete(item.out_name)
+            fut.set_result(
+                JobOutcome(
+                    item=item,
+                    backend=backend.name,
+                    elapsed_s=elapsed,
+                    meta=meta,
+                    lane=lane,
+                )
+            )
+            return
+
+    workers = [
+        threading.Thread(target=worker, args=(lane, b), daemon=True)
+        for lane, b in enumerate(backends)
+        for _ in range(threads_per_lane[lane])
+    ]
+    feed_thread = threading.Thread(target=feeder, daemon=True)
+    for t in [feed_thread, *workers]:
+        t.start()
+
+    history = [timings.median_s(key) if timings else None for key, _ in lanes]
+    observed: List[List[float]] = [[] for _ in backends]
+
+    def eta_s(remaining: int | None) -> float | None:
+        if remaining is None or remaining <= 0:
+            return None
+        per_item = [
+            (
+                history[i]
+                or (sum(observed[i]) / len(observed[i]) if observed[i] else None),
+                controllers[i].limit if controllers[i] is not None else slots,
+            )
+            for i, (_, slots) in enumerate(lanes)
+        ]
+        return estimate_s(remaining, per_item)
+
+    outcomes: List[JobOutcome] = []
+    failures: List[FailedItem] = []
+    done = 0
+    finished = False
+    try:
+        while True:
+            entry = order.get()
+            if entry is None:
+                break
+            if isinstance(entry, BaseException):
+                raise entry
+            item, fut, note = entry
+            label = progress_label(item, total)
+            if fut is None:
+                print(f"{label} skip ({note}): {item.name} -> {item.out_path}")
+                counts["skipped"] += 1
+                report_progress()
+                continue
+            try:
+                outcome = fut.result()
+            except ItemFailure as e:
+                if timings is not None:
+                    timings.record(
+                        e.backend.timing_key(),
+                        item=item.name,
+                        total_s=e.elapsed_s,
+                        success=False,
+                    )
+                failed = FailedItem(
+                    item=item,
+                    backend=e.backend.name,
+                    stage=e.stage,
+                    attempts=e.attempts,
+                    error=str(e.error),
+                )
+                failures.append(failed)
+                counts["failed"] += 1
+                report_progress()
+                if not keep_going:
+                    write_failure_report(out_dir, failures)
+                    raise SystemExit(f"Failed to generate '{item.name}': {e}")
+                print(
+                    f"{label} FAILED: {item.name} ({e.backend.name}, {e.stage} stage, "
+                    f"{e.attempts} attempt(s)): {e.error}"
+                )
+                if on_failure is not None:
+                    on_failure(failed)
+                continue
+            except Exception as e:
+                raise SystemExit(f"Failed to generate '{item.name}': {e}")
+            done += 1
+            observed[outcome.lane].append(outcome.elapsed_s)
+            del observed[outcome.lane][:-HISTORY_SAMPLES]
+            if timings is not None:
+                timings.record(
+                    backends[outcome.lane].result_timing_key(outcome.meta),
+                    item=item.name,
+                    total_s=outcome.elapsed_s,
+                    success=True,
+                    stages=outcome.meta.get("stages"),
+                )
+            seed = outcome.meta.get("seed")
+            seed_note = f", seed={seed}" if seed is not None else ""
+            remaining = (
+                pending_count - done - len(failures)
+                if pending_count is not None
+                else None
+            )
+            eta = last_eta[0] = eta_s(remaining)
+            eta_note = f", ETA {format_duration(eta)}" if eta is not None else ""
+            print(
+                f"{label} done: {item.name} -> {item.out_name} "
+                f"({outcome.backend}{seed_note}, {outcome.elapsed_s:.1f}s{eta_note})"
+            )
+            with progress_lock:
+                counts["done"] = done
+                lane_done[outcome.lane] += 1
+            report_progress()
+            if on_outcome is not None:
+                on_outcome(outcome)
+            else:
+                outcomes.append(outcome)
+        finished = True
+    finally:
+        stop.set()
+        # Workers are daemon threads: one stuck in a long render must not
+        # hold up an abort, it goes down with the process.
+        deadline = None if finished else time.monotonic() + ABORT_JOIN_S
+        for t in [feed_thread, *workers]:
+            t.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        busy = sum(1 for t in workers if t.is_alive())
+        if busy:
+            print(f"Stopped waiting for {busy} worker(s) still rendering")
+
+    report = write_failure_report(out_dir, failures)
+    if failures:
+        print(f"{len(failures)} item(s) failed; report: {report}")
+    for c in controllers:
+        if c is not None:
+            print(
+                f"Concurrency {c.name}: finished at {c.limit} "
+                f"(max {c.ceiling}, {c.changes} change(s))"
+            )
+    if timings is not None:
+        for warning in timings.regressions([key for key, _ in lanes]):
+            print(f"WARNING: slower than usual: {warning}")
+    return outcomes
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Sequence
+
+from png_tools import PngError, idat_stream, read_header, replace_idat
+
+# (level, memLevel, strategy) tried on every image; the smallest wins. The
+# original filtering is kept as-is: generators already pick per-row filters
+# (mostly Paeth), and re-filtering in pure Python did not beat them.
+STRATEGIES = (
+    (9, 9, zlib.Z_DEFAULT_STRATEGY),
+    (9, 9, zlib.Z_FILTERED),
+)
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS optimized (
+    sha256 TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    ts REAL NOT NULL
+);
+"""
+
+
+@dataclass(frozen=True)
+class OptimizeResult:
+    path: str
+    before: int
+    after: int
+    status: str  # optimized | optimal | skipped | error
+    sha256: str = ""  # of the file as left on disk
+    error: str = ""
+
+    @property
+    def saved(self) -> int:
+        return self.before - self.after
+
+
+def recompress_png(data: bytes) -> bytes | None:
+    """Losslessly smaller encoding of ``data``, or None if none was found.
+
+    Every chunk except IDAT is kept byte-for-byte; the IDAT payload is
+    re-deflated and checked to inflate to exactly the same scanlines, so the
+    pixels are guaranteed identical.
+    """
+    header = read_header(data)
+    original = idat_stream(data)
+    try:
+        raw = zlib.decompress(original)
+    except zlib.error as e:
+        raise PngError(f"corrupt image data: {e}")
+
+    best = original
+    for level, mem_level, strategy in STRATEGIES:
+        c = zlib.compressobj(level, zlib.DEFLATED, 15, mem_level, strategy)
+        candidate = c.compress(raw) + c.flush()
+        if len(candidate) < len(best):
+            best = candidate
+    if best is original:
+        return None
+
+    out = replace_idat(data, best)
+    if len(out) >= len(data):
+        return None
+    if read_header(out) != header or zlib.decompress(idat_stream(out)) != raw:
+        raise PngError("recompressed image does not match the original pixels")
+    return out
+
+
+def optimize_file(path: str) -> OptimizeResult:
+    """Recompress one PNG in place (atomically); runs in worker processes."""
+    p = Path(path)
+    data = p.read_bytes()
+    try:
+        out = recompress_png(data)
+    except PngError as e:
+        return OptimizeResult(path, len(data), len(data), "error", error=str(e))
+    if out is None:
+        sha = hashlib.sha256(data).hexdigest()
+        return OptimizeResult(path, len(data), len(data), "optimal", sha)
+
+    fd, tmp = tempfile.mkstemp(prefix=f".{p.name}.", dir=str(p.parent))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(out)
+        os.replace(tmp, p)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return OptimizeResult(
+        path, len(data), len(out), "optimized", hashlib.sha256(out).hexdigest()
+    )
+
+
+class OptimizeLedger:
+    """sha256 of every PNG already optimized (or found optimal), in SQLite.
+
+    A file whose current hash is in the ledger is skipped without decoding.
+    """
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path))
+        self._conn.executescript(LEDGER_SCHEMA)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def contains(self, sha256: str) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM optimized WHERE sha256=?", (sha256,)
+        ).fetchone()
+        return row is not None
+
+    def add(self, sha256: str, size: int) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO optimized (sha256, bytes, ts) VALUES (?, ?, ?)",
+            (sha256, size, time.time()),
+        )
+        self._conn.commit()
+
+
+def iter_pngs(paths: Iterable[Path]) -> List[Path]:
+    out: List[Path] = []
+    for p in paths:
+        if p.is_dir():
+            out.extend(
+                f
+                for f in p.rglob("*.png")
+                if f.is_file() and not f.name.startswith(".")
+            )
+        elif p.suffix.lower() == ".png" and p.is_file():
+            out.append(p)
+    return sorted(set(out))
+
+
+def optimize_pngs(
+    paths: Sequence[Path],
+    *,
+    ledger: OptimizeLedger | None,
+    workers: int | None = None,
+) -> List[OptimizeResult]:
+    """Optimize every PNG under ``paths`` across a process pool."""
+    results: List[OptimizeResult] = []
+    todo: List[str] = []
+    for p in iter_pngs(paths):
+        if ledger is not None:
+            data = p.read_bytes()
+            sha = hashlib.sha256(data).hexdigest()
+            if ledger.contains(sha):
+                results.append(
+                    OptimizeResult(str(p), len(data), len(data), "skipped", sha)
+                )
+                continue
+        todo.append(str(p))
+
+    if len(todo) > 1 and (workers or os.cpu_count() or 1) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            done = list(pool.map(optimize_file, todo))
+    else:
+        done = [optimize_file(p) for p in todo]
+
+    for r in done:
+        if ledger is not None and r.status in {"optimized", "optimal"}:
+            ledger.add(r.sha256, r.after)
+    return sorted(results + done, key=lambda r: r.path)
+
+
+def print_optimize_report(results: Sequence[OptimizeResult]) -> None:
+    for r in results:
+        if r.status == "optimized":
+            pct = 100.0 * r.saved / r.before if r.before else 0.0
+            print(f"optimized: {r.path} ({r.before} -> {r.after} bytes, -{pct:.1f}%)")
+        elif r.status == "error":
+            print(f"ERROR: {r.path}: {r.error}")
+    counts = {
+        s: sum(1 for r in results if r.status == s)
+        for s in ("optimized", "optimal", "skipped", "error")
+    }
+    before = sum(r.before for r in results if r.status == "optimized")
+    saved = sum(r.saved for r in results)
+    pct = f" ({100.0 * saved / before:.1f}% of those files)" if before else ""
+    print(
+        f"PNG optimize: {counts['optimized']} optimized, {counts['optimal']} already "
+        f"optimal, {counts['skipped']} skipped (ledger), {counts['error']} error(s); "
+        f"saved {saved} bytes{pct}"
+    )
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import struct
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Mapping, Sequence, Tuple
+
+# PNG helpers that work on the byte stream directly. Pillow is optional in
+# this repo, so everything here is stdlib-only; callers that have Pillow may
+# still prefer it for full decodes.
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Samples per pixel by color type (gray, RGB, palette, gray+alpha, RGBA).
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+TEXT_CHUNKS = (b"tEXt", b"zTXt", b"iTXt")
+
+# iTXt keyword under which the runners record how an image was generated.
+METADATA_KEYWORD = "dbu:generation"
+
+
+class PngError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class PngHeader:
+    width: int
+    height: int
+    bit_depth: int
+    color_type: int
+    interlace: int
+
+    @property
+    def bits_per_pixel(self) -> int:
+        return CHANNELS[self.color_type] * self.bit_depth
+
+    @property
+    def stride(self) -> int:
+        # Bytes per scanline, excluding the filter type byte.
+        return (self.width * self.bits_per_pixel + 7) // 8
+
+    @property
+    def filter_bpp(self) -> int:
+        # Byte distance to the "left" pixel used by the Sub/Avg/Paeth filters.
+        return max(1, self.bits_per_pixel // 8)
+
+
+@dataclass(frozen=True)
+class Chunk:
+    ctype: bytes
+    offset: int  # of the length field; the body starts at offset + 8
+    length: int
+    crc: int
+
+    @property
+    def end(self) -> int:
+        return self.offset + 12 + self.length
+
+
+def make_chunk(ctype: bytes, body: bytes) -> bytes:
+    crc = zlib.crc32(body, zlib.crc32(ctype)) & 0xFFFFFFFF
+    return struct.pack(">I", len(body)) + ctype + body + struct.pack(">I", crc)
+
+
+def iter_chunks(data: bytes, *, check_crc: bool = False) -> Iterator[Chunk]:
+    """Walk chunk headers without touching image data (unless ``check_crc``)."""
+    if data[:8] != PNG_SIGNATURE:
+        raise PngError("not a PNG (bad signature)")
+    pos = 8
+    while pos < len(data):
+        if pos + 12 > len(data):
+            raise PngError(f"truncated chunk header at offset {pos}")
+        length, ctype = struct.unpack(">I4s", data[pos : pos + 8])
+        end = pos + 12 + length
+        if end > len(data):
+            raise PngError(f"truncated {ctype!r} chunk at offset {pos}")
+        (crc,) = struct.unpack(">I", data[end - 4 : end])
+        if check_crc:
+            actual = zlib.crc32(data[pos + 4 : end - 4]) & 0xFFFFFFFF
+            if actual != crc:
+                raise PngError(f"CRC mismatch in {ctype!r} chunk at offset {pos}")
+        yield Chunk(ctype=ctype, offset=pos, length=length, crc=crc)
+        if ctype == b"IEND":
+            return
+        pos = end
+    raise PngError("missing IEND chunk")
+
+
+def read_header(data: bytes) -> PngHeader:
+    if data[:8] != PNG_SIGNATURE or data[12:16] != b"IHDR":
+        raise PngError("not a PNG (missing IHDR)")
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+        ">IIBBBBB", data[16:29]
+    )
+    if color_type not in CHANNELS:
+        raise PngError(f"unsupported color type {color_type}")
+    return PngHeader(width, height, bit_depth, color_type, interlace)
+
+
+def chunk_body(data: bytes, chunk: Chunk) -> bytes:
+    return data[chunk.offset + 8 : chunk.offset + 8 + chunk.length]
+
+
+def idat_stream(data: bytes) -> bytes:
+    """The concatenated (still compressed) IDAT payload."""
+    return b"".join(
+        chunk_body(data, c) for c in iter_chunks(data) if c.ctype == b"IDAT"
+    )
+
+
+def replace_idat(data: bytes, idat: bytes) -> bytes:
+    """Rebuild ``data`` with one IDAT chunk holding ``idat``, keeping every
+    other chunk byte-for-byte and in place."""
+    out = [PNG_SIGNATURE]
+    wrote_idat = False
+    for c in iter_chunks(data):
+        if c.ctype == b"IDAT":
+            if not wrote_idat:
+                out.append(make_chunk(b"IDAT", idat))
+                wrote_idat = True
+            continue
+        out.append(data[c.offset : c.end])
+    return b"".join(out)
+
+
+def _add_bytes(a: bytes, b: bytes) -> bytes:
+    # Bytewise (a + b) mod 256 on whole scanlines at once, without carries
+    # crossing byte boundaries; much faster than a Python loop for Up.
+    n = len(a)
+    low = int.from_bytes(b"\x7f" * n, "big")
+    high = int.from_bytes(b"\x80" * n, "big")
+    x = int.from_bytes(a, "big")
+    y = int.from_bytes(b, "big")
+    return (((x & low) + (y & low)) ^ ((x ^ y) & high)).to_bytes(n, "big")
+
+
+def unfilter_scanlines(raw: bytes, header: PngHeader) -> List[bytes]:
+    """Undo the per-row PNG filters of a decompressed, non-interlaced image."""
+    if header.interlace:
+        raise PngError("interlaced PNGs are not supported")
+    stride = header.stride
+    bpp = header.filter_bpp
+    if len(raw) < (stride + 1) * header.height:
+        raise PngError("image data is shorter than the header promises")
+    rows: List[bytes] = []
+    prev = bytes(stride)
+    pos = 0
+    for _ in range(header.height):
+        ftype = raw[pos]
+        line = raw[pos + 1 : pos + 1 + stride]
+        pos += stride + 1
+        if ftype == 0:
+            cur = bytes(line)
+        elif ftype == 2:
+            cur = _add_bytes(line, prev)
+        elif ftype == 1:
+            buf = bytearray(line)
+            for i in range(bpp, stride):
+                buf[i] = (buf[i] + buf[i - bpp]) & 0xFF
+            cur = bytes(buf)
+        elif ftype == 3:
+            buf = bytearray(line)
+            for i in range(stride):
+                left = buf[i - bpp] if i >= bpp else 0
+                buf[i] = (buf[i] + ((left + prev[i]) >> 1)) & 0xFF
+            cur = bytes(buf)
+        elif ftype == 4:
+            buf = bytearray(line)
+            for i in range(stride):
+                a = buf[i - bpp] if i >= bpp else 0
+                b = prev[i]
+                c = prev[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    pred = a
+                elif pb <= pc:
+                    pred = b
+                else:
+                    pred = c
+                buf[i] = (buf[i] + pred) & 0xFF
+            cur = bytes(buf)
+        else:
+            raise PngError(f"bad filter type {ftype}")
+        rows.append(cur)
+        prev = cur
+    return rows
+
+
+def decode_scanlines(data: bytes) -> Tuple[PngHeader, List[bytes]]:
+    """Decode a PNG to unfiltered scanlines (raw samples, no color conversion)."""
+    header = read_header(data)
+    try:
+        raw = zlib.decompress(idat_stream(data))
+    except zlib.error as e:
+        raise PngError(f"corrupt image data: {e}")
+    return header, unfilter_scanlines(raw, header)
+
+
+def palette(data: bytes) -> List[Tuple[int, int, int]]:
+    for c in iter_chunks(data):
+        if c.ctype == b"PLTE":
+            body = chunk_body(data, c)
+            return [tuple(body[i : i + 3]) for i in range(0, len(body) - 2, 3)]  # type: ignore[misc]
+    return []
+
+
+def gray_at(
+    header: PngHeader,
+    rows: Sequence[bytes],
+    x: int,
+    y: int,
+    plte: Sequence[Tuple[int, int, int]] = (),
+) -> int:
+    """0..255 luma of one pixel; alpha is ignored."""
+    row = rows[y]
+    depth = header.bit_depth
+    channels = CHANNELS[header.color_type]
+    if depth < 8:
+        bit = x * depth
+        sample = (row[bit // 8] >> (8 - depth - bit % 8)) & ((1 << depth) - 1)
+        if header.color_type == 3:
+            r, g, b = plte[sample] if sample < len(plte) else (0, 0, 0)
+            return (299 * r + 587 * g + 114 * b) // 1000
+        return sample * 255 // ((1 << depth) - 1)
+    step = depth // 8  # 16-bit samples: use the high byte
+    base = x * channels * step
+    if header.color_type == 3:
+        r, g, b = plte[row[base]] if row[base] < len(plte) else (0, 0, 0)
+    elif channels >= 3:
+        r, g, b = row[base], row[base + step], row[base + 2 * step]
+    else:
+        return row[base]
+    return (299 * r + 587 * g + 114 * b) // 1000
+
+
+def encode_png(header: PngHeader, rows: Sequence[bytes], *, level: int = 6) -> bytes:
+    """Minimal encoder: unfiltered scanlines, one IDAT, no ancillary chunks."""
+    raw = b"".join(b"\x00" + bytes(r) for r in rows)
+    ihdr = struct.pack(
+        ">IIBBBBB",
+        header.width,
+        header.height,
+        header.bit_depth,
+        header.color_type,
+        0,
+        0,
+        header.interlace,
+    )
+    return (
+        PNG_SIGNATURE
+        + make_chunk(b"IHDR", ihdr)
+        + make_chunk(b"IDAT", zlib.compress(raw, level))
+        + make_chunk(b"IEND", b"")
+    )
+
+
+def text_chunk(keyword: str, text: str) -> bytes:
+    """An uncompressed iTXt chunk (UTF-8 text, unlike Latin-1 tEXt)."""
+    kw = keyword.encode("latin-1")
+    if not 1 <= len(kw) <= 79 or b"\0" in kw:
+        raise PngError(f"invalid text chunk keyword: {keyword!r}")
+    # keyword, NUL, compression flag + method, empty language tag and
+    # translated keyword (each NUL-terminated), then the text.
+    return make_chunk(b"iTXt", kw + b"\0\0\0\0\0" + text.encode("utf-8"))
+
+
+def parse_text_chunk(ctype: bytes, body: bytes) -> Tuple[str, str]:
+    """(keyword, text) of a tEXt, zTXt or iTXt chunk body."""
+    kw, _, rest = body.partition(b"\0")
+    keyword = kw.decode("latin-1")
+    if ctype == b"tEXt":
+        return keyword, rest.decode("latin-1")
+    if ctype == b"zTXt":
+        return keyword, zlib.decompress(rest[1:]).decode("latin-1")
+    compressed = rest[:1] == b"\1"
+    _, _, rest = rest[2:].partition(b"\0")  # language tag
+    _, _, text = rest.partition(b"\0")  # translated keyword
+    return keyword, (zlib.decompress(text) if compressed else text).decode("utf-8")
+
+
+def set_text_chunk(data: bytes, keyword: str, text: str) -> bytes:
+    """Splice an iTXt ``keyword`` chunk into ``data`` without re-encoding.
+
+    The chunk goes right after IHDR, so header-only scanners find it before
+    the image data; an existing chunk with the same keyword is replaced.
+    Every other chunk is copied byte-for-byte.
+    """
+    new = text_chunk(keyword, text)
+    out = [PNG_SIGNATURE]
+    for c in iter_chunks(data):
+        raw = data[c.offset : c.end]
+        if c.ctype in TEXT_CHUNKS:
+            kw = chunk_body(data, c).partition(b"\0")[0]
+            if kw == keyword.encode("latin-1"):
+                continue
+        out.append(raw)
+        if c.ctype == b"IHDR":
+            out.append(new)
+    return b"".join(out)
+
+
+def scan_chunks(f: BinaryIO) -> Iterator[Tuple[bytes, int, int]]:
+    """(type, body offset, length) per chunk, reading only the 8-byte headers.
+
+    Chunk bodies are skipped with seeks, so the cost is one small read per
+    chunk however large the image is.
+    """
+    if f.read(8) != PNG_SIGNATURE:
+        raise PngError("not a PNG (bad signature)")
+    pos = 8
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            raise PngError(f"truncated chunk header at offset {pos}")
+        length, ctype = struct.unpack(">I4s", head)
+        yield ctype, pos + 8, length
+        if ctype == b"IEND":
+            return
+        pos += 12 + length
+        f.seek(pos)
+
+
+def read_text_chunks(path: Path, *, stop_at_idat: bool = False) -> Dict[str, str]:
+    """Every text chunk in a PNG file, keyword -> text, from headers only.
+
+    With ``stop_at_idat`` the scan ends at the image data, which is where
+    the runners put their metadata.
+    """
+    out: Dict[str, str] = {}
+    with path.open("rb") as f:
+        for ctype, offset, length in scan_chunks(f):
+            if ctype == b"IDAT" and stop_at_idat:
+                break
+            if ctype in TEXT_CHUNKS:
+                f.seek(offset)
+                keyword, text = parse_text_chunk(ctype, f.read(length))
+                out.setdefault(keyword, text)
+    return out
+
+
+def embed_metadata(data: bytes, meta: Mapping[str, Any]) -> bytes:
+    """``data`` with ``meta`` recorded as compact JSON under METADATA_KEYWORD."""
+    text = json.dumps(meta, separators=(",", ":"), ensure_ascii=False)
+    return set_text_chunk(data, METADATA_KEYWORD, text)
+
+
+def read_metadata(path: Path) -> Dict[str, Any] | None:
+    """The runners' generation metadata for a PNG, or None if it has none."""
+    text = read_text_chunks(path, stop_at_idat=True).get(METADATA_KEYWORD)
+    if text is None:
+        return None
+    meta = json.loads(text)
+    return meta if isinstance(meta, dict) else None
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Tuple
+
+from png_tools import PNG_SIGNATURE
+
+# Relative to the content pack directory; read by @dbu/adapters (portraitIndex.ts).
+INDEX_REL = "assets/portraits/index.json"
+PORTRAITS_REL = "assets/portraits"
+
+
+def image_dimensions(data: bytes) -> Tuple[int, int] | None:
+    """Width/height from a PNG IHDR or JPEG SOF header, without decoding."""
+    if data[:8] == PNG_SIGNATURE and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        return width, height
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                i += 2
+                continue
+            (length,) = struct.unpack(">H", data[i + 2 : i + 4])
+            # SOF0..SOF15, minus DHT/JPG/DAC which share the range.
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[i + 5 : i + 9])
+                return width, height
+            i += 2 + length
+    return None
+
+
+def file_entry(path: Path) -> Dict[str, Any]:
+    data = path.read_bytes()
+    entry: Dict[str, Any] = {
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "bytes": len(data),
+    }
+    dims = image_dimensions(data)
+    if dims:
+        entry["width"], entry["height"] = dims
+    return entry
+
+
+def read_pack_id(pack_dir: Path) -> str:
+    try:
+        meta = json.loads((pack_dir / "pack.json").read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        raise SystemExit(f"Not a content pack (missing pack.json): {pack_dir}")
+    pack_id = meta.get("id") if isinstance(meta, dict) else None
+    if not isinstance(pack_id, str) or not pack_id:
+        raise SystemExit(f"pack.json has no id: {pack_dir}")
+    return pack_id
+
+
+def write_json_atomic(path: Path, data: Any) -> None:
+    # Readers (the API, other runners) only ever see the old or the new file.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _copy_atomic(src: Path, dest: Path) -> None:
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{dest.name}.", dir=str(dest.parent))
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _same_content(a: Path, b: Path) -> bool:
+    if a.stat().st_size != b.stat().st_size:
+        return False
+    return (
+        hashlib.sha256(a.read_bytes()).digest()
+        == hashlib.sha256(b.read_bytes()).digest()
+    )
+
+
+def _check_inside(pack_dir: Path, index: Mapping[str, Any], index_path: Path) -> None:
+    # Index paths are hashed here and served by the API: one that leads out
+    # of the pack (hand-edited, say) must not get that far.
+    root = pack_dir.resolve()
+    for key, value in index.items():
+        if not isinstance(value, dict):
+            continue
+        rels = value.keys() if key == "files" else value.values()
+        for rel in rels:
+            if isinstance(rel, str) and not (root / rel).resolve().is_relative_to(root):
+                raise SystemExit(
+                    f"{index_path}: {key} entry points outside the pack: {rel}"
+                )
+
+
+@dataclass
+class PublishReport:
+    copied: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+    pruned: List[str] = field(default_factory=list)
+    index_changed: bool = False
+
+
+def publish_portraits(
+    src_dir: Path,
+    pack_dir: Path,
+    *,
+    section: str = "kins",
+    ext: str = "png",
+    prune: bool = True,
+) -> PublishReport:
+    """Copy ``src_dir/**/*.<ext>`` into a content pack and refresh its index.
+
+    Each output ``<slug>.<ext>`` becomes ``<pack_id>:<slug>`` in the index's
+    ``section`` map (``<pack_id>:<subdir>/<slug>`` for outputs in subdirs,
+    e.g. one per matrix style) (the existing string map read by the API). A separate
+    ``files`` map records sha256, byte size and dimensions per asset path so
+    the API can hand out content-addressed URLs. With ``prune``, entries whose
+    file no longer exists are dropped.
+    """
+    pack_id = read_pack_id(pack_dir)
+    index_path = pack_dir / INDEX_REL
+    try:
+        index = json.loads(index_path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        index = {}
+    if not isinstance(index, dict):
+        raise SystemExit(f"Invalid portrait index (expected an object): {index_path}")
+    _check_inside(pack_dir, index, index_path)
+    before = json.dumps(index, sort_keys=True)
+
+    refs_raw = index.get(section)
+    refs: Dict[str, str] = dict(refs_raw) if isinstance(refs_raw, dict) else {}
+    files_raw = index.get("files")
+    old_files: Mapping[str, Any] = files_raw if isinstance(files_raw, dict) else {}
+
+    report = PublishReport()
+    for src in sorted(src_dir.rglob(f"*.{ext}")):
+        sub = src.relative_to(src_dir)
+        if not src.is_file() or any(part.startswith(".") for part in sub.parts):
+            continue
+        rel = f"{PORTRAITS_REL}/{section}/{sub.as_posix()}"
+        dest = pack_dir / rel
+        if dest.exists() and _same_content(src, dest):
+            report.unchanged.append(rel)
+        else:
+            _copy_atomic(src, dest)
+            report.copied.append(rel)
+        refs[f"{pack_id}:{sub.with_suffix('').as_posix()}"] = rel
+
+    if prune:
+        for ref, rel in list(refs.items()):
+            if not isinstance(rel, str) or not (pack_dir / rel).is_file():
+                del refs[ref]
+                report.pruned.append(ref)
+
+    # Hash every asset any section references, so hand-added entries get
+    # hashes too; anything no longer referenced drops out of ``files``.
+    sections = {k: v for k, v in index.items() if k != "files" and isinstance(v, dict)}
+    sections[section] = refs
+    files: Dict[str, Any] = {}
+    for mapping in sections.values():
+        for rel in mapping.values():
+            if isinstance(rel, str) and (pack_dir / rel).is_file():
+                files[rel] = file_entry(pack_dir / rel)
+    if not prune:
+        for rel, entry in old_files.items():
+            files.setdefault(rel, entry)
+
+    new_index: Dict[str, Any] = {
+        **index,
+        section: refs,
+        "files": dict(sorted(files.items())),
+    }
+    if json.dumps(new_index, sort_keys=True) != before:
+        write_json_atomic(index_path, new_index)
+        report.index_changed = True
+    return report
+
+
+def print_publish_report(report: PublishReport, pack_dir: Path) -> None:
+    for rel in report.copied:
+        print(f"published: {rel}")
+    for ref in report.pruned:
+        print(f"pruned: {ref} (file missing)")
+    state = "updated" if report.index_changed else "unchanged"
+    print(
+        f"Pack {pack_dir}: {len(report.copied)} copied, "
+        f"{len(report.unchanged)} unchanged, {len(report.pruned)} pruned; "
+        f"index {state}"
+    )
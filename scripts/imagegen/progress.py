@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from portrait_index import write_json_atomic
+
+# Each running runner keeps one small JSON file named after its pid in a
+# shared directory; `imagegen.py status` reads them all. Files of processes
+# that are gone (killed without cleanup) are ignored and removed.
+
+
+class ProgressFile:
+    """This process's job progress, rewritten atomically on every change."""
+
+    def __init__(self, path: Path, *, job: str = "") -> None:
+        self.path = path
+        self.job = job  # label shown by `status`; a batch updates it per job
+        self._lock = threading.Lock()
+
+    def write(self, state: Dict[str, Any]) -> None:
+        with self._lock:
+            write_json_atomic(
+                self.path,
+                {"pid": os.getpid(), "job": self.job, "updated": time.time(), **state},
+            )
+
+    def close(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_progress(directory: Path) -> List[Dict[str, Any]]:
+    """Progress of every live runner, oldest first."""
+    out: List[Dict[str, Any]] = []
+    for path in sorted(directory.glob("*.json")):
+        try:
+            state = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue  # removed or being replaced right now
+        pid = state.get("pid") if isinstance(state, dict) else None
+        if not isinstance(pid, int) or not _alive(pid):
+            path.unlink(missing_ok=True)
+            continue
+        out.append(state)
+    return sorted(out, key=lambda s: s.get("started") or 0)
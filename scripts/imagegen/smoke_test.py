@@ -0,0 +1,989 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+from asset_index import AssetIndex, link_duplicates
+from concurrency import AimdController
+from daemon import GenerationDaemon, StandInBackend, make_server
+import imagegen
+import imagegen_lib
+from imagegen import validate_mixed_job_config
+from png_optimize import OptimizeLedger, optimize_pngs
+from png_tools import (
+    PngHeader,
+    decode_scanlines,
+    chunk_body,
+    embed_metadata,
+    encode_png,
+    idat_stream,
+    iter_chunks,
+    read_metadata,
+    read_text_chunks,
+)
+from portrait_index import INDEX_REL, PNG_SIGNATURE, publish_portraits
+from progress import ProgressFile, read_progress
+from status import render_status
+from timing_db import TimingDB, estimate_s, format_duration
+import tracing
+from verify import VerifyCache, check_image, requeue_entries, verify_tree
+from work_queue import WorkQueue
+from imagegen_lib import (
+    FAILURE_REPORT,
+    GenerationBackend,
+    RetryPolicy,
+    StageError,
+    GenerationResult,
+    JobItem,
+    PromptItem,
+    job_items_from_cfg,
+    retry_policy_from_cfg,
+    run_job,
+    slugify,
+    validate_job_config,
+    validate_matrix,
+)
+
+
+def meta_chunk_body(data: bytes) -> bytes:
+    return next(chunk_body(data, c) for c in iter_chunks(data) if c.ctype == b"iTXt")
+
+
+class StubBackend(GenerationBackend):
+    def __init__(self, name: str, *, slots: int = 1, delay_s: float = 0.0) -> None:
+        self.name = name
+        self.slots = slots
+        self.delay_s = delay_s
+        self.seen: list[str] = []
+        self._lock = threading.Lock()
+
+    def generate(self, item: JobItem) -> GenerationResult:
+        time.sleep(self.delay_s)
+        with self._lock:
+            self.seen.append(item.name)
+        if item.name == "boom":
+            raise RuntimeError("stub failure")
+        return GenerationResult(image=item.name.encode(), meta={"seed": item.idx})
+
+
+class ImagegenSmokeTests(unittest.TestCase):
+    def test_slugify(self) -> None:
+        self.assertEqual(slugify("Mallsing"), "mallsing")
+        self.assertEqual(slugify("  Elf (Wood)  "), "elf_wood")
+
+    def test_run_job_spreads_items_over_backends(self) -> None:
+        fast = StubBackend("fast", slots=2, delay_s=0.01)
+        slow = StubBackend("slow", delay_s=0.05)
+        items = [(f"item {i}", f"prompt {i}") for i in range(8)]
+        with tempfile.TemporaryDirectory() as td:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                outcomes = run_job(
+                    items,
+                    [fast, slow],
+                    out_dir=Path(td),
+                    out_ext="png",
+                    overwrite=False,
+                )
+            self.assertEqual(len(outcomes), 8)
+            self.assertEqual((Path(td) / "item_3.png").read_bytes(), b"item 3")
+        self.assertTrue(fast.seen and slow.seen)
+        self.assertEqual(len(fast.seen) + len(slow.seen), 8)
+        done = [l for l in out.getvalue().splitlines() if " done: " in l]
+        self.assertEqual(
+            [l.split("/")[0] for l in done], [f"[{i}" for i in range(1, 9)]
+        )
+
+    def test_run_job_skips_existing_and_reports_failure(self) -> None:
+        with tempfile.TemporaryDirectory() as td:
+            (Path(td) / "a.png").write_bytes(b"old")
+            backend = StubBackend("stub")
+            with contextlib.redirect_stdout(io.StringIO()):
+                with self.assertRaises(SystemExit) as ctx:
+                    run_job(
+                        [("a", "p"), ("boom", "p")],
+                        [backend],
+                        out_dir=Path(td),
+                        out_ext="png",
+                        overwrite=False,
+                    )
+            self.assertIn("boom", str(ctx.exception))
+            self.assertEqual(backend.seen, ["boom"])
+
+    def test_run_job_retries_by_stage_and_keeps_going(self) -> None:
+        class FlakyBackend(StubBackend):
+            def __init__(self) -> None:
+                super().__init__("flaky")
+                self.calls: dict[str, int] = {}
+
+            def generate(self, item: JobItem) -> GenerationResult:
+                n = self.calls[item.name] = self.calls.get(item.name, 0) + 1
+                if item.name == "flaky" and n == 1:
+                    raise StageError("wait", "timed out")
+                if item.name == "rejected":
+                    raise StageError("queue", "HTTP 400", retryable=False)
+                if item.name == "broken":
+                    raise StageError("download", "connection reset")
+                return super().generate(item)
+
+        backend = FlakyBackend()
+        failed = []
+        policy = RetryPolicy(attempts=3, backoff_s=0.01, max_backoff_s=0.02)
+        with tempfile.TemporaryDirectory() as td:
+            (Path(td) / FAILURE_REPORT).write_text("stale")
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                outcomes = run_job(
+                    [("flaky", "p"), ("rejected", "p"), ("broken", "p"), ("ok", "p")],
+                    [backend],
+                    out_dir=Path(td),
+                    out_ext="png",
+                    overwrite=False,
+                    retry=policy,
+                    keep_going=True,
+                    on_failure=failed.append,
+                )
+            self.assertEqual([o.item.name for o in outcomes], ["flaky", "ok"])
+            self.assertEqual(outcomes[0].meta["attempts"], 2)
+            self.assertEqual(
+                backend.calls, {"flaky": 2, "rejected": 1, "broken": 3, "ok": 1}
+            )
+            self.assertEqual(
+                [(f.item.name, f.stage, f.attempts) for f in failed],
+                [("rejected", "queue", 1), ("broken", "download", 3)],
+            )
+            report = json.loads((Path(td) / FAILURE_REPORT).read_text())
+            self.assertEqual(
+                [r["name"] for r in report["failed"]], ["rejected", "broken"]
+            )
+            self.assertIn("retry 2/3", out.getvalue())
+            self.assertIn("2 item(s) failed", out.getvalue())
+
+            # A clean rerun clears the report.
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_job(
+                    [("ok", "p")],
+                    [backend],
+                    out_dir=Path(td),
+                    out_ext="png",
+                    overwrite=True,
+                )
+            self.assertFalse((Path(td) / FAILURE_REPORT).exists())
+
+    def test_retry_policy_keeps_explicit_zero(self) -> None:
+        policy = retry_policy_from_cfg({"retry": {"backoff_s": 0, "attempts": 1}})
+        self.assertEqual((policy.attempts, policy.backoff_s), (1, 0.0))
+        self.assertEqual(retry_policy_from_cfg({}, attempts=5).attempts, 5)
+        for bad in ({"attempts": 0}, {"backoff_s": -1}, {"attempts": "3"}):
+            with self.assertRaises(SystemExit):
+                retry_policy_from_cfg({"retry": bad})
+
+    def test_run_job_warns_about_colliding_names(self) -> None:
+        backend = StubBackend("stub")
+        with tempfile.TemporaryDirectory() as td:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                run_job(
+                    [("Elf", "p"), ("elf", "q")],
+                    [backend],
+                    out_dir=Path(td),
+                    out_ext="png",
+                    overwrite=False,
+                )
+            self.assertEqual(backend.seen, ["Elf", "elf"])
+            self.assertIn("both write to elf.png", out.getvalue())
+
+    def test_run_job_consumes_generators_lazily(self) -> None:
+        pulled = []
+
+        def source():
+            for i in range(200):
+                pulled.append(i)
+                yield (f"item {i}", "p")
+
+        backend = StubBackend("stub")
+        first_pull: list[int] = []
+        orig = backend.generate
+
+        def generate(item: JobItem) -> GenerationResult:
+            if not first_pull:
+                first_pull.append(len(pulled))
+            return orig(item)
+
+        backend.generate = generate  # type: ignore[method-assign]
+        with tempfile.TemporaryDirectory() as td:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                outcomes = run_job(
+                    source(),
+                    [backend],
+                    out_dir=Path(td),
+                    out_ext="png",
+                    overwrite=False,
+                )
+        self.assertEqual(len(outcomes), 200)
+        # Generation started after reading only a handful of items.
+        self.assertLess(first_pull[0], 30)
+        self.assertIn("[200] done: item 199", out.getvalue())
+
+    def test_streaming_sources(self) -> None:
+        with tempfile.TemporaryDirectory() as td:
+            jsonl = Path(td) / "monsters.jsonl"
+            jsonl.write_text(
+                '{"name": "Ghoul", "prompt": "a ghoul"}\n\n'
+                '{"name": "Wyrm", "prompt": "a wyrm"}\n',
+                encoding="utf-8",
+            )
+            items = job_items_from_cfg(
+                {"source": {"type": "jsonl", "path": str(jsonl)}}
+            )
+            self.assertNotIsInstance(items, list)
+            self.assertEqual(
+                [(i.name, i.source, i.source_idx) for i in items],
+                [("Ghoul", "monsters.jsonl", 1), ("Wyrm", "monsters.jsonl", 2)],
+            )
+
+            jsonl.write_text('{"name": "Ghoul"}\n', encoding="utf-8")
+            with self.assertRaises(SystemExit) as ctx:
+                list(
+                    job_items_from_cfg(
+                        {"source": {"type": "jsonl", "path": str(jsonl)}}
+                    )
+                )
+            self.assertIn("monsters.jsonl:1", str(ctx.exception))
+
+            for name, heading in (("a.md", "Imp"), ("b.md", "Troll")):
+                (Path(td) / name).write_text(
+                    f"## {heading}\n\n```\n{heading} prompt\n```\n\n"
+                    f"## {heading} II\n\n```\nmore\n```\n",
+                    encoding="utf-8",
+                )
+            items = job_items_from_cfg(
+                {"source": {"type": "prompts_markdown_glob", "path": f"{td}/*.md"}}
+            )
+            out_dir = Path(td) / "out"
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                run_job(
+                    items,
+                    [StubBackend("stub")],
+                    out_dir=out_dir,
+                    out_ext="png",
+                    overwrite=False,
+                )
+            done = [l for l in out.getvalue().splitlines() if " done: " in l]
+            self.assertEqual(
+                [l.split("]")[0] for l in done],
+                ["[1 a.md#1", "[2 a.md#2", "[3 b.md#1", "[4 b.md#2"],
+            )
+            self.assertTrue((out_dir / "troll_ii.png").exists())
+
+    def test_matrix_expansion(self) -> None:
+        cfg = {
+            "items": [{"name": "Elf", "prompt": "an elf"}],
+            "matrix": {
+                "styles": [
+                    {"name": "default"},
+                    {"name": "Western", "prompt_prefix": "ink,", "negative": "anime"},
+                    {"name": "copy", "prompt_prefix": "ink,", "negative": "anime"},
+                ],
+                "seeds": [7, 7, 8],
+            },
+        }
+        validate_job_config(cfg, top_keys={"items", "matrix"}, sections={})
+        items = list(job_items_from_cfg(cfg))
+        # The duplicate style and seed collapse: 2 styles x 2 seeds remain.
+        self.assertEqual(
+            [(i.subdir, i.seed, i.prompt) for i in items],
+            [
+                ("default", 7, "an elf"),
+                ("default", 8, "an elf"),
+                ("western", 7, "ink, an elf"),
+                ("western", 8, "ink, an elf"),
+            ],
+        )
+
+        backend = StubBackend("stub")
+        with tempfile.TemporaryDirectory() as td:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                run_job(
+                    items,
+                    [backend],
+                    out_dir=Path(td),
+                    out_ext="png",
+                    overwrite=False,
+                )
+            self.assertTrue((Path(td) / "western" / "elf_seed8.png").exists())
+        self.assertIn("-> default/elf_seed7.png", out.getvalue())
+
+        with self.assertRaises(SystemExit):
+            validate_matrix({"styles": [{"name": "a", "prefix": "x"}]})
+        with self.assertRaises(SystemExit):
+            validate_matrix({"seeds": ["1"]})
+
+    def test_publish_portraits_updates_index(self) -> None:
+        png = PNG_SIGNATURE + b"\x00\x00\x00\rIHDR" + struct.pack(">II", 64, 32)
+        with tempfile.TemporaryDirectory() as td:
+            src = Path(td) / "out"
+            pack = Path(td) / "pack"
+            src.mkdir()
+            (pack / "assets/portraits/kins").mkdir(parents=True)
+            (pack / "pack.json").write_text('{"id": "core"}', encoding="utf-8")
+            (pack / INDEX_REL).write_text(
+                json.dumps({"kins": {"core:gone": "assets/portraits/kins/gone.png"}}),
+                encoding="utf-8",
+            )
+            (src / "elf.png").write_bytes(png + b"elf")
+
+            report = publish_portraits(src, pack)
+            self.assertEqual(report.copied, ["assets/portraits/kins/elf.png"])
+            self.assertEqual(report.pruned, ["core:gone"])
+            index = json.loads((pack / INDEX_REL).read_text(encoding="utf-8"))
+            self.assertEqual(
+                index["kins"], {"core:elf": "assets/portraits/kins/elf.png"}
+            )
+            entry = index["files"]["assets/portraits/kins/elf.png"]
+            self.assertEqual(entry["sha256"], hashlib.sha256(png + b"elf").hexdigest())
+            self.assertEqual(
+                (entry["bytes"], entry["width"], entry["height"]),
+                (len(png) + 3, 64, 32),
+            )
+
+            report = publish_portraits(src, pack)
+            self.assertFalse(report.copied or report.index_changed)
+
+            # Matrix outputs sit in one subdir per style.
+            (src / "western").mkdir()
+            (src / "western" / "elf_seed1.png").write_bytes(png + b"w")
+            report = publish_portraits(src, pack)
+            self.assertEqual(
+                report.copied, ["assets/portraits/kins/western/elf_seed1.png"]
+            )
+            index = json.loads((pack / INDEX_REL).read_text(encoding="utf-8"))
+            self.assertEqual(
+                index["kins"]["core:western/elf_seed1"],
+                "assets/portraits/kins/western/elf_seed1.png",
+            )
+
+            index["kins"]["core:evil"] = "../../outside.png"
+            (pack / INDEX_REL).write_text(json.dumps(index), encoding="utf-8")
+            with self.assertRaises(SystemExit) as ctx:
+                publish_portraits(src, pack)
+            self.assertIn("outside the pack", str(ctx.exception))
+
+    def test_asset_index_clusters_and_links(self) -> None:
+        def gradient(w: int, h: int, bump: int = 0) -> bytes:
+            rows = [
+                bytes(
+                    min(255, (x * 255 // w) + bump) for x in range(w) for _ in range(3)
+                )
+                for _ in range(h)
+            ]
+            return encode_png(PngHeader(w, h, 8, 2, 0), rows)
+
+        with tempfile.TemporaryDirectory() as td:
+            a, b = Path(td) / "a", Path(td) / "b"
+            a.mkdir()
+            b.mkdir()
+            (a / "elf.png").write_bytes(gradient(64, 48))
+            (b / "elf.png").write_bytes(gradient(64, 48))
+            (b / "elf_v2.png").write_bytes(gradient(64, 48, bump=2))
+            (b / "noise.png").write_bytes(
+                encode_png(
+                    PngHeader(64, 48, 8, 0, 0),
+                    [
+                        bytes((x * 7919 + y * 104729) % 251 for x in range(64))
+                        for y in range(48)
+                    ],
+                )
+            )
+            index = AssetIndex(Path(td) / "assets.sqlite")
+            try:
+                roots = [a, b]
+                self.assertEqual(index.refresh(roots), 4)
+                self.assertEqual(index.refresh(roots), 0)
+                exact = index.exact_clusters(roots)
+                self.assertEqual(
+                    exact,
+                    [[str((a / "elf.png").resolve()), str((b / "elf.png").resolve())]],
+                )
+                similar = index.similar_clusters(roots)
+                self.assertEqual(len(similar), 1)
+                self.assertEqual(len(similar[0]), 3)
+                self.assertNotIn(str((b / "noise.png").resolve()), similar[0])
+
+                link_duplicates(exact)
+                self.assertTrue(os.path.samefile(a / "elf.png", b / "elf.png"))
+            finally:
+                index.close()
+
+    def test_run_job_embeds_metadata_chunk(self) -> None:
+        backend = StandInBackend(delay_s=0.0, size=8)
+        with tempfile.TemporaryDirectory() as td:
+            out = Path(td)
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_job(
+                    [PromptItem("Elf", "portrait of an élf", source="kins.md", seed=7)],
+                    [backend],
+                    out_dir=out,
+                    out_ext="png",
+                    overwrite=False,
+                )
+                run_job(
+                    [("Plain", "p")],
+                    [backend],
+                    out_dir=out / "plain",
+                    out_ext="png",
+                    overwrite=False,
+                    metadata=False,
+                )
+            data = (out / "elf_seed7.png").read_bytes()
+            meta = read_metadata(out / "elf_seed7.png")
+            self.assertEqual(meta["prompt"], "portrait of an élf")
+            self.assertEqual(meta["seed"], 7)
+            self.assertEqual(meta["backend"], "stand-in")
+            self.assertEqual((meta["name"], meta["source"]), ("Elf", "kins.md"))
+            # Spliced in after IHDR; the image data itself is untouched.
+            self.assertEqual(
+                [c.ctype for c in iter_chunks(data, check_crc=True)][:3],
+                [b"IHDR", b"iTXt", b"IDAT"],
+            )
+            raw = backend.generate(JobItem(1, "Elf", "portrait of an élf", out)).image
+            self.assertEqual(idat_stream(data), idat_stream(raw))
+            self.assertEqual(len(data) - len(raw), 12 + len(meta_chunk_body(data)))
+            plain = out / "plain/plain.png"
+            self.assertIsNone(read_metadata(plain))
+            self.assertEqual(read_text_chunks(plain), {})
+
+    def test_optimize_pngs_is_lossless_and_uses_ledger(self) -> None:
+        header = PngHeader(48, 32, 8, 2, 0)
+        rows = [bytes((x // 4 + y) % 256 for x in range(48 * 3)) for y in range(32)]
+        loose = encode_png(header, rows, level=1)
+        with tempfile.TemporaryDirectory() as td:
+            path = Path(td) / "a.png"
+            path.write_bytes(loose)
+            ledger = OptimizeLedger(Path(td) / "ledger.sqlite")
+            try:
+                (first,) = optimize_pngs([Path(td)], ledger=ledger)
+                self.assertEqual(first.status, "optimized")
+                self.assertLess(first.after, len(loose))
+                self.assertEqual(decode_scanlines(path.read_bytes()), (header, rows))
+                (again,) = optimize_pngs([Path(td)], ledger=ledger)
+                self.assertEqual(again.status, "skipped")
+            finally:
+                ledger.close()
+
+    def test_verify_finds_corrupt_and_mismatched_files(self) -> None:
+        good = encode_png(PngHeader(8, 8, 8, 0, 0), [bytes(range(8))] * 8)
+        jpeg = b"\xff\xd8\xff\xe0\x00\x04ab\xff\xda\x00\x02scan\xff\xd9"
+        webp = b"RIFF\x10\x00\x00\x00WEBPVP8L\x03\x00\x00\x00abc\x00"
+        check_image(jpeg)
+        check_image(webp)
+        with self.assertRaises(ValueError):
+            check_image(jpeg[:-2])
+        with self.assertRaises(ValueError):
+            check_image(webp[:-4])
+
+        with tempfile.TemporaryDirectory() as td:
+            pack = Path(td) / "pack"
+            assets = pack / "assets/portraits/kins"
+            assets.mkdir(parents=True)
+            (assets / "ok.png").write_bytes(good)
+            (assets / "photo.jpg").write_bytes(jpeg)
+            (assets / "edited.png").write_bytes(good)
+            meta = {"v": 1, "name": "Cut Off", "prompt": "a portrait"}
+            (assets / "cut.png").write_bytes(embed_metadata(good, meta)[:-20])
+            flipped = bytearray(good)
+            flipped[-20] ^= 0xFF  # inside the IDAT payload: CRC no longer matches
+            (assets / "crc.png").write_bytes(bytes(flipped))
+            index = {
+                "files": {
+                    "assets/portraits/kins/ok.png": {
+                        "sha256": hashlib.sha256(good).hexdigest()
+                    },
+                    "assets/portraits/kins/edited.png": {"sha256": "0" * 64},
+                    "assets/portraits/kins/gone.png": {"sha256": "0" * 64},
+                }
+            }
+            (pack / INDEX_REL).write_text(json.dumps(index), encoding="utf-8")
+
+            cache = VerifyCache(Path(td) / "verified.sqlite")
+            try:
+                results = verify_tree([pack / "assets"], packs=[pack], cache=cache)
+                status = {Path(r.path).name: r.status for r in results}
+                self.assertEqual(
+                    status,
+                    {
+                        "ok.png": "ok",
+                        "photo.jpg": "ok",
+                        "edited.png": "mismatch",
+                        "gone.png": "missing",
+                        "cut.png": "corrupt",
+                        "crc.png": "corrupt",
+                    },
+                )
+                again = verify_tree([pack / "assets"], packs=[pack], cache=cache)
+            finally:
+                cache.close()
+            status = {Path(r.path).name: r.status for r in again}
+            self.assertEqual(status["ok.png"], "cached")
+            self.assertEqual(status["crc.png"], "corrupt")
+            # Only the truncated file still carries its generation metadata.
+            self.assertEqual(
+                requeue_entries(results), [{"name": "Cut Off", "prompt": "a portrait"}]
+            )
+
+            # --requeue deletes only what it could requeue.
+            args = argparse.Namespace(
+                roots=[str(pack / "assets")],
+                no_cache=True,
+                cache=None,
+                deep=False,
+                workers=1,
+                requeue=str(Path(td) / "requeue.jsonl"),
+                delete=False,
+            )
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+                io.StringIO()
+            ):
+                self.assertEqual(imagegen.cmd_verify(args), 1)
+            self.assertFalse((assets / "cut.png").exists())
+            self.assertTrue((assets / "crc.png").exists())
+
+    def test_daemon_coalesces_and_prioritizes(self) -> None:
+        backend = StandInBackend(delay_s=0.2)
+        with tempfile.TemporaryDirectory() as td:
+            service = GenerationDaemon([backend], out_dir=Path(td))
+            service.start()
+            server = make_server(service, "127.0.0.1", 0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base = f"http://127.0.0.1:{server.server_address[1]}"
+
+            def post(body: dict) -> dict:
+                req = urllib.request.Request(
+                    f"{base}/requests",
+                    data=json.dumps(body).encode("utf-8"),
+                    headers={"Content-Type": "application/json"},
+                )
+                with urllib.request.urlopen(req) as resp:
+                    return json.loads(resp.read())
+
+            try:
+                first = post({"prompt": "an elf"})  # occupies the only slot
+                bulk = post({"prompt": "a dwarf", "priority": "bulk"})
+                urgent = post({"prompt": "a wolfkin"})
+                again = post({"prompt": "an elf", "name": "Elf"})
+                self.assertEqual(again["id"], first["id"])
+                self.assertTrue(again["coalesced"])
+
+                with urllib.request.urlopen(
+                    f"{base}/requests/{bulk['id']}/events"
+                ) as resp:
+                    events = [
+                        json.loads(line[len(b"data: ") :])
+                        for line in resp.read().splitlines()
+                        if line.startswith(b"data: ")
+                    ]
+                self.assertEqual(events[-1]["status"], "done")
+
+                states = {r["id"]: service.get(r["id"]) for r in (first, bulk, urgent)}
+                # The interactive request overtook the bulk one queued before it.
+                self.assertLess(
+                    states[urgent["id"]].started, states[bulk["id"]].started
+                )
+                self.assertEqual(backend.calls, 3)
+                with urllib.request.urlopen(
+                    f"{base}/requests/{first['id']}/image"
+                ) as r:
+                    self.assertEqual(r.read()[:8], PNG_SIGNATURE)
+                with self.assertRaises(urllib.error.HTTPError) as ctx:
+                    post({"prompt": "x", "steps": 4})
+                self.assertEqual(ctx.exception.code, 400)
+            finally:
+                server.shutdown()
+                server.server_close()
+                service.stop()
+
+    def test_daemon_forgets_finished_requests(self) -> None:
+        with tempfile.TemporaryDirectory() as td:
+            service = GenerationDaemon(
+                [StandInBackend(delay_s=0)], out_dir=Path(td), keep_s=0
+            )
+            other = GenerationDaemon([StandInBackend(size=32)], out_dir=Path(td))
+            service.start()
+            try:
+                req, _ = service.submit({"prompt": "an elf"})
+                while service.get(req.id).status != "done":
+                    time.sleep(0.01)
+                service.submit({"prompt": "a dwarf"})
+                self.assertIsNone(service.get(req.id))
+                # Found on disk again rather than rendered twice.
+                again, _ = service.submit({"prompt": "an elf"})
+                self.assertEqual((again.id, again.status), (req.id, "done"))
+
+                # A done image that was deleted (or cut short) is rendered
+                # again rather than served.
+                self.assertIsNotNone(service.image(again))
+                again.out_path.unlink()
+                self.assertIsNone(service.image(again))
+                self.assertEqual(again.status, "failed")
+                fresh, coalesced = service.submit({"prompt": "an elf"})
+                self.assertFalse(coalesced)
+                while service.get(req.id).status != "done":
+                    time.sleep(0.01)
+                data = fresh.out_path.read_bytes()
+                fresh.out_path.write_bytes(data[:-20])
+                retry, coalesced = service.submit({"prompt": "an elf"})
+                self.assertFalse(coalesced)
+                self.assertNotEqual(retry.status, "done")
+            finally:
+                service.stop()
+        # Other render settings make another image.
+        self.assertNotEqual(other.fingerprint, service.fingerprint)
+
+    def test_aimd_controller_finds_capacity_and_backs_off(self) -> None:
+        # Simulated server that renders two items at a time, 10s each: more
+        # in flight only adds queueing latency.
+        now = [0.0]
+        pressure: list[float | None] = [None]
+        log: list[str] = []
+        ctl = AimdController(
+            "sim",
+            initial=1,
+            ceiling=8,
+            pressure=lambda: pressure[0],
+            log=log.append,
+            clock=lambda: now[0],
+        )
+        stop = threading.Event()
+
+        def epoch(*, ok: bool = True) -> None:
+            n = ctl.limit
+            parallel = min(n, 2)
+            for _ in range(n):
+                self.assertTrue(ctl.acquire(stop))
+            now[0] += 10.0 * n / parallel
+            for _ in range(n):
+                ctl.release(10.0 * n / parallel, ok=ok)
+
+        seen = set()
+        for _ in range(20):
+            epoch()
+            seen.add(ctl.limit)
+        self.assertEqual(max(seen), 3)  # probed one past capacity, never further
+        self.assertIn(ctl.limit, {2, 3})
+        self.assertTrue(any("no gain" in line for line in log))
+
+        for _ in range(3):
+            epoch()
+        before = ctl.limit
+        epoch(ok=False)
+        self.assertEqual(ctl.limit, max(1, before // 2))
+        self.assertIn("failure", log[-1])
+
+        ctl.limit = 4
+        pressure[0] = 0.95
+        epoch()
+        self.assertEqual(ctl.limit, 2)
+        self.assertIn("VRAM 95%", log[-1])
+
+        # The pressure probe runs outside the lock: other workers aren't
+        # held up while it waits on the server.
+        def slow_probe() -> float | None:
+            other = threading.Thread(target=ctl.acquire, args=(stop,))
+            other.start()
+            other.join(2.0)
+            self.assertFalse(other.is_alive())
+            ctl.cancel()
+            return None
+
+        ctl = AimdController("probe", initial=1, ceiling=4, pressure=slow_probe)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(ctl.acquire(stop))
+            ctl.release(1.0, ok=True)
+        self.assertEqual(ctl.limit, 2)
+
+    def test_run_job_adaptive_lane(self) -> None:
+        backend = StubBackend("a", delay_s=0.01)
+        backend.max_slots = 3
+        with tempfile.TemporaryDirectory() as td:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                outcomes = run_job(
+                    [(f"Item {i}", f"prompt {i}") for i in range(12)],
+                    [backend],
+                    out_dir=Path(td),
+                    out_ext="png",
+                    overwrite=False,
+                )
+            self.assertEqual(len(outcomes), 12)
+            self.assertIn("adaptive, max 3", out.getvalue())
+            self.assertIn("Concurrency a: finished at", out.getvalue())
+
+    def test_run_job_abort_does_not_wait_for_slow_renders(self) -> None:
+        class FailsFast(StubBackend):
+            def generate(self, item: JobItem) -> GenerationResult:
+                if item.name == "boom":
+                    raise RuntimeError("stub failure")
+                return super().generate(item)
+
+        backend = FailsFast("a", slots=2, delay_s=5.0)
+        saved = imagegen_lib.ABORT_JOIN_S
+        imagegen_lib.ABORT_JOIN_S = 0.2
+        try:
+            with tempfile.TemporaryDirectory() as td:
+                started = time.monotonic()
+                with contextlib.redirect_stdout(io.StringIO()) as out:
+                    with self.assertRaises(SystemExit):
+                        run_job(
+                            [("boom", "p1"), ("slow", "p2")],
+                            [backend],
+                            out_dir=Path(td),
+                            out_ext="png",
+                            overwrite=False,
+                        )
+        finally:
+            imagegen_lib.ABORT_JOIN_S = saved
+        self.assertLess(time.monotonic() - started, 3.0)
+        self.assertIn("Stopped waiting for 1 worker(s)", out.getvalue())
+
+    def test_trace_spans_cover_worker_items(self) -> None:
+        self.assertIs(tracing.span("off"), tracing.NO_SPAN)
+        with tempfile.TemporaryDirectory() as td:
+            trace_path = Path(td) / "trace.json"
+            with contextlib.redirect_stdout(io.StringIO()):
+                with tracing.session(str(trace_path), "test generate"):
+                    run_job(
+                        [("Elf", "p1"), ("Dwarf", "p2"), ("Human", "p3")],
+                        [StubBackend("a"), StubBackend("b")],
+                        out_dir=Path(td) / "out",
+                        out_ext="png",
+                        overwrite=False,
+                    )
+            self.assertIs(tracing.span("off again"), tracing.NO_SPAN)
+            events = json.loads(trace_path.read_text())["traceEvents"]
+
+        spans = {e["args"]["span_id"]: e for e in events if e["ph"] == "X"}
+        by_name: dict[str, list[dict]] = {}
+        for e in spans.values():
+            by_name.setdefault(e["name"], []).append(e)
+        root = by_name["test generate"][0]
+        job = by_name["run_job"][0]
+        self.assertEqual(job["args"]["parent_id"], root["args"]["span_id"])
+        items = by_name["item"]
+        self.assertEqual(
+            sorted(e["args"]["item"] for e in items), ["Dwarf", "Elf", "Human"]
+        )
+        for e in items:
+            self.assertEqual(e["args"]["parent_id"], job["args"]["span_id"])
+            self.assertNotEqual(e["tid"], job["tid"])
+        for e in by_name["write"]:
+            self.assertIn(spans[e["args"]["parent_id"]]["name"], {"item"})
+        self.assertEqual(sum(1 for e in events if e["ph"] == "s"), 3)
+        self.assertTrue(any(e["ph"] == "M" for e in events))
+
+    def test_validate_mixed_job_config(self) -> None:
+        cfg = {
+            "version": 1,
+            "generate": {"width": 512},
+            "backends": [
+                {
+                    "type": "comfyui",
+                    "checkpoint": {"name": "x.safetensors"},
+                    "generate": {"sampler": "euler"},
+                },
+                {"type": "ollama", "model": "x/z-image-turbo"},
+            ],
+            "items": [{"name": "a", "prompt": "b"}],
+        }
+        comfy, oll = validate_mixed_job_config(cfg)
+        self.assertEqual(comfy["generate"], {"width": 512, "sampler": "euler"})
+        self.assertEqual(oll["generate"], {"width": 512})
+        # Ollama has no sampler setting, so it can't be shared with it.
+        with self.assertRaises(SystemExit):
+            validate_mixed_job_config({**cfg, "generate": {"sampler": "euler"}})
+
+        with self.assertRaises(SystemExit):
+            validate_mixed_job_config({"backends": [{"type": "dall-e"}]})
+        with self.assertRaises(SystemExit):
+            validate_mixed_job_config(
+                {"backends": [{"type": "ollama", "output": {"dir": "x"}}]}
+            )
+
+    def test_timing_db_median_and_regressions(self) -> None:
+        key = {"backend": "comfyui", "model": "m", "width": 512, "height": 512}
+        with tempfile.TemporaryDirectory() as td:
+            path = Path(td) / "t.sqlite"
+            old = TimingDB(path)
+            for s in (10.0, 11.0, 12.0):
+                old.record(key, item="x", total_s=s, success=True)
+            old.record(key, item="x", total_s=99.0, success=False)
+            old.close()
+
+            db = TimingDB(path)
+            self.assertEqual(db.median_s(key), 11.0)
+            self.assertIsNone(db.median_s({**key, "steps": 30}))
+            self.assertIsNone(db.median_s({**key, "mode": "img2img"}))
+            for s in (25.0, 26.0, 27.0):
+                db.record(key, item="x", total_s=s, success=True)
+            # The current run doesn't count towards its own baseline.
+            self.assertEqual(db.median_s(key), 11.0)
+            warnings = db.regressions([key])
+            db.close()
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("2.4x slower", warnings[0])
+
+    def test_estimate_and_duration_format(self) -> None:
+        # 2 slots at 10s/item + 1 slot at 20s/item = 0.25 items/s.
+        self.assertEqual(estimate_s(10, [(10.0, 2), (20.0, 1), (None, 4)]), 40.0)
+        self.assertIsNone(estimate_s(3, [(None, 1)]))
+        self.assertEqual(format_duration(42), "42s")
+        self.assertEqual(format_duration(252), "4m12s")
+        self.assertEqual(format_duration(3720), "1h02m")
+
+    def test_run_job_records_timings(self) -> None:
+        with tempfile.TemporaryDirectory() as td:
+            db = TimingDB(Path(td) / "t.sqlite")
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                run_job(
+                    [("a", "p"), ("b", "p"), ("c", "p")],
+                    [StubBackend("stub")],
+                    out_dir=Path(td) / "out",
+                    out_ext="png",
+                    overwrite=False,
+                    timings=db,
+                )
+            self.assertEqual(len(db.durations({"backend": "stub"}, this_run=True)), 3)
+            db.close()
+        self.assertIn("ETA", out.getvalue())
+
+    def test_run_job_writes_progress_for_status(self) -> None:
+        with tempfile.TemporaryDirectory() as td:
+            progress = ProgressFile(Path(td) / "progress" / "1.json", job="kins")
+            out_dir = Path(td) / "out"
+            out_dir.mkdir()
+            (out_dir / "a.png").write_bytes(b"existing")
+            with contextlib.redirect_stdout(io.StringIO()):
+                run_job(
+                    [("a", "p"), ("b", "p"), ("c", "p")],
+                    [StubBackend("stub", slots=2)],
+                    out_dir=out_dir,
+                    out_ext="png",
+                    overwrite=False,
+                    progress=progress,
+                )
+            (state,) = read_progress(Path(td) / "progress")
+            self.assertEqual(state["pid"], os.getpid())
+            self.assertEqual(
+                (state["total"], state["done"], state["skipped"], state["in_flight"]),
+                (2, 2, 1, 0),
+            )
+            self.assertEqual(state["lanes"][0]["done"], 2)
+            state["lanes"][0]["hosts"] = [
+                {"host": "gpu1", "in_flight": 1, "assigned": 4, "healthy": True},
+                {"host": "gpu2", "in_flight": 0, "assigned": 2, "healthy": False},
+            ]
+            view = render_status(
+                [state],
+                [{"server": "http://gpu:8188", "running": 1, "pending": 3}],
+                now=state["updated"],
+            )
+            progress.close()
+            self.assertEqual(read_progress(Path(td) / "progress"), [])
+        self.assertIn("kins: done 2/2, in flight 0, pending 0", view)
+        self.assertIn("http://gpu:8188: running 1, queued 3", view)
+        self.assertIn("host gpu2: DOWN, in flight 0, assigned 2", view)
+
+    def test_runners_sharing_a_work_queue_split_items(self) -> None:
+        items = [(f"item {i}", f"prompt {i}") for i in range(12)]
+        with tempfile.TemporaryDirectory() as td:
+            db = Path(td) / "queue.sqlite"
+            out_dir = Path(td) / "out"
+            # A runner that died holding item 0; its lease runs out mid-job.
+            dead = WorkQueue(db, job="job", lease_s=0.3, owner="dead:1")
+            payload = {"idx": 1, "name": "item 0", "prompt": "prompt 0"}
+            self.assertIsNone(dead.claim("item_0.png", payload))
+            backends = [StubBackend(f"r{i}", delay_s=0.02) for i in range(2)]
+
+            def runner(i: int) -> None:
+                claims = WorkQueue(db, job="job", lease_s=0.9, owner=f"r{i}")
+                claims.start()
+                try:
+                    run_job(
+                        items,
+                        [backends[i]],
+                        out_dir=out_dir,
+                        out_ext="png",
+                        overwrite=True,
+                        claims=claims,
+                    )
+                finally:
+                    claims.close()
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                threads = [threading.Thread(target=runner, args=(i,)) for i in (0, 1)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            seen = backends[0].seen + backends[1].seen
+            self.assertEqual(sorted(seen), sorted(name for name, _ in items))
+            self.assertEqual(dead.counts(), {"done": 12})
+            # Finished items aren't handed out again, even to a later runner.
+            self.assertRegex(dead.claim("item_5.png", {}) or "", r"^done by r[01]$")
+            dead.close()
+
+    def test_work_queue_renders_deleted_outputs_again(self) -> None:
+        items = [("a", "p"), ("b", "p")]
+        with tempfile.TemporaryDirectory() as td:
+            out_dir = Path(td) / "out"
+            backend = StubBackend("r")
+            for _ in range(2):
+                claims = WorkQueue(Path(td) / "q.sqlite", job="job", owner="r")
+                claims.start()
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        run_job(
+                            items,
+                            [backend],
+                            out_dir=out_dir,
+                            out_ext="png",
+                            overwrite=False,
+                            claims=claims,
+                        )
+                finally:
+                    claims.close()
+                (out_dir / "b.png").unlink()  # e.g. by verify --delete
+            self.assertEqual(backend.seen, ["a", "b", "b"])
+
+    def test_work_queue_hands_failed_items_out_after_a_lease(self) -> None:
+        with tempfile.TemporaryDirectory() as td:
+            a = WorkQueue(Path(td) / "q.sqlite", job="job", lease_s=0.2, owner="a")
+            b = WorkQueue(Path(td) / "q.sqlite", job="job", lease_s=0.2, owner="b")
+            self.assertIsNone(a.claim("x.png", {}))
+            a.fail("x.png", "boom")
+            self.assertEqual(b.claim("x.png", {}), "failed by a")
+            time.sleep(0.3)
+            self.assertIsNone(b.claim("x.png", {}))
+            self.assertEqual(b.counts(), {"leased": 1})
+            a.close()
+            b.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
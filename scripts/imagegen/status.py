@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import time
+import urllib.request
+from typing import Any, Dict, List, Sequence
+
+from timing_db import format_duration
+
+GIB = 1024**3
+
+# A runner that hasn't written progress for this long is probably stuck on
+# one long render (or hung); `status` says so next to it.
+STALE_S = 120.0
+
+
+def _get_json(url: str, timeout_s: float) -> Any:
+    with urllib.request.urlopen(url, timeout=timeout_s) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def poll_server(server: str, *, timeout_s: float = 3.0) -> Dict[str, Any]:
+    """Queue depth and memory use of one ComfyUI server (``error`` if down)."""
+    server = server.rstrip("/")
+    out: Dict[str, Any] = {"server": server}
+    try:
+        q = _get_json(f"{server}/queue", timeout_s)
+        stats = _get_json(f"{server}/system_stats", timeout_s)
+    except Exception as e:
+        out["error"] = str(e)
+        return out
+    out["running"] = len(q.get("queue_running") or [])
+    out["pending"] = len(q.get("queue_pending") or [])
+    system = stats.get("system") or {}
+    if isinstance(system.get("ram_total"), (int, float)):
+        out["ram"] = (
+            system["ram_total"] - system.get("ram_free", 0),
+            system["ram_total"],
+        )
+    devices = [d for d in stats.get("devices") or [] if isinstance(d, dict)]
+    out["devices"] = [
+        (
+            str(d.get("name") or "gpu"),
+            d["vram_total"] - d.get("vram_free", 0),
+            d["vram_total"],
+        )
+        for d in devices
+        if isinstance(d.get("vram_total"), (int, float)) and d["vram_total"] > 0
+    ]
+    return out
+
+
+def servers_in_use(
+    runners: Sequence[Dict[str, Any]], extra: Sequence[str]
+) -> List[str]:
+    """ComfyUI servers the runners' lanes talk to, plus ``extra``."""
+    found = [s.rstrip("/") for s in extra]
+    for r in runners:
+        for lane in r.get("lanes") or []:
+            server = str(lane.get("server") or "").rstrip("/")
+            if lane.get("backend") == "comfyui" and server and server not in found:
+                found.append(server)
+    return found
+
+
+def _gib(used: float, total: float) -> str:
+    return f"{used / GIB:.1f}/{total / GIB:.1f} GiB ({used / total:.0%})"
+
+
+def render_status(
+    runners: Sequence[Dict[str, Any]],
+    servers: Sequence[Dict[str, Any]],
+    *,
+    now: float,
+) -> str:
+    lines = [f"imagegen status  {time.strftime('%H:%M:%S', time.localtime(now))}", ""]
+    lines.append("Runners:" if runners else "Runners: none running")
+    for r in runners:
+        total = r.get("total")
+        done = r.get("done", 0)
+        failed = r.get("failed", 0)
+        in_flight = r.get("in_flight", 0)
+        if total is not None:
+            pending = max(0, total - done - failed - in_flight)
+            counts = f"done {done}/{total}, in flight {in_flight}, pending {pending}"
+        else:
+            counts = f"done {done}, in flight {in_flight}"
+        counts += f", failed {failed}, skipped {r.get('skipped', 0)}"
+        per_min = r.get("per_min")
+        rate = f"{per_min:.1f}/min" if per_min else "-/min"
+        eta = r.get("eta_s")
+        eta_note = f", ETA {format_duration(eta)}" if eta else ""
+        idle = now - float(r.get("updated") or now)
+        stale = f"  (no update for {format_duration(idle)})" if idle > STALE_S else ""
+        job = r.get("job") or "?"
+        lines.append(f"  pid {r.get('pid')} {job}: {counts}; {rate}{eta_note}{stale}")
+        for lane in r.get("lanes") or []:
+            where = f" {lane['server']}" if lane.get("server") else ""
+            busy = f"{lane.get('in_flight', 0)}/{lane.get('limit', 1)}"
+            lines.append(
+                f"    {lane.get('backend')}{where}: in flight {busy}, "
+                f"done {lane.get('done', 0)}"
+            )
+            for h in lane.get("hosts") or []:
+                health = "up" if h.get("healthy", True) else "DOWN"
+                lines.append(
+                    f"      host {h.get('host')}: {health}, "
+                    f"in flight {h.get('in_flight', 0)}, "
+                    f"assigned {h.get('assigned', 0)}"
+                )
+    if servers:
+        lines += ["", "Servers:"]
+    for s in servers:
+        if "error" in s:
+            lines.append(f"  {s['server']}: unreachable ({s['error']})")
+            continue
+        parts = [f"running {s['running']}", f"queued {s['pending']}"]
+        for name, used, total in s.get("devices") or []:
+            parts.append(f"VRAM {_gib(used, total)} [{name}]")
+        if s.get("ram"):
+            parts.append(f"RAM {_gib(*s['ram'])}")
+        lines.append(f"  {s['server']}: " + ", ".join(parts))
+    return "\n".join(lines)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import statistics
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Sequence, Tuple
+
+# Everything that should make two renders comparable. Prompts are left out on
+# purpose: they barely move render time, and including them would leave every
+# new item without history.
+# ``mode`` is empty for renders from noise and e.g. "img2img" for refreshes,
+# whose ``steps`` are the ones actually sampled.
+KEY_FIELDS = ("backend", "model", "width", "height", "steps", "sampler", "mode")
+
+# A run is flagged when its median is this much slower than history.
+REGRESSION_RATIO = 1.5
+# Medians are only trusted once there are at least this many samples.
+MIN_SAMPLES = 3
+# Only the most recent records count, so old hardware ages out.
+HISTORY_WINDOW = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    backend TEXT NOT NULL,
+    model TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    steps INTEGER NOT NULL,
+    sampler TEXT NOT NULL,
+    item TEXT NOT NULL,
+    stages TEXT NOT NULL,
+    total_s REAL NOT NULL,
+    success INTEGER NOT NULL,
+    mode TEXT NOT NULL DEFAULT ''
+);
+"""
+
+# Files from before ``mode`` existed get the column (their rows are all
+# renders from noise) before the index that covers it is created.
+MIGRATE = "ALTER TABLE generations ADD COLUMN mode TEXT NOT NULL DEFAULT ''"
+
+INDEX = """
+CREATE INDEX IF NOT EXISTS generations_key_mode
+    ON generations (backend, model, width, height, steps, sampler, mode, success);
+"""
+
+
+def normalize_key(key: Mapping[str, Any]) -> Tuple[Any, ...]:
+    # Unknown values are stored as ""/0 so they still group together.
+    out: List[Any] = []
+    for f in KEY_FIELDS:
+        v = key.get(f)
+        if f in {"width", "height", "steps"}:
+            out.append(int(v) if v is not None else 0)
+        else:
+            out.append(str(v) if v is not None else "")
+    return tuple(out)
+
+
+def describe_key(key: Mapping[str, Any]) -> str:
+    backend, model, width, height, steps, sampler, mode = normalize_key(key)
+    parts = [backend, model or "?", f"{width or '?'}x{height or '?'}"]
+    if steps:
+        parts.append(f"{steps} steps")
+    if sampler:
+        parts.append(sampler)
+    if mode:
+        parts.append(mode)
+    return " ".join(parts)
+
+
+def format_duration(seconds: float) -> str:
+    s = int(round(seconds))
+    if s < 60:
+        return f"{s}s"
+    m, s = divmod(s, 60)
+    if m < 60:
+        return f"{m}m{s:02d}s"
+    h, m = divmod(m, 60)
+    return f"{h}h{m:02d}m"
+
+
+class TimingDB:
+    """Per-item generation timings kept in a local SQLite file."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.run_id = uuid.uuid4().hex
+        self._conn = sqlite3.connect(str(path))
+        self._conn.executescript(SCHEMA)
+        columns = {r[1] for r in self._conn.execute("PRAGMA table_info(generations)")}
+        if "mode" not in columns:
+            try:
+                self._conn.execute(MIGRATE)
+            except sqlite3.OperationalError:
+                pass  # another runner migrated it first
+        self._conn.executescript(INDEX)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def record(
+        self,
+        key: Mapping[str, Any],
+        *,
+        item: str,
+        total_s: float,
+        success: bool,
+        stages: Mapping[str, float] | None = None,
+    ) -> None:
+        self._conn.execute(
+            "INSERT INTO generations (run_id, ts, backend, model, width, height,"
+            " steps, sampler, mode, item, stages, total_s, success)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.run_id,
+                time.time(),
+                *normalize_key(key),
+                item,
+                json.dumps({k: round(v, 3) for k, v in (stages or {}).items()}),
+                total_s,
+                1 if success else 0,
+            ),
+        )
+        self._conn.commit()
+
+    def durations(
+        self, key: Mapping[str, Any], *, this_run: bool = False
+    ) -> List[float]:
+        op = "=" if this_run else "!="
+        rows = self._conn.execute(
+            "SELECT total_s FROM generations"
+            " WHERE backend=? AND model=? AND width=? AND height=? AND steps=?"
+            f" AND sampler=? AND mode=? AND success=1 AND run_id {op} ?"
+            " ORDER BY id DESC LIMIT ?",
+            (*normalize_key(key), self.run_id, HISTORY_WINDOW),
+        ).fetchall()
+        return [float(r[0]) for r in rows]
+
+    def median_s(self, key: Mapping[str, Any]) -> float | None:
+        """Historical median for ``key``, ignoring the current run."""
+        samples = self.durations(key)
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return statistics.median(samples)
+
+    def regressions(
+        self, keys: Sequence[Mapping[str, Any]], *, ratio: float = REGRESSION_RATIO
+    ) -> List[str]:
+        """Describe configurations this run rendered notably slower than usual."""
+        out: List[str] = []
+        seen: set[Tuple[Any, ...]] = set()
+        for key in keys:
+            norm = normalize_key(key)
+            if norm in seen:
+                continue
+            seen.add(norm)
+            hist = self.median_s(key)
+            now = self.durations(key, this_run=True)
+            if hist is None or len(now) < MIN_SAMPLES:
+                continue
+            current = statistics.median(now)
+            if current > hist * ratio:
+                out.append(
+                    f"{describe_key(key)}: median {current:.1f}s this run vs "
+                    f"{hist:.1f}s historically ({current / hist:.1f}x slower)"
+                )
+        return out
+
+
+def estimate_s(
+    count: int,
+    lanes: Sequence[Tuple[float | None, int]],
+) -> float | None:
+    """Wall time for ``count`` items spread over (seconds/item, slots) lanes.
+
+    Lanes without a known per-item time are ignored; returns None when no lane
+    has one.
+    """
+    rate = sum(slots / per_item for per_item, slots in lanes if per_item)
+    if count <= 0:
+        return 0.0
+    if rate <= 0:
+        return None
+    return count / rate
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+# Spans in Chrome trace event format (chrome://tracing, https://ui.perfetto.dev,
+# speedscope). Tracing is off unless a runner is started with --trace; while
+# off, ``span`` returns a shared no-op context manager and records nothing.
+
+
+class _NoSpan:
+    id = 0
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        return None
+
+    def set(self, **args: Any) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span:
+    def __init__(
+        self, tracer: "Tracer", name: str, parent: int, args: Dict[str, Any]
+    ) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.id = next(tracer.ids)
+        self.parent = parent
+        self.args = args
+        self.start_us = 0.0
+
+    def set(self, **args: Any) -> None:
+        """Attach more arguments, e.g. a result only known inside the span."""
+        self.args.update(args)
+
+    def __enter__(self) -> "Span":
+        stack = self.tracer.stack()
+        if not self.parent and stack:
+            self.parent = stack[-1].id
+        stack.append(self)
+        self.tracer.opened(self)
+        self.start_us = self.tracer.now_us()
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        end_us = self.tracer.now_us()
+        stack = self.tracer.stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        if exc_type is not None:
+            self.args["error"] = f"{exc_type.__name__}: {exc}"
+        self.tracer.complete(self, end_us)
+
+
+class Tracer:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.ids = itertools.count(1)
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._t0 = time.perf_counter()
+        self._pid = os.getpid()
+        self._threads: Dict[int, str] = {}
+        self._thread_of: Dict[int, int] = {}  # span id -> tid, for flow arrows
+
+    def now_us(self) -> float:
+        return (time.perf_counter() - self._t0) * 1e6
+
+    def stack(self) -> List[Span]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def opened(self, span: Span) -> None:
+        with self._lock:
+            self._thread_of[span.id] = threading.get_ident()
+
+    def complete(self, span: Span, end_us: float) -> None:
+        tid = threading.get_ident()
+        args = {**span.args, "span_id": span.id}
+        if span.parent:
+            args["parent_id"] = span.parent
+        event = {
+            "name": span.name,
+            "ph": "X",
+            "ts": round(span.start_us, 1),
+            "dur": round(end_us - span.start_us, 1),
+            "pid": self._pid,
+            "tid": tid,
+            "args": args,
+        }
+        with self._lock:
+            self._threads.setdefault(tid, threading.current_thread().name)
+            self.events.append(event)
+            parent_tid = self._thread_of.get(span.parent, tid)
+            if span.parent and parent_tid != tid:
+                # Spans on another thread (worker items) get a flow arrow from
+                # their parent, since viewers only nest spans per thread.
+                flow = {
+                    "name": "parent",
+                    "cat": "flow",
+                    "id": span.id,
+                    "ts": event["ts"],
+                    "pid": self._pid,
+                }
+                self.events.append({**flow, "ph": "s", "tid": parent_tid})
+                self.events.append({**flow, "ph": "f", "bp": "e", "tid": tid})
+
+    def write(self) -> None:
+        with self._lock:
+            meta = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self._pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self._threads.items()
+            ]
+            events = meta + sorted(self.events, key=lambda e: e["ts"])
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(
+            json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}) + "\n",
+            encoding="utf-8",
+        )
+
+
+_tracer: Tracer | None = None
+
+
+def span(name: str, *, parent: int = 0, **args: Any) -> Span | _NoSpan:
+    """Context manager timing ``name``; a no-op unless tracing is on.
+
+    Spans nest under the innermost open span on the same thread. Work handed
+    to other threads passes ``parent=<span>.id`` explicitly.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return NO_SPAN
+    return Span(tracer, name, parent, args)
+
+
+def current_id() -> int:
+    """Id of the innermost open span on this thread (0 when none or off)."""
+    tracer = _tracer
+    if tracer is None:
+        return 0
+    stack = tracer.stack()
+    return stack[-1].id if stack else 0
+
+
+@contextmanager
+def session(path: str | None, name: str, **args: Any) -> Iterator[None]:
+    """Trace everything inside as one root span ``name``; write on exit."""
+    global _tracer
+    if not path:
+        yield
+        return
+    _tracer = Tracer(Path(path).resolve())
+    try:
+        with span(name, **args):
+            yield
+    finally:
+        tracer, _tracer = _tracer, None
+        tracer.write()
+        print(f"Trace written to: {tracer.path}")
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from asset_index import iter_image_files
+from png_tools import PngError, idat_stream, iter_chunks, read_header, read_metadata
+from portrait_index import INDEX_REL
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verified (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+class CorruptImage(ValueError):
+    pass
+
+
+def check_png(data: bytes, *, deep: bool = False) -> None:
+    """Chunk structure and every chunk CRC; ``deep`` also inflates IDAT."""
+    try:
+        chunks = list(iter_chunks(data, check_crc=True))
+        header = read_header(data)
+    except PngError as e:
+        raise CorruptImage(str(e))
+    if chunks[0].ctype != b"IHDR":
+        raise CorruptImage("first chunk is not IHDR")
+    if not any(c.ctype == b"IDAT" for c in chunks):
+        raise CorruptImage("no image data (IDAT)")
+    if deep:
+        try:
+            raw = zlib.decompress(idat_stream(data))
+        except zlib.error as e:
+            raise CorruptImage(f"corrupt image data: {e}")
+        if not header.interlace and len(raw) != (header.stride + 1) * header.height:
+            raise CorruptImage("image data size does not match the header")
+
+
+def check_jpeg(data: bytes) -> None:
+    """Marker segments up to the scan, and an EOI marker at the end."""
+    if data[:2] != b"\xff\xd8":
+        raise CorruptImage("not a JPEG (missing SOI)")
+    i = 2
+    while True:
+        if i + 4 > len(data) or data[i] != 0xFF:
+            raise CorruptImage(f"bad marker at offset {i}")
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in (0x01,) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        (length,) = struct.unpack(">H", data[i + 2 : i + 4])
+        if length < 2 or i + 2 + length > len(data):
+            raise CorruptImage(f"truncated segment at offset {i}")
+        i += 2 + length
+        if marker == 0xDA:  # start of scan: entropy-coded data follows
+            break
+    if data.rstrip(b"\x00")[-2:] != b"\xff\xd9":
+        raise CorruptImage("missing EOI (truncated scan data)")
+
+
+def check_webp(data: bytes) -> None:
+    """RIFF size field and the chunk list inside it."""
+    if data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+        raise CorruptImage("not a WebP (bad RIFF header)")
+    (riff_size,) = struct.unpack("<I", data[4:8])
+    if riff_size + 8 != len(data):
+        raise CorruptImage(f"RIFF size {riff_size + 8} != file size {len(data)}")
+    i = 12
+    while i < len(data):
+        if i + 8 > len(data):
+            raise CorruptImage(f"truncated chunk header at offset {i}")
+        fourcc = data[i : i + 4].decode("latin-1")
+        (size,) = struct.unpack("<I", data[i + 4 : i + 8])
+        i += 8 + size + (size & 1)
+        if i > len(data) + (size & 1):
+            raise CorruptImage(f"truncated {fourcc} chunk")
+
+
+def check_image(data: bytes, *, deep: bool = False) -> None:
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        check_png(data, deep=deep)
+    elif data[:2] == b"\xff\xd8":
+        check_jpeg(data)
+    elif data[:4] == b"RIFF":
+        check_webp(data)
+    elif not data:
+        raise CorruptImage("empty file")
+    else:
+        raise CorruptImage("unrecognized image format")
+
+
+@dataclass(frozen=True)
+class VerifyResult:
+    path: str
+    status: str  # ok | corrupt | mismatch | missing | cached
+    sha256: str = ""
+    error: str = ""
+
+
+def verify_file(task: Tuple[str, str, bool]) -> VerifyResult:
+    """Check one file; runs in worker processes. ``task`` is (path,
+    expected sha256 or "", deep)."""
+    path, expected, deep = task
+    try:
+        data = Path(path).read_bytes()
+    except FileNotFoundError:
+        return VerifyResult(path, "missing", error="file not found")
+    sha = hashlib.sha256(data).hexdigest()
+    try:
+        check_image(data, deep=deep)
+    except CorruptImage as e:
+        return VerifyResult(path, "corrupt", sha, str(e))
+    if expected and sha != expected:
+        return VerifyResult(path, "mismatch", sha, f"sha256 differs from {expected}")
+    return VerifyResult(path, "ok", sha)
+
+
+def recorded_hashes(pack_dirs: Iterable[Path]) -> Dict[str, str]:
+    """Absolute path -> sha256 from each content pack's portrait index."""
+    out: Dict[str, str] = {}
+    for pack in pack_dirs:
+        index_path = pack / INDEX_REL
+        try:
+            index = json.loads(index_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            continue
+        files = index.get("files") if isinstance(index, dict) else None
+        for rel, entry in (files or {}).items():
+            if isinstance(entry, dict) and isinstance(entry.get("sha256"), str):
+                out[str((pack / rel).resolve())] = entry["sha256"]
+    return out
+
+
+class VerifyCache:
+    """Files already found intact, by path + size + mtime, in SQLite."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path))
+        self._conn.executescript(CACHE_SCHEMA)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def load(self) -> Dict[str, Tuple[int, int, str]]:
+        return {
+            r[0]: (r[1], r[2], r[3])
+            for r in self._conn.execute(
+                "SELECT path, size, mtime_ns, sha256 FROM verified"
+            )
+        }
+
+    def store(self, rows: Sequence[Tuple[str, int, int, str]]) -> None:
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO verified (path, size, mtime_ns, sha256)"
+            " VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        self._conn.commit()
+
+    def forget(self, paths: Iterable[str]) -> None:
+        self._conn.executemany(
+            "DELETE FROM verified WHERE path=?", [(p,) for p in paths]
+        )
+        self._conn.commit()
+
+
+def verify_tree(
+    roots: Sequence[Path],
+    *,
+    packs: Sequence[Path] = (),
+    cache: VerifyCache | None = None,
+    deep: bool = False,
+    workers: int | None = None,
+) -> List[VerifyResult]:
+    """Verify every image under ``roots`` across a process pool.
+
+    Files listed in a pack's portrait index are also checked against their
+    recorded sha256, and reported ``missing`` when gone. Files unchanged
+    since they were last found intact (per ``cache``) are skipped.
+    """
+    expected = recorded_hashes(packs)
+    files = {str(p) for p in iter_image_files(roots)}
+    known = cache.load() if cache is not None else {}
+
+    results: List[VerifyResult] = []
+    tasks: List[Tuple[str, str, bool]] = []
+    stats: Dict[str, os.stat_result] = {}
+    for path in sorted(files | set(expected)):
+        if path not in files and not Path(path).exists():
+            results.append(VerifyResult(path, "missing", error="listed in pack index"))
+            continue
+        st = stats[path] = os.stat(path)
+        hit = known.get(path)
+        want = expected.get(path, "")
+        if hit and hit[:2] == (st.st_size, st.st_mtime_ns) and want in ("", hit[2]):
+            results.append(VerifyResult(path, "cached", hit[2]))
+            continue
+        tasks.append((path, want, deep))
+
+    if len(tasks) > 1 and (workers or os.cpu_count() or 1) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            done = list(pool.map(verify_file, tasks, chunksize=16))
+    else:
+        done = [verify_file(t) for t in tasks]
+    results.extend(done)
+
+    if cache is not None:
+        cache.store(
+            [
+                (r.path, stats[r.path].st_size, stats[r.path].st_mtime_ns, r.sha256)
+                for r in done
+                if r.status == "ok"
+            ]
+        )
+        cache.forget(r.path for r in done if r.status != "ok")
+    return sorted(results, key=lambda r: r.path)
+
+
+def requeue_entry(result: VerifyResult) -> Optional[Dict[str, str]]:
+    """JSONL source item ({"name", "prompt"}) to regenerate a corrupt output.
+
+    Uses the generation metadata the runners embed right after IHDR, which
+    survives a truncated tail; None for files without it (they can't be
+    requeued).
+    """
+    if result.status != "corrupt" or not result.path.lower().endswith(".png"):
+        return None
+    try:
+        meta = read_metadata(Path(result.path))
+    except (PngError, ValueError, OSError):
+        return None
+    if meta and meta.get("name") and meta.get("prompt"):
+        return {"name": str(meta["name"]), "prompt": str(meta["prompt"])}
+    return None
+
+
+def requeue_entries(results: Sequence[VerifyResult]) -> List[Dict[str, str]]:
+    """``requeue_entry`` for each result that can be requeued."""
+    return [e for e in map(requeue_entry, results) if e is not None]
+
+
+def print_verify_report(results: Sequence[VerifyResult]) -> None:
+    for r in results:
+        if r.status in ("corrupt", "mismatch", "missing"):
+            print(f"{r.status.upper()}: {r.path}: {r.error}")
+    counts = {
+        s: sum(1 for r in results if r.status == s)
+        for s in ("ok", "cached", "corrupt", "mismatch", "missing")
+    }
+    print(
+        f"Verified {len(results)} file(s): {counts['ok']} ok, {counts['cached']} "
+        f"unchanged since last check, {counts['corrupt']} corrupt, "
+        f"{counts['mismatch']} hash mismatch, {counts['missing']} missing"
+    )
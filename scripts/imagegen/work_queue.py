@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+# Runners that share a queue file split a job's items between them: each
+# item is leased by one runner at a time, and done items are recorded so no
+# other runner picks them up again. A done record only stands while the
+# output does: an item whose output has gone, or is being overwritten, is
+# handed out again unless a runner working alongside this one finished it.
+# A runner renews its leases while it works on them; if it dies they expire
+# and whoever is still running takes them over. A failed item is held for
+# one more lease period (so the other runners of the same run don't all
+# retry it at once) and can then be claimed again, e.g. by a later run.
+#
+# The file may sit on a shared filesystem for runners on several machines.
+# It uses SQLite's default rollback journal (WAL needs shared memory, which
+# network filesystems don't provide), and lease times are wall-clock, so
+# the machines' clocks should agree to well within ``lease_s``.
+
+DEFAULT_LEASE_S = 120.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    job TEXT NOT NULL,
+    item TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (job, item)
+);
+"""
+
+
+class WorkQueue:
+    """Item leases for one job, shared through a SQLite file.
+
+    ``job`` identifies the job across runners (the output dir); items are
+    identified by their output path within it. Payloads are whatever the
+    caller needs to rebuild an item it takes over from a dead runner.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        job: str,
+        lease_s: float = DEFAULT_LEASE_S,
+        owner: str | None = None,
+    ) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.job = job
+        self.lease_s = lease_s
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        # Items finished since then were finished by runners working
+        # alongside this one, on this same pass over the job.
+        self.started = time.time()
+        # Transactions are explicit (BEGIN IMMEDIATE takes the write lock up
+        # front, so two runners can't both read "free" and claim).
+        self._conn = sqlite3.connect(
+            str(path), timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewer: threading.Thread | None = None
+
+    def _write(self, sql: str, params: Tuple[Any, ...]) -> int:
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def start(self) -> None:
+        """Keep this runner's leases alive until ``close``."""
+        self._renewer = threading.Thread(
+            target=self._renew, name="work-queue-renew", daemon=True
+        )
+        self._renewer.start()
+
+    def _renew(self) -> None:
+        while not self._stop.wait(self.lease_s / 3):
+            try:
+                self._write(
+                    "UPDATE leases SET expires=? "
+                    "WHERE job=? AND owner=? AND state='leased'",
+                    (time.time() + self.lease_s, self.job, self.owner),
+                )
+            except sqlite3.OperationalError:
+                continue  # locked for longer than the timeout; retry next round
+
+    def close(self) -> None:
+        """Stop renewing and hand unfinished items back right away."""
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+        self._write(
+            "DELETE FROM leases WHERE job=? AND owner=? AND state='leased'",
+            (self.job, self.owner),
+        )
+        self._conn.close()
+
+    def reset(self) -> int:
+        """Forget this job's done and failed records; returns how many."""
+        return self._write(
+            "DELETE FROM leases WHERE job=? AND state IN ('done', 'failed')",
+            (self.job,),
+        )
+
+    def claim(
+        self, item: str, payload: Dict[str, Any], *, redo: bool = False
+    ) -> str | None:
+        """Lease ``item`` to this runner; None if it got it, else why not.
+
+        ``redo`` says the item's output is missing or being overwritten, so a
+        done record from before this runner started doesn't count.
+        """
+        now = time.time()
+        with self._lock:
+            c = self._conn
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                reason = self._claim(item, payload, now, redo)
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+            return reason
+
+    def _claim(
+        self, item: str, payload: Dict[str, Any], now: float, redo: bool
+    ) -> str | None:
+        c = self._conn
+        row = c.execute(
+            "SELECT state, owner, expires, updated FROM leases"
+            " WHERE job=? AND item=?",
+            (self.job, item),
+        ).fetchone()
+        if row is None:
+            c.execute(
+                "INSERT INTO leases (job, item, state, owner, expires,"
+                " attempts, payload, updated)"
+                " VALUES (?, ?, 'leased', ?, ?, 1, ?, ?)",
+                (
+                    self.job,
+                    item,
+                    self.owner,
+                    now + self.lease_s,
+                    json.dumps(payload),
+                    now,
+                ),
+            )
+            return None
+        state, owner, expires, updated = row
+        if state == "done" and (not redo or updated >= self.started):
+            return f"done by {owner}"
+        if state != "done" and expires >= now:
+            if state == "failed" or owner != self.owner:
+                return f"{state} by {owner}"
+        c.execute(
+            "UPDATE leases SET state='leased', owner=?, expires=?, error=NULL,"
+            " attempts=attempts+1, payload=?, updated=? WHERE job=? AND item=?",
+            (
+                self.owner,
+                now + self.lease_s,
+                json.dumps(payload),
+                now,
+                self.job,
+                item,
+            ),
+        )
+        return None
+
+    def expired(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Items whose lease ran out (their runner is gone); ``claim`` them."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT item, payload FROM leases"
+                " WHERE job=? AND state='leased' AND expires<?",
+                (self.job, time.time()),
+            ).fetchall()
+        return [(item, json.loads(payload)) for item, payload in rows]
+
+    def leased_elsewhere(self) -> int:
+        """Items other runners are working on (their leases still live)."""
+        with self._lock:
+            (n,) = self._conn.execute(
+                "SELECT COUNT(*) FROM leases"
+                " WHERE job=? AND state='leased' AND owner<>? AND expires>=?",
+                (self.job, self.owner, time.time()),
+            ).fetchone()
+        return int(n)
+
+    def complete(self, item: str) -> None:
+        self._finish(item, "done", None)
+
+    def fail(self, item: str, error: str) -> None:
+        self._finish(item, "failed", error)
+
+    def _finish(self, item: str, state: str, error: str | None) -> None:
+        now = time.time()
+        self._write(
+            "UPDATE leases SET state=?, error=?, expires=?, updated=?"
+            " WHERE job=? AND item=? AND owner=?",
+            (state, error, now + self.lease_s, now, self.job, item, self.owner),
+        )
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM leases WHERE job=? GROUP BY state",
+                (self.job,),
+            ).fetchall()
+        return {state: int(n) for state, n in rows}
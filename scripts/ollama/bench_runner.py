@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+import ollama
+
+FAKE_BIN = Path(__file__).resolve().parent / "fake_bin"
+
+
+def _bare_spawn_s(count: int, workdir: Path) -> float:
+    # Cost of just launching the fake binary; the runner can't beat this.
+    started = time.monotonic()
+    for _ in range(count):
+        subprocess.check_call(
+            ["ollama", "run", "x/fake", "bench", "--width", "8", "--height", "8"],
+            cwd=str(workdir),
+            stdout=subprocess.DEVNULL,
+        )
+    return time.monotonic() - started
+
+
+def main(argv: List[str]) -> int:
+    ap = argparse.ArgumentParser(
+        description="Measure Ollama runner overhead against the fake `ollama` binary"
+    )
+    ap.add_argument("--items", type=int, default=500)
+    ap.add_argument("--concurrency", type=int, default=1)
+    ap.add_argument("--delay-s", type=float, default=0.0, help="Fake render time")
+    ap.add_argument("--output-bytes", type=int, default=0, help="Fake PNG size")
+    ap.add_argument(
+        "--baseline-samples",
+        type=int,
+        default=50,
+        help="Bare fake-binary launches used to estimate process spawn cost",
+    )
+    args = ap.parse_args(argv)
+
+    os.environ["PATH"] = f"{FAKE_BIN}{os.pathsep}{os.environ.get('PATH', '')}"
+    os.environ["FAKE_OLLAMA_DELAY_S"] = str(args.delay_s)
+    os.environ["FAKE_OLLAMA_OUTPUT_BYTES"] = str(args.output_bytes)
+    os.environ["FAKE_OLLAMA_QUIET"] = "1"
+
+    with tempfile.TemporaryDirectory(prefix="dbu-ollama-bench-") as td:
+        d = Path(td)
+        job = d / "job.json"
+        job.write_text(
+            json.dumps(
+                {
+                    "version": 1,
+                    "backend": "ollama",
+                    "generate": {"width": 8, "height": 8},
+                    "output": {"dir": str(d / "out")},
+                    "items": [
+                        {"name": f"item {i}", "prompt": f"bench prompt {i}"}
+                        for i in range(args.items)
+                    ],
+                }
+            ),
+            encoding="utf-8",
+        )
+
+        spawn_s = _bare_spawn_s(args.baseline_samples, d) / args.baseline_samples
+
+        started = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            rc = ollama.main(
+                [
+                    "generate",
+                    "--job",
+                    str(job),
+                    "--concurrency",
+                    str(args.concurrency),
+                    "--no-timings",
+                ]
+            )
+        total_s = time.monotonic() - started
+        if rc != 0:
+            print(f"Runner exited with {rc}")
+            return rc
+
+    per_item = total_s / args.items
+    # Spawning is CPU-bound, the fake render delay is not.
+    parallel_spawn = min(args.concurrency, os.cpu_count() or 1)
+    ideal = max(spawn_s / parallel_spawn, (spawn_s + args.delay_s) / args.concurrency)
+    print(f"items:             {args.items}")
+    print(f"concurrency:       {args.concurrency}")
+    print(f"total:             {total_s:.2f}s")
+    print(f"per item:          {per_item * 1000:.1f} ms")
+    print(f"ideal (no runner): {ideal * 1000:.1f} ms/item")
+    print(f"runner overhead:   {(per_item - ideal) * 1000:.1f} ms/item")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
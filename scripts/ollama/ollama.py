@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 import argparse
+import json
 import subprocess
 import shutil
 import sys
@@ -10,20 +11,32 @@ from pathlib import Path
 from typing import List
 
 from ollama_lib import (
+    DEFAULT_MODEL,
     ROOT_DIR,
+    FailedItem,
+    embed_output_metadata,
     ensure_ollama_present,
+    format_benchmark_table,
+    job_items_from_cfg,
     load_data_file,
+    ollama_backend_from_cfg,
     ollama_generate_image,
     ollama_pull,
-    read_kin_prompts_md,
+    ollama_timing_key,
+    open_progress,
+    open_timings,
+    print_job_plan,
+    optimize_job_outputs,
+    publish_job_outputs,
+    retry_policy_from_cfg,
+    run_benchmark,
+    run_job,
+    session,
     slugify,
     validate_job_config,
 )
 
 
-DEFAULT_MODEL = "x/z-image-turbo"
-
-
 def cmd_setup(args: argparse.Namespace) -> int:
     ensure_ollama_present(auto_install=not args.no_install)
     print("Ollama OK.")
@@ -80,6 +93,9 @@ def cmd_doctor(args: argparse.Namespace) -> int:
             print(f"Image generation smoke test failed: {e}")
             return 2
 
+    if args.benchmark:
+        return _doctor_benchmark(args, model)
+
     print("Doctor OK:")
     print("- ollama: present")
     print("- image generation: supported")
@@ -87,39 +103,83 @@ def cmd_doctor(args: argparse.Namespace) -> int:
     return 0
 
 
-def _job_items_from_cfg(cfg: dict) -> List[tuple[str, str]]:
-    items = cfg.get("items")
-    if isinstance(items, list):
-        out: List[tuple[str, str]] = []
-        for it in items:
-            if not isinstance(it, dict):
-                raise SystemExit("items must contain objects")
-            name = str(it.get("name") or "").strip()
-            prompt = str(it.get("prompt") or "").strip()
-            if not name or not prompt:
-                raise SystemExit("each item requires name and prompt")
-            out.append((name, prompt))
-        return out
-
-    source = cfg.get("source")
-    if isinstance(source, dict):
-        stype = str(source.get("type") or "").strip()
-        if stype == "kin_prompts_markdown":
-            md_path = source.get("path") or str(
-                ROOT_DIR / "docs/character_creation/kin-profile-portrait-prompts.md"
-            )
-            prompts = read_kin_prompts_md(Path(md_path))
-            return [(p.name, p.prompt) for p in prompts]
-        raise SystemExit(f"Unknown source.type: {stype}")
+def _parse_int_list(raw: str, *, flag: str) -> List[int]:
+    try:
+        values = [int(v) for v in raw.split(",") if v.strip()]
+    except ValueError:
+        raise SystemExit(f"{flag} expects comma-separated integers, got: {raw}")
+    if not values or any(v <= 0 for v in values):
+        raise SystemExit(f"{flag} expects positive integers, got: {raw}")
+    return values
+
+
+def _doctor_benchmark(args: argparse.Namespace, model: str) -> int:
+    sizes = [(s, s) for s in _parse_int_list(args.bench_sizes, flag="--bench-sizes")]
+    steps_list = _parse_int_list(args.bench_steps, flag="--bench-steps")
+    out_path = (
+        Path(args.bench_out)
+        if args.bench_out
+        else ROOT_DIR / "tools/ollama" / f"benchmark-{slugify(model)}.json"
+    )
+
+    total = 2 + len(sizes) * len(steps_list) * args.bench_repeats
+    print(f"Benchmarking {model}: {total} renders ...")
+
+    def render(width: int, height: int, steps: int) -> None:
+        ollama_generate_image(
+            model=model,
+            prompt="a simple red circle on a white background",
+            width=width,
+            height=height,
+            steps=steps,
+            seed=1,
+            negative=None,
+            timeout_s=args.bench_timeout_s,
+        )
 
-    raise SystemExit("Config must include either items[] or source{type=...}")
+    try:
+        model_load_s, rows = run_benchmark(
+            render,
+            sizes=sizes,
+            steps_list=steps_list,
+            repeats=args.bench_repeats,
+        )
+    except (Exception, SystemExit) as e:
+        print(f"Benchmark failed: {e}")
+        return 2
 
+    print()
+    print(f"Model load (cold - warm): {model_load_s:.2f}s")
+    print(format_benchmark_table(rows))
+    slowest = max(r.first_s for r in rows)
+    print()
+    print(
+        f"Tip: timeout_s >= {int(slowest * 3) + 1} covers the slowest config with headroom."
+    )
 
-def cmd_generate(args: argparse.Namespace) -> int:
-    ensure_ollama_present(auto_install=False)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    report = {
+        "model": model,
+        "model_load_s": round(model_load_s, 3),
+        "rows": [
+            {
+                "width": r.width,
+                "height": r.height,
+                "steps": r.steps,
+                "runs": r.runs,
+                "first_s": round(r.first_s, 3),
+                "steady_s": None if r.steady_s is None else round(r.steady_s, 3),
+                "images_per_min": round(r.images_per_min, 3),
+            }
+            for r in rows
+        ],
+    }
+    out_path.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+    print(f"Saved benchmark: {out_path}")
+    return 0
 
-    # CLI flag should override config.
-    model = args.model or DEFAULT_MODEL
+
+def cmd_generate(args: argparse.Namespace) -> int:
     backend = "ollama"
 
     if args.job:
@@ -131,104 +191,110 @@ def cmd_generate(args: argparse.Namespace) -> int:
         if str(cfg.get("backend") or backend) != "ollama":
             raise SystemExit("This runner only supports backend=ollama")
 
-        cfg_model = cfg.get("model")
-        if args.model:
-            model = args.model
-        elif cfg_model is not None:
-            model = str(cfg_model)
-
-        gen_raw = cfg.get("generate")
-        gen = gen_raw if isinstance(gen_raw, dict) else {}
-        width = (
-            int(gen["width"]) if "width" in gen and gen["width"] is not None else None
-        )
-        height = (
-            int(gen["height"])
-            if "height" in gen and gen["height"] is not None
-            else None
-        )
-        steps = (
-            int(gen["steps"]) if "steps" in gen and gen["steps"] is not None else None
-        )
-        seed = int(gen["seed"]) if "seed" in gen and gen["seed"] is not None else None
-        negative = (
-            str(gen["negative"])
-            if "negative" in gen and gen["negative"] is not None
-            else None
-        )
-        timeout_s = (
-            int(gen["timeout_s"])
-            if "timeout_s" in gen and gen["timeout_s"] is not None
-            else None
-        )
-        prompt_prefix = (
-            str(gen["prompt_prefix"]).strip()
-            if "prompt_prefix" in gen and gen["prompt_prefix"] is not None
-            else None
-        )
-
         out_raw = cfg.get("output")
         out_cfg = out_raw if isinstance(out_raw, dict) else {}
         out_dir = Path(out_cfg.get("dir") or str(args.out)).resolve()
         out_ext = str(out_cfg.get("ext") or "png").lstrip(".")
         overwrite = bool(out_cfg.get("overwrite") or False)
 
-        items = _job_items_from_cfg(cfg)
+        items = job_items_from_cfg(cfg)
     else:
         if not args.prompt:
             raise SystemExit("generate requires either --job <file> or --prompt <text>")
-        width = args.width
-        height = args.height
-        steps = args.steps
-        seed = None if args.seed == 0 else args.seed
-        negative = args.negative
-        timeout_s = args.timeout
-        prompt_prefix = args.prompt_prefix.strip() if args.prompt_prefix else None
+        # Ad-hoc flags map onto the same config shape a job file would use.
+        cfg = {
+            "generate": {
+                "width": args.width,
+                "height": args.height,
+                "steps": args.steps,
+                "seed": None if args.seed == 0 else args.seed,
+                "negative": args.negative,
+                "timeout_s": args.timeout,
+                "prompt_prefix": args.prompt_prefix,
+            }
+        }
         out_dir = Path(args.out).resolve()
         out_ext = "png"
         overwrite = args.overwrite
         name = args.name or "image"
         items = [(name, args.prompt)]
 
-    print(f"Model: {model}")
-    ollama_pull(model)
-
-    out_dir.mkdir(parents=True, exist_ok=True)
+    timings = open_timings(args.timings_db, disabled=args.no_timings)
+    if args.dry_run:
+        gen_raw = cfg.get("generate")
+        gen = gen_raw if isinstance(gen_raw, dict) else {}
+        hosts_raw = cfg.get("hosts")
+        slots = (
+            args.concurrency
+            or gen.get("concurrency")
+            or len(args.host or hosts_raw or [])
+            or 1
+        )
+        key = ollama_timing_key(cfg, model=args.model)
+        print(f"Model: {key['model']}")
+        print_job_plan(
+            items,
+            [(key, int(slots))],
+            out_dir=out_dir,
+            out_ext=out_ext,
+            overwrite=overwrite,
+            timings=timings,
+        )
+        return 0
 
-    for idx, (name, prompt) in enumerate(items, start=1):
-        slug = slugify(name)
-        out_path = out_dir / f"{slug}.{out_ext}"
-        if out_path.exists() and not overwrite:
-            print(f"[{idx}/{len(items)}] skip (exists): {name} -> {out_path}")
-            continue
+    ensure_ollama_present(auto_install=False)
 
-        print(f"[{idx}/{len(items)}] generate: {name} -> {out_path.name}")
-        effective_prompt = prompt
-        if prompt_prefix:
-            effective_prompt = f"{prompt_prefix} {prompt}".strip()
+    # CLI flags should override config.
+    gen_backend = ollama_backend_from_cfg(
+        cfg,
+        model=args.model,
+        hosts=[h.strip() for h in args.host] if args.host else None,
+        concurrency=args.concurrency,
+        max_concurrency=args.max_concurrency,
+    )
+    if len(gen_backend.pool.hosts) > 1:
+        print(f"Hosts: {len(gen_backend.pool.healthy_hosts())} healthy")
 
-        img_bytes = ollama_generate_image(
-            model=model,
-            prompt=effective_prompt,
-            width=width,
-            height=height,
-            steps=steps,
-            seed=seed,
-            negative=negative,
-            timeout_s=timeout_s,
+    failures: List[FailedItem] = []
+    progress = open_progress(Path(args.job).name if args.job else "ad-hoc")
+    try:
+        run_job(
+            items,
+            [gen_backend],
+            out_dir=out_dir,
+            out_ext=out_ext,
+            overwrite=overwrite,
+            timings=timings,
+            retry=retry_policy_from_cfg(cfg, attempts=args.attempts),
+            keep_going=args.keep_going,
+            on_failure=failures.append,
+            metadata=embed_output_metadata(cfg),
+            progress=progress,
         )
-        out_path.write_bytes(img_bytes)
+    finally:
+        progress.close()
+        if timings is not None:
+            timings.close()
 
+    optimize_job_outputs(cfg, out_dir=out_dir)
+    publish_job_outputs(cfg, out_dir=out_dir, out_ext=out_ext)
     print(f"Done. Wrote outputs to: {out_dir}")
-    return 0
+    return 1 if failures else 0
 
 
 def main(argv: List[str]) -> int:
     ap = argparse.ArgumentParser(description="Dragonbane Unbound Ollama image helper")
     sub = ap.add_subparsers(dest="cmd", required=True)
+    trace = argparse.ArgumentParser(add_help=False)
+    trace.add_argument(
+        "--trace",
+        default=None,
+        metavar="FILE",
+        help="Write timing spans as Chrome trace JSON (open in ui.perfetto.dev)",
+    )
 
     p_setup = sub.add_parser(
-        "setup", help="Install/verify Ollama and optionally pull model"
+        "setup", parents=[trace], help="Install/verify Ollama and optionally pull model"
     )
     p_setup.add_argument(
         "--no-install", action="store_true", help="Do not auto-install"
@@ -239,7 +305,9 @@ def main(argv: List[str]) -> int:
     )
     p_setup.set_defaults(func=cmd_setup)
 
-    p_doc = sub.add_parser("doctor", help="Verify Ollama + image generation support")
+    p_doc = sub.add_parser(
+        "doctor", parents=[trace], help="Verify Ollama + image generation support"
+    )
     p_doc.add_argument("--pull", action="store_true", help="Pull model during doctor")
     p_doc.add_argument(
         "--model", default=None, help=f"Model id (default: {DEFAULT_MODEL})"
@@ -249,9 +317,38 @@ def main(argv: List[str]) -> int:
         action="store_true",
         help="Attempt a tiny image generation as part of doctor",
     )
+    p_doc.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Time a grid of sizes/steps and save a throughput table",
+    )
+    p_doc.add_argument(
+        "--bench-sizes",
+        default="256,512,1024",
+        help="Comma-separated square sizes (default: 256,512,1024)",
+    )
+    p_doc.add_argument(
+        "--bench-steps",
+        default="4,8,16",
+        help="Comma-separated step counts (default: 4,8,16)",
+    )
+    p_doc.add_argument(
+        "--bench-repeats",
+        type=int,
+        default=3,
+        help="Renders per grid cell; the first is reported as first-image latency",
+    )
+    p_doc.add_argument("--bench-timeout-s", type=int, default=600)
+    p_doc.add_argument(
+        "--bench-out",
+        default=None,
+        help="Where to save the JSON report (default: tools/ollama/benchmark-<model>.json)",
+    )
     p_doc.set_defaults(func=cmd_doctor)
 
-    p_gen = sub.add_parser("generate", help="Generate images via Ollama")
+    p_gen = sub.add_parser(
+        "generate", parents=[trace], help="Generate images via Ollama"
+    )
     p_gen.add_argument("--job", default=None, help="Job config (.json/.yaml)")
     p_gen.add_argument(
         "--model", default=None, help=f"Model id (default: {DEFAULT_MODEL})"
@@ -273,10 +370,54 @@ def main(argv: List[str]) -> int:
         help="Prefix applied to every prompt (ad-hoc mode)",
     )
     p_gen.add_argument("--timeout", type=int, default=1800)
+    p_gen.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Parallel `ollama run` calls (default: generate.concurrency, else one per host)",
+    )
+    p_gen.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="Adapt parallel calls between 1 and this, by throughput "
+        "(default: generate.max_concurrency; off when unset)",
+    )
+    p_gen.add_argument(
+        "--host",
+        action="append",
+        default=None,
+        help="Ollama server (OLLAMA_HOST) to use; repeat to spread work over several",
+    )
+    p_gen.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the plan and a time estimate from past runs; generate nothing",
+    )
+    p_gen.add_argument(
+        "--timings-db",
+        default=None,
+        help="SQLite file with generation timings (default: tools/imagegen/timings.sqlite)",
+    )
+    p_gen.add_argument(
+        "--no-timings", action="store_true", help="Do not read or record timings"
+    )
+    p_gen.add_argument(
+        "--attempts",
+        type=int,
+        default=None,
+        help="Tries per item before it counts as failed (default: retry.attempts or 3)",
+    )
+    p_gen.add_argument(
+        "--keep-going",
+        action="store_true",
+        help="Don't stop at a failed item; report failures and exit 1 at the end",
+    )
     p_gen.set_defaults(func=cmd_generate)
 
     args = ap.parse_args(argv)
-    return int(args.func(args))
+    with session(getattr(args, "trace", None), f"ollama {args.cmd}"):
+        return int(args.func(args))
 
 
 if __name__ == "__main__":
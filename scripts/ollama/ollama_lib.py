@@ -2,141 +2,97 @@
 
 from __future__ import annotations
 
-import json
 import os
 import platform
-import re
 import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Tuple
-
-
-ROOT_DIR = Path(__file__).resolve().parents[2]
-
-
-def slugify(name: str) -> str:
-    s = name.strip().lower()
-    s = re.sub(r"\s+", "_", s)
-    s = re.sub(r"[^a-z0-9_]+", "", s)
-    s = re.sub(r"_+", "_", s).strip("_")
-    return s or "image"
-
-
-@dataclass(frozen=True)
-class PromptItem:
-    name: str
-    prompt: str
-
-
-def read_kin_prompts_md(md_path: Path) -> List[PromptItem]:
-    text = md_path.read_text(encoding="utf-8")
-    lines = text.splitlines()
-
-    prompts: List[PromptItem] = []
-    current_name: str | None = None
-    in_code = False
-    buf: List[str] = []
-
-    def flush() -> None:
-        nonlocal current_name, buf
-        if current_name and buf:
-            prompt_text = "\n".join(buf).strip()
-            if prompt_text:
-                prompts.append(PromptItem(name=current_name, prompt=prompt_text))
-        buf = []
-
-    for line in lines:
-        m = re.match(r"^##\s+(.+?)\s*$", line)
-        if m and not in_code:
-            flush()
-            current_name = m.group(1).strip()
-            continue
-
-        if line.strip().startswith("```"):
-            in_code = not in_code
-            if in_code:
-                buf = []
-            continue
-
-        if in_code:
-            buf.append(line)
-
-    flush()
-    return prompts
-
-
-def _fail_unknown_keys(where: str, unknown: List[str]) -> None:
-    raise SystemExit(
-        f"Unknown/disallowed keys at {where}: " + ", ".join(sorted(unknown))
-    )
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "imagegen"))
+
+# Shared job engine; names are re-exported for ollama.py and the tests.
+from imagegen_lib import (  # noqa: E402, F401
+    OUTPUT_KEYS,
+    PUBLISH_KEYS,
+    RETRY_KEYS,
+    ROOT_DIR,
+    FailedItem,
+    GenerationBackend,
+    GenerationResult,
+    JobItem,
+    PromptItem,
+    StageError,
+    concurrency_limits,
+    embed_output_metadata,
+    job_items_from_cfg,
+    load_data_file,
+    open_progress,
+    open_timings,
+    print_job_plan,
+    optimize_job_outputs,
+    publish_job_outputs,
+    read_kin_prompts_md,
+    retry_policy_from_cfg,
+    run_job,
+    slugify,
+)
+from imagegen_lib import validate_job_config as _validate_job_config  # noqa: E402
+from tracing import session, span  # noqa: E402, F401
+
+
+DEFAULT_MODEL = "x/z-image-turbo"
+
+GENERATE_KEYS = {
+    "width",
+    "height",
+    "steps",
+    "seed",
+    "negative",
+    "timeout_s",
+    "prompt_prefix",
+    "concurrency",
+    "max_concurrency",
+}
 
 
 def validate_job_config(cfg: Dict[str, Any]) -> None:
-    allowed_top = {
-        "version",
-        "backend",
-        "model",
-        "generate",
-        "source",
-        "items",
-        "output",
-    }
-    unknown = [k for k in cfg.keys() if k not in allowed_top]
-    if unknown:
-        _fail_unknown_keys("root", unknown)
-
-    def validate_obj(obj: Any, allowed: set[str], where: str) -> None:
-        if obj is None:
-            return
-        if not isinstance(obj, dict):
-            raise SystemExit(f"Expected object at {where}")
-        unknown2 = [k for k in obj.keys() if k not in allowed]
-        if unknown2:
-            _fail_unknown_keys(where, unknown2)
-
-    validate_obj(
-        cfg.get("generate"),
-        {"width", "height", "steps", "seed", "negative", "timeout_s", "prompt_prefix"},
-        "generate",
+    _validate_job_config(
+        cfg,
+        top_keys={
+            "version",
+            "backend",
+            "model",
+            "generate",
+            "source",
+            "items",
+            "matrix",
+            "output",
+            "publish",
+            "retry",
+            "hosts",
+        },
+        sections={
+            "generate": GENERATE_KEYS,
+            "source": {"type", "path"},
+            "output": OUTPUT_KEYS,
+            "publish": PUBLISH_KEYS,
+            "retry": RETRY_KEYS,
+        },
     )
-    validate_obj(cfg.get("source"), {"type", "path"}, "source")
-    validate_obj(cfg.get("output"), {"dir", "overwrite", "ext"}, "output")
-
-    items = cfg.get("items")
-    if items is not None:
-        if not isinstance(items, list):
-            raise SystemExit("items must be an array")
-        for i, it in enumerate(items):
-            if not isinstance(it, dict):
-                raise SystemExit(f"items[{i}] must be an object")
-            unknown3 = [k for k in it.keys() if k not in {"name", "prompt"}]
-            if unknown3:
-                _fail_unknown_keys(f"items[{i}]", unknown3)
-
-
-def load_data_file(path: Path) -> Dict[str, Any]:
-    suffix = path.suffix.lower()
-    if suffix == ".json":
-        return json.loads(path.read_text(encoding="utf-8"))
-    if suffix in {".yaml", ".yml"}:
-        # Avoid requiring PyYAML in system python; try to parse via python if present.
-        try:
-            import yaml  # type: ignore
-
-            data = yaml.safe_load(path.read_text(encoding="utf-8"))
-            if data is None:
-                return {}
-            if not isinstance(data, dict):
-                raise SystemExit(f"Config must be an object at top-level: {path}")
-            return data
-        except Exception:
-            raise SystemExit(
-                "YAML config requires PyYAML. Use JSON, or install PyYAML in your python."
-            )
-    raise SystemExit(f"Unsupported config type: {path} (use .json/.yaml)")
+
+    hosts = cfg.get("hosts")
+    if hosts is not None:
+        if not isinstance(hosts, list) or not hosts:
+            raise SystemExit("hosts must be a non-empty array")
+        for i, h in enumerate(hosts):
+            if not isinstance(h, str) or not h.strip():
+                raise SystemExit(f"hosts[{i}] must be a non-empty string")
 
 
 def ensure_ollama_present(*, auto_install: bool) -> None:
@@ -168,8 +124,145 @@ def ensure_ollama_present(*, auto_install: bool) -> None:
     )
 
 
-def ollama_pull(model: str) -> None:
-    subprocess.check_call(["ollama", "pull", model])
+def ollama_env(host: str | None) -> Dict[str, str] | None:
+    # None means "whatever OLLAMA_HOST the user already has".
+    if host is None:
+        return None
+    env = dict(os.environ)
+    env["OLLAMA_HOST"] = host
+    return env
+
+
+def ollama_pull(model: str, *, host: str | None = None) -> None:
+    with span("ollama.pull", model=model, host=host):
+        subprocess.check_call(["ollama", "pull", model], env=ollama_env(host))
+
+
+def ollama_host_healthy(host: str | None, *, timeout_s: int = 10) -> bool:
+    # `ollama list` talks to the server, so it doubles as a cheap health check.
+    try:
+        with span("ollama.health", host=host):
+            subprocess.run(
+                ["ollama", "list"],
+                env=ollama_env(host),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=timeout_s,
+                check=True,
+            )
+    except Exception:
+        return False
+    return True
+
+
+class OllamaHostPool:
+    """Hands out Ollama hosts to workers, least-loaded healthy host first.
+
+    A host that fails a generation is marked unhealthy (unless it is the last
+    healthy one) and only offered again after it passes a health check, at
+    most once every ``recheck_s`` seconds.
+    """
+
+    def __init__(
+        self,
+        hosts: List[str | None],
+        *,
+        recheck_s: float = 30.0,
+        health_check: Any = ollama_host_healthy,
+    ) -> None:
+        if not hosts:
+            raise ValueError("OllamaHostPool requires at least one host")
+        self.hosts = list(hosts)
+        self._recheck_s = recheck_s
+        self._health_check = health_check
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str | None, int] = {h: 0 for h in self.hosts}
+        self._assigned: Dict[str | None, int] = {h: 0 for h in self.hosts}
+        self._down: set[str | None] = set()
+        # When each host's health was last found out, by a check or a failure.
+        self._checked: Dict[str | None, float] = {}
+
+    @staticmethod
+    def label(host: str | None) -> str:
+        return host or "default"
+
+    def healthy_hosts(self) -> List[str | None]:
+        with self._lock:
+            return [h for h in self.hosts if h not in self._down]
+
+    def states(self) -> List[Dict[str, Any]]:
+        """Per-host load and health, for progress reporting."""
+        with self._lock:
+            return [
+                {
+                    "host": self.label(h),
+                    "in_flight": self._in_flight[h],
+                    "assigned": self._assigned[h],
+                    "healthy": h not in self._down,
+                }
+                for h in self.hosts
+            ]
+
+    def probe(self, host: str | None) -> bool:
+        """Health-check ``host`` (unless it was within ``recheck_s``); is it up?"""
+        with self._lock:
+            self._probe(host)
+            return host not in self._down
+
+    def _probe(self, host: str | None) -> None:
+        # The only place hosts get health-checked; called with the lock held.
+        # The time is recorded before the check, so other workers arriving
+        # meanwhile don't check the same host again.
+        now = time.monotonic()
+        last = self._checked.get(host)
+        if last is not None and now - last < self._recheck_s:
+            return
+        self._checked[host] = now
+        # Health checks shell out; keep them outside the lock.
+        self._lock.release()
+        try:
+            ok = self._health_check(host)
+        finally:
+            self._lock.acquire()
+        if ok:
+            self._down.discard(host)
+        else:
+            self._down.add(host)
+
+    def mark_down(self, host: str | None) -> None:
+        with self._lock:
+            self._mark_down(host)
+
+    def _mark_down(self, host: str | None) -> None:
+        if host not in self._down:
+            self._down.add(host)
+            self._checked[host] = time.monotonic()
+
+    def acquire(self, exclude: Iterable[str | None] = ()) -> str | None:
+        excluded = set(exclude)
+        with self._lock:
+            for h in [h for h in self.hosts if h in self._down]:
+                self._probe(h)
+            candidates = [
+                h for h in self.hosts if h not in self._down and h not in excluded
+            ]
+            if not candidates:
+                raise RuntimeError("no healthy Ollama host available")
+            host = min(
+                candidates, key=lambda h: (self._in_flight[h], self._assigned[h])
+            )
+            self._in_flight[host] += 1
+            self._assigned[host] += 1
+            return host
+
+    def release(self, host: str | None, *, ok: bool) -> None:
+        with self._lock:
+            self._in_flight[host] -= 1
+            # The last healthy host stays in: with nowhere else to go, one
+            # failure shouldn't fail every item for ``recheck_s``.
+            others = [h for h in self.hosts if h != host and h not in self._down]
+            if not ok and others:
+                self._mark_down(host)
 
 
 def _list_image_files(dir_path: Path) -> List[Path]:
@@ -192,6 +285,7 @@ def ollama_generate_image(
     seed: int | None,
     negative: str | None,
     timeout_s: int | None,
+    host: str | None = None,
 ) -> bytes:
     # Ollama saves generated images to the current directory.
     # Run inside a temp dir and return the produced image bytes.
@@ -211,7 +305,7 @@ def ollama_generate_image(
         if negative:
             cmd += ["--negative", negative]
 
-        subprocess.check_call(cmd, cwd=str(d), timeout=timeout_s)
+        subprocess.check_call(cmd, cwd=str(d), timeout=timeout_s, env=ollama_env(host))
 
         after = _list_image_files(d)
         produced = [p for p in after if p not in before]
@@ -221,3 +315,272 @@ def ollama_generate_image(
             )
         # Return the newest file bytes.
         return produced[-1].read_bytes()
+
+
+class OllamaBackend(GenerationBackend):
+    name = "ollama"
+
+    def __init__(
+        self,
+        *,
+        model: str,
+        pool: OllamaHostPool,
+        slots: int = 1,
+        max_slots: int | None = None,
+        width: int | None = None,
+        height: int | None = None,
+        steps: int | None = None,
+        seed: int | None = None,
+        negative: str | None = None,
+        timeout_s: int | None = None,
+        prompt_prefix: str | None = None,
+    ) -> None:
+        self.model = model
+        self.pool = pool
+        self.slots = slots
+        self.max_slots = max_slots
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.seed = seed
+        self.negative = negative
+        self.timeout_s = timeout_s
+        self.prompt_prefix = prompt_prefix
+
+    def timing_key(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "model": self.model,
+            "width": self.width,
+            "height": self.height,
+            "steps": self.steps,
+        }
+
+    def render_settings(self) -> Dict[str, Any]:
+        return {
+            **self.timing_key(),
+            "seed": self.seed,
+            "negative": self.negative,
+            "prompt_prefix": self.prompt_prefix,
+        }
+
+    def host_states(self) -> List[Dict[str, Any]]:
+        return self.pool.states()
+
+    def generate(self, item: JobItem) -> GenerationResult:
+        started = time.monotonic()
+        prompt = item.prompt
+        if self.prompt_prefix:
+            prompt = f"{self.prompt_prefix} {prompt}".strip()
+        seed = item.seed if item.seed is not None else self.seed
+        negative = item.negative if item.negative is not None else self.negative
+
+        # Each call runs `ollama` inside its own temp dir, so parallel workers
+        # never see each other's files. A failed host is retried elsewhere.
+        tried: List[str | None] = []
+        while True:
+            try:
+                host = self.pool.acquire(exclude=tried)
+            except RuntimeError as e:
+                raise StageError("render", str(e)) from e
+            tried.append(host)
+            try:
+                with span("ollama.run", host=host):
+                    image = ollama_generate_image(
+                        model=self.model,
+                        prompt=prompt,
+                        width=self.width,
+                        height=self.height,
+                        steps=self.steps,
+                        seed=seed,
+                        negative=negative,
+                        timeout_s=self.timeout_s,
+                        host=host,
+                    )
+            except (Exception, SystemExit) as e:
+                self.pool.release(host, ok=False)
+                if not set(self.pool.healthy_hosts()) - set(tried):
+                    raise StageError("render", str(e)) from e
+                print(
+                    f"  host {OllamaHostPool.label(host)} failed ({e}); retrying elsewhere"
+                )
+                continue
+            self.pool.release(host, ok=True)
+            break
+
+        meta: Dict[str, Any] = {
+            "backend": self.name,
+            "model": self.model,
+            "prompt": prompt,
+            "negative": negative,
+            "width": self.width,
+            "height": self.height,
+            "steps": self.steps,
+            "seed": seed,
+            "host": host,
+            "stages": {"render": time.monotonic() - started},
+        }
+        return GenerationResult(
+            image=image, meta={k: v for k, v in meta.items() if v is not None}
+        )
+
+
+def ollama_timing_key(
+    cfg: Dict[str, Any], *, model: str | None = None
+) -> Dict[str, Any]:
+    """Timing key for a job config; mirrors ``OllamaBackend.timing_key``."""
+    gen_raw = cfg.get("generate")
+    gen = gen_raw if isinstance(gen_raw, dict) else {}
+    return {
+        "backend": OllamaBackend.name,
+        "model": model or (str(cfg["model"]) if cfg.get("model") else DEFAULT_MODEL),
+        "width": gen.get("width"),
+        "height": gen.get("height"),
+        "steps": gen.get("steps"),
+    }
+
+
+def ollama_backend_from_cfg(
+    cfg: Dict[str, Any],
+    *,
+    model: str | None = None,
+    hosts: List[str] | None = None,
+    concurrency: int | None = None,
+    max_concurrency: int | None = None,
+) -> OllamaBackend:
+    """Build a ready-to-use backend from a (validated) job config.
+
+    Keyword arguments are CLI overrides and win over the config. Configured
+    hosts are health-checked and the model is pulled on each healthy one.
+    """
+    gen_raw = cfg.get("generate")
+    gen = gen_raw if isinstance(gen_raw, dict) else {}
+
+    def opt(key: str, conv: Callable[[Any], Any]) -> Any:
+        return conv(gen[key]) if gen.get(key) is not None else None
+
+    model = model or (str(cfg["model"]) if cfg.get("model") else DEFAULT_MODEL)
+    if not hosts:
+        hosts_raw = cfg.get("hosts")
+        hosts = (
+            [str(h).strip() for h in hosts_raw] if isinstance(hosts_raw, list) else []
+        )
+    slots, max_slots = concurrency_limits(
+        gen,
+        default=max(1, len(hosts)),
+        concurrency=concurrency,
+        max_concurrency=max_concurrency,
+    )
+    prefix = opt("prompt_prefix", str)
+
+    print(f"Model: {model}")
+    if hosts:
+        pool = OllamaHostPool(list(hosts))
+        healthy = [h for h in hosts if pool.probe(h)]
+        for h in hosts:
+            state = "ok" if h in healthy else "unreachable (skipped)"
+            print(f"Host: {h} {state}")
+        if not healthy:
+            raise SystemExit("None of the configured Ollama hosts are reachable")
+        for h in healthy:
+            ollama_pull(model, host=h)
+    else:
+        ollama_pull(model)
+        pool = OllamaHostPool([None])
+
+    return OllamaBackend(
+        model=model,
+        pool=pool,
+        slots=slots,
+        max_slots=max_slots,
+        width=opt("width", int),
+        height=opt("height", int),
+        steps=opt("steps", int),
+        seed=opt("seed", int),
+        negative=opt("negative", str),
+        timeout_s=opt("timeout_s", int),
+        prompt_prefix=prefix.strip() if prefix else None,
+    )
+
+
+@dataclass(frozen=True)
+class BenchmarkRow:
+    width: int
+    height: int
+    steps: int
+    first_s: float
+    steady_s: float | None
+    runs: int
+
+    @property
+    def images_per_min(self) -> float:
+        latency = self.steady_s if self.steady_s is not None else self.first_s
+        return 60.0 / latency if latency > 0 else 0.0
+
+
+def _median(values: List[float]) -> float:
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[mid]
+    return (ordered[mid - 1] + ordered[mid]) / 2
+
+
+def run_benchmark(
+    render: Callable[[int, int, int], Any],
+    *,
+    sizes: List[Tuple[int, int]],
+    steps_list: List[int],
+    repeats: int,
+) -> Tuple[float, List[BenchmarkRow]]:
+    """Time ``render(width, height, steps)`` over a size x steps grid.
+
+    Returns the estimated model load time (cold minus warm latency of the
+    smallest config) and one row per grid cell. The first run of every cell
+    is reported separately from the steady-state median of the rest.
+    """
+    if not sizes or not steps_list:
+        raise ValueError("benchmark grid must not be empty")
+    if repeats < 1:
+        raise ValueError("repeats must be >= 1")
+
+    def timed(width: int, height: int, steps: int) -> float:
+        started = time.monotonic()
+        render(width, height, steps)
+        return time.monotonic() - started
+
+    w0, h0 = min(sizes, key=lambda wh: wh[0] * wh[1])
+    s0 = min(steps_list)
+    cold = timed(w0, h0, s0)
+    warm = timed(w0, h0, s0)
+    model_load_s = max(0.0, cold - warm)
+
+    rows: List[BenchmarkRow] = []
+    for width, height in sizes:
+        for steps in steps_list:
+            samples = [timed(width, height, steps) for _ in range(repeats)]
+            rows.append(
+                BenchmarkRow(
+                    width=width,
+                    height=height,
+                    steps=steps,
+                    first_s=samples[0],
+                    steady_s=_median(samples[1:]) if len(samples) > 1 else None,
+                    runs=len(samples),
+                )
+            )
+    return model_load_s, rows
+
+
+def format_benchmark_table(rows: List[BenchmarkRow]) -> str:
+    header = (
+        f"{'size':>11}  {'steps':>5}  {'first_s':>8}  {'steady_s':>8}  {'img/min':>7}"
+    )
+    lines = [header, "-" * len(header)]
+    for r in rows:
+        steady = f"{r.steady_s:8.2f}" if r.steady_s is not None else f"{'-':>8}"
+        lines.append(
+            f"{f'{r.width}x{r.height}':>11}  {r.steps:>5}  {r.first_s:8.2f}  "
+            f"{steady}  {r.images_per_min:7.2f}"
+        )
+    return "\n".join(lines)
@@ -2,9 +2,26 @@
 
 from __future__ import annotations
 
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
+from pathlib import Path
+from unittest import mock
 
-from ollama_lib import slugify, validate_job_config
+import ollama
+from ollama_lib import (
+    OllamaHostPool,
+    format_benchmark_table,
+    ollama_generate_image,
+    run_benchmark,
+    slugify,
+    validate_job_config,
+)
 
 
 class OllamaSmokeTests(unittest.TestCase):
@@ -23,6 +40,164 @@ class OllamaSmokeTests(unittest.TestCase):
         with self.assertRaises(SystemExit):
             validate_job_config(cfg)
 
+    def test_validate_job_config_accepts_concurrency(self) -> None:
+        cfg = {
+            "version": 1,
+            "backend": "ollama",
+            "generate": {"width": 512, "height": 512, "concurrency": 2},
+        }
+        validate_job_config(cfg)
+
+    def test_validate_job_config_hosts(self) -> None:
+        validate_job_config({"hosts": ["http://gpu1:11434", "gpu2:11434"]})
+        with self.assertRaises(SystemExit):
+            validate_job_config({"hosts": []})
+        with self.assertRaises(SystemExit):
+            validate_job_config({"hosts": [""]})
+
+    def test_host_pool_least_loaded_and_retry(self) -> None:
+        pool = OllamaHostPool(["a", "b"], health_check=lambda h: False)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEqual({first, second}, {"a", "b"})
+
+        pool.release(first, ok=False)
+        # A failed host is skipped, and a retry can exclude the host it tried.
+        self.assertEqual(pool.acquire(), second)
+        with self.assertRaises(RuntimeError):
+            pool.acquire(exclude=[second])
+        # What `imagegen.py status` shows per host.
+        states = {st["host"]: st for st in pool.states()}
+        self.assertFalse(states[first]["healthy"])
+        self.assertEqual(
+            (states[second]["healthy"], states[second]["in_flight"]), (True, 2)
+        )
+
+    def test_host_pool_keeps_last_healthy_host(self) -> None:
+        pool = OllamaHostPool([None], health_check=lambda h: False)
+        pool.release(pool.acquire(), ok=False)
+        self.assertEqual(pool.healthy_hosts(), [None])
+        self.assertIsNone(pool.acquire())
+
+    def test_host_pool_revives_after_health_check(self) -> None:
+        pool = OllamaHostPool(["a", "b"], recheck_s=0, health_check=lambda h: True)
+        pool.mark_down("a")
+        pool.acquire(exclude=["b"])
+        self.assertEqual(pool.healthy_hosts(), ["a", "b"])
+
+    def test_host_pool_checks_a_host_once_per_interval(self) -> None:
+        checks: list[str | None] = []
+
+        def slow_check(host: str | None) -> bool:
+            checks.append(host)
+            time.sleep(0.1)
+            return False
+
+        pool = OllamaHostPool(["a", "b"], recheck_s=0.5, health_check=slow_check)
+        self.assertFalse(pool.probe("a"))
+        self.assertFalse(pool.probe("a"))  # checked just now: not again
+        time.sleep(0.5)
+        # Workers arriving while "a" is being checked don't check it again.
+        threads = [threading.Thread(target=pool.acquire) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(checks, ["a", "a"])
+
+    def test_run_benchmark_grid(self) -> None:
+        calls = []
+        model_load_s, rows = run_benchmark(
+            lambda w, h, s: calls.append((w, h, s)),
+            sizes=[(256, 256), (512, 512)],
+            steps_list=[4, 8],
+            repeats=2,
+        )
+        # Cold + warm calibration runs, then repeats per grid cell.
+        self.assertEqual(len(calls), 2 + 4 * 2)
+        self.assertEqual(calls[0], (256, 256, 4))
+        self.assertGreaterEqual(model_load_s, 0.0)
+        self.assertEqual(
+            [(r.width, r.steps) for r in rows], [(256, 4), (256, 8), (512, 4), (512, 8)]
+        )
+        self.assertIn("512x512", format_benchmark_table(rows))
+
+
+FAKE_BIN = Path(__file__).resolve().parent / "fake_bin"
+
+
+def fake_ollama_env(**overrides: str) -> mock._patch:
+    env = {
+        "PATH": f"{FAKE_BIN}{os.pathsep}{os.environ.get('PATH', '')}",
+        "FAKE_OLLAMA_QUIET": "1",
+    }
+    env.update(overrides)
+    return mock.patch.dict(os.environ, env)
+
+
+class FakeOllamaTests(unittest.TestCase):
+    def test_generate_image_returns_png(self) -> None:
+        with fake_ollama_env(FAKE_OLLAMA_OUTPUT_BYTES="4096"):
+            data = ollama_generate_image(
+                model="x/fake",
+                prompt="a red circle",
+                width=32,
+                height=16,
+                steps=4,
+                seed=1,
+                negative="text",
+                timeout_s=30,
+            )
+        self.assertTrue(data.startswith(b"\x89PNG\r\n\x1a\n"))
+        self.assertGreaterEqual(len(data), 4096)
+
+    def test_cmd_generate_job_with_failover(self) -> None:
+        with tempfile.TemporaryDirectory() as td:
+            d = Path(td)
+            job = d / "job.json"
+            job.write_text(
+                json.dumps(
+                    {
+                        "version": 1,
+                        "backend": "ollama",
+                        "hosts": ["up:1", "down:2"],
+                        "generate": {"width": 8, "height": 8, "concurrency": 2},
+                        "output": {"dir": str(d / "out")},
+                        "items": [
+                            {"name": f"Item {i}", "prompt": f"prompt {i}"}
+                            for i in range(4)
+                        ],
+                    }
+                ),
+                encoding="utf-8",
+            )
+            log = d / "calls.jsonl"
+            out = io.StringIO()
+            with fake_ollama_env(
+                FAKE_OLLAMA_DOWN_HOSTS="down:2", FAKE_OLLAMA_LOG=str(log)
+            ), contextlib.redirect_stdout(out):
+                rc = ollama.main(
+                    [
+                        "generate",
+                        "--job",
+                        str(job),
+                        "--timings-db",
+                        str(d / "timings.sqlite"),
+                    ]
+                )
+
+            self.assertEqual(rc, 0)
+            names = sorted(p.name for p in (d / "out").iterdir())
+            self.assertEqual(names, [f"item_{i}.png" for i in range(4)])
+            lines = [l for l in out.getvalue().splitlines() if "done:" in l]
+            self.assertEqual(
+                [l.split("]")[0] for l in lines], ["[1/4", "[2/4", "[3/4", "[4/4"]
+            )
+            calls = [json.loads(l) for l in log.read_text().splitlines()]
+            runs = [c for c in calls if c["argv"][0] == "run"]
+            self.assertTrue(all(c["host"] == "up:1" for c in runs))
+            self.assertEqual(len({c["cwd"] for c in runs}), 4)
+
 
 if __name__ == "__main__":
     unittest.main()